@@ -1,8 +1,11 @@
 """Wrapper class for Travis CI API v3."""
 
 from __future__ import unicode_literals
+import io
 import os
 import sys
+import time
+import hashlib
 import logging
 
 try:
@@ -15,6 +18,7 @@ import base64
 from Crypto.Cipher import PKCS1_v1_5
 from Crypto.PublicKey import RSA
 from ..exceptions import InvalidEnvironmentError, InternalError
+from ..utilities import atomic_save, user_cache_dir, timed
 
 
 class TravisCI(object):
@@ -54,6 +58,10 @@ class TravisCI(object):
     SUGGESTION_ORG = "Your travis-ci.ORG token is on the settings tab of your travis-ci profile: https://travis-ci.org/account/preferences"
 
     _key_cache = {}
+    _secure_cache = {}
+
+    KEY_CACHE_SECONDS = 24*60*60
+    """How long public keys are kept in the on-disk cache shared by all processes."""
 
     def __init__(self, com_token=None, org_token=None):
         if com_token is None:
@@ -93,7 +101,8 @@ class TravisCI(object):
         resource = base + url
 
         self._logger.debug("HTTP GET %s", resource)
-        resp = requests.get(resource, headers=headers)
+        with timed('http', "GET " + resource):
+            resp = requests.get(resource, headers=headers)
         self._logger.debug("HTTP RESPONSE: %s", resp)
 
         return resp
@@ -158,13 +167,23 @@ class TravisCI(object):
 
         This method will automatically get the correct key for the repository
         whether it is running on travis-ci.com or travis-ci.org.  It will only
-        look up each key once using a global cache of keys.
+        look up each key once using a global cache of keys.  Keys are also
+        stored for a day in the user's cache directory so that other
+        multipackage processes, e.g. while updating many repositories at
+        once, do not need to look them up again.
         """
 
         if repo_slug in self._key_cache:
             self._logger.debug("Using cached key for repository %s", repo_slug)
             return self._key_cache[repo_slug]
 
+        cache_path = self._key_cache_path(repo_slug)
+        key = _read_cached_file(cache_path, self.KEY_CACHE_SECONDS)
+        if key is not None:
+            self._logger.debug("Using key for repository %s from %s", repo_slug, cache_path)
+            self._key_cache[repo_slug] = key
+            return key
+
         org = self.use_travis_org(repo_slug)
         if org:
             self._logger.info("Getting encryption key for %s on travis-ci.org", repo_slug)
@@ -184,10 +203,35 @@ class TravisCI(object):
         key = key.replace('\\n', '\n')
         self._key_cache[repo_slug] = key
 
+        if cache_path is not None:
+            try:
+                atomic_save(cache_path, key)
+            except (IOError, OSError):
+                self._logger.warning("Could not save key for repository %s to %s", repo_slug, cache_path)
+
         return key
 
+    def _key_cache_path(self, repo_slug):
+        """Get the file where the public key of a repository is cached, if any."""
+
+        cache_dir = user_cache_dir('travis_keys')
+        if cache_dir is None:
+            return None
+
+        # Include the API endpoints so keys from different servers never mix
+        if isinstance(repo_slug, tuple):
+            repo_slug = "/".join(repo_slug)
+
+        identity = "|".join([self.TRAVIS_BASE_COM, self.TRAVIS_BASE_ORG, repo_slug])
+        return os.path.join(cache_dir, hashlib.sha256(identity.encode('utf-8')).hexdigest() + '.pem')
+
     def encrypt_string(self, repo_slug, text):
-        """Encrypt a string using the repo's public key."""
+        """Encrypt a string using the repo's public key.
+
+        Encryption uses random padding so encrypting the same text twice
+        gives different results.  The result is cached by the key and text
+        so that rerendering a file with unchanged secrets does not change it.
+        """
 
         self._logger.debug("Encrypting '%s' for repo '%s'", text, repo_slug)
 
@@ -195,12 +239,33 @@ class TravisCI(object):
             text = text.encode('utf-8')
 
         key_data = self.get_key(repo_slug)
+
+        identity = hashlib.sha256(key_data.encode('utf-8') + b'\0' + text).hexdigest()
+        encrypted = self._secure_cache.get(identity)
+        if encrypted is not None:
+            return encrypted
+
+        cache_path = _secure_cache_path(identity)
+        encrypted = _read_cached_file(cache_path, None)
+        if encrypted is not None:
+            self._secure_cache[identity] = encrypted
+            return encrypted
+
         key = RSA.importKey(key_data)
 
         cipher = PKCS1_v1_5.new(key)
         ciphertext = cipher.encrypt(text)
 
-        return base64.b64encode(ciphertext).decode('utf-8')
+        encrypted = base64.b64encode(ciphertext).decode('utf-8')
+        self._secure_cache[identity] = encrypted
+
+        if cache_path is not None:
+            try:
+                atomic_save(cache_path, encrypted)
+            except (IOError, OSError):
+                self._logger.warning("Could not save encrypted value to %s", cache_path)
+
+        return encrypted
 
     def encrypt_env(self, repo_slug, *env_names, **kwargs):
         """Encrypt one or more environment variables.
@@ -241,3 +306,29 @@ class TravisCI(object):
             enc_text = self.encrypt_string(repo_slug, raw_txt)
 
         return "secure: {}".format(enc_text)
+
+
+def _secure_cache_path(identity):
+    """Get the file where an encrypted value is cached, if any."""
+
+    cache_dir = user_cache_dir('travis_secure')
+    if cache_dir is None:
+        return None
+
+    return os.path.join(cache_dir, identity + '.txt')
+
+
+def _read_cached_file(path, max_age):
+    """Read a cached file if it exists and is not older than max_age, if given."""
+
+    if path is None:
+        return None
+
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            return None
+
+        with io.open(path, "r", encoding="utf-8", newline='') as infile:
+            return infile.read()
+    except (IOError, OSError):
+        return None
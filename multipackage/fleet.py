@@ -0,0 +1,201 @@
+"""Run multipackage actions over every repository below a folder.
+
+Each repository is processed in its own worker process.  Before the
+workers are started, the caches that every repository needs are warmed in
+the parent so the workers inherit them instead of each filling them again:
+all templates are loaded and compiled, and the modules used to talk to
+Travis CI are imported.  Package discovery results and Travis CI public keys
+are shared between the workers through their on-disk caches.
+"""
+
+from __future__ import unicode_literals
+import os
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from .exceptions import UsageError, InvalidEnvironmentError
+from .repo import Repository
+
+FLEET_ACTIONS = ('info', 'update')
+REPORT_VERSION = 1
+
+
+def find_repositories(root):
+    """Find all multipackage repositories below a folder.
+
+    A repository is a folder containing ``.multipackage/settings.json``.
+    Hidden folders are skipped and the search does not descend into a
+    repository once one is found.
+
+    Args:
+        root (str): The folder to search.
+
+    Returns:
+        list of str: The sorted absolute paths of the repositories found.
+    """
+
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        raise UsageError("Path '{}' should be a folder but it doesn't exist".format(root), "Check your path")
+
+    found = []
+    pending = [root]
+
+    while len(pending) > 0:
+        folder = pending.pop()
+
+        if os.path.isfile(os.path.join(folder, Repository.SETTINGS_FILE)):
+            found.append(folder)
+            continue
+
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+
+    return sorted(found)
+
+
+def warm_caches():
+    """Fill the in-process caches that every repository uses."""
+
+    from .utilities import warm_template_cache
+    from .external import travis  # pylint: disable=unused-import
+
+    warm_template_cache()
+
+
+def _format_messages(repo, message_type):
+    return [{'file': msg.file, 'message': msg.message, 'suggestion': msg.suggestion}
+            for msg in repo.iter_messages(message_type)]
+
+
+def _process_repository(action, repo_path, force=False, dry_run=False, paranoid=False):
+    """Run a single action on a repository and describe the outcome.
+
+    This runs inside of a worker process so it never raises, every error is
+    recorded in the result instead.
+
+    Returns:
+        dict: The result for this repository, see :func:`run_fleet`.
+    """
+
+    result = {
+        'path': repo_path,
+        'status': 'ok',
+        'exit_code': 0,
+        'errors': [],
+        'warnings': []
+    }
+
+    try:
+        repo = Repository(repo_path)
+
+        if action == 'info':
+            repo.manifest.verify_all(report=True, paranoid=paranoid)
+        elif repo.clean:
+            if dry_run:
+                overlay = repo.update(dry_run=True, force=force)
+                changes = [path for path, _data in overlay.changes()] + overlay.directories
+                result['changes'] = sorted(os.path.relpath(path, repo_path) for path in changes)
+            else:
+                repo.update(force=force)
+
+        result['errors'] = _format_messages(repo, 'error')
+        result['warnings'] = _format_messages(repo, 'warning')
+
+        if not repo.clean:
+            result['status'] = 'unclean'
+            result['exit_code'] = 2 if action == 'update' else 1
+        elif len(result.get('changes', [])) > 0:
+            result['status'] = 'outdated'
+            result['exit_code'] = 1
+    except UsageError as err:
+        result['status'] = 'error'
+        result['exit_code'] = 1
+        result['errors'].append({'file': None, 'message': err.message, 'suggestion': err.suggestion})
+    except InvalidEnvironmentError as err:
+        result['status'] = 'error'
+        result['exit_code'] = 1
+        result['errors'].append({'file': None, 'message': "Missing environment variable %s: %s" % (err.variable_name, err.reason),
+                                 'suggestion': err.suggestion})
+    except Exception as err:  # pylint: disable=broad-except
+        logging.getLogger(__name__).debug("Error processing repository %s", repo_path, exc_info=True)
+
+        result['status'] = 'error'
+        result['exit_code'] = 1
+        result['errors'].append({'file': None, 'message': "Unexpected %s: %s" % (type(err).__name__, str(err)),
+                                 'suggestion': None, 'traceback': traceback.format_exc()})
+
+    return result
+
+
+def run_fleet(root, action, force=False, dry_run=False, paranoid=False, jobs=None):
+    """Run info or update on every repository below a folder.
+
+    Repositories are processed concurrently in a pool of worker processes
+    after warming shared caches with :func:`warm_caches`.
+
+    Args:
+        root (str): The folder to search for repositories.
+        action (str): Either 'info' or 'update'.
+        force (bool): Update every subsystem even if it appears to be up to
+            date.  Only used by update.
+        dry_run (bool): Only report the files that update would change.
+        paranoid (bool): Rehash every managed file rather than trusting
+            unchanged file stat information.  Only used by info.
+        jobs (int): The number of worker processes.  Defaults to the
+            number of CPUs.  If 1, all repositories are processed in this
+            process.
+
+    Returns:
+        dict: A machine readable report with a ``repositories`` list holding
+        the ``path``, ``status`` (ok, outdated, unclean or error),
+        ``exit_code``, ``errors`` and ``warnings`` of each repository, plus
+        its ``changes`` in dry run mode.  The ``summary`` counts the
+        repositories with each status and ``exit_code`` is the largest exit
+        code of any repository.
+    """
+
+    if action not in FLEET_ACTIONS:
+        raise UsageError("Unsupported action for multiple repositories: %s" % action,
+                         "Use one of %s" % ", ".join(FLEET_ACTIONS))
+
+    repos = find_repositories(root)
+    logger = logging.getLogger(__name__)
+    logger.info("Found %d repositories below %s", len(repos), root)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    jobs = max(1, min(jobs, len(repos)))
+
+    warm_caches()
+
+    if jobs == 1:
+        results = [_process_repository(action, path, force, dry_run, paranoid) for path in repos]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_process_repository, action, path, force, dry_run, paranoid) for path in repos]
+
+        results = [future.result() for future in futures]
+
+    summary = {status: 0 for status in ('ok', 'outdated', 'unclean', 'error')}
+    for result in results:
+        summary[result['status']] += 1
+
+    return {
+        'version': REPORT_VERSION,
+        'action': action,
+        'root': os.path.abspath(root),
+        'repositories': results,
+        'summary': summary,
+        'exit_code': max([x['exit_code'] for x in results] + [0])
+    }
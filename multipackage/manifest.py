@@ -1,12 +1,14 @@
 """A hash based manifest file."""
 
-import os.path
+import os
 import json
+import errno
 import logging
 from builtins import open
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from future.utils import viewitems
-from .utilities import line_hash, dict_hash, atomic_json, ManagedFileSection
+from .utilities import line_hash, line_hash_file, dict_hash, hash_method, atomic_json, ManagedFileSection, timed
 from .exceptions import InternalError
 
 VALID = 0
@@ -14,7 +16,12 @@ NOT_PRESENT = 1
 INVALID_HASH = 2
 PRESENT_UNKNOWN = 3
 
-ManagedFile = namedtuple("ManagedFile", ["relative_path", "absolute_path", "status", "expected_hash", "hash_type"])
+# Entries are loaded with an unresolved status that is only checked when needed
+_UNRESOLVED = None
+
+ManagedFile = namedtuple("ManagedFile", ["relative_path", "absolute_path", "status", "expected_hash", "hash_type", "file_stat"])
+HashJob = namedtuple("HashJob", ["path", "hash_type", "known_hash"])
+HashJob.__new__.__defaults__ = (None,)
 
 class ManifestFile(object):
     """A hash based manifest file.
@@ -22,6 +29,21 @@ class ManifestFile(object):
     This class will load a json file that contains relative file paths and
     hash values.  It can detect changes in the files using the hashes.
 
+    Along with each hash, the size, modification time (in nanoseconds) and
+    inode number of the file are recorded at the time it was hashed.  Files
+    whose stat information has not changed since then are assumed to still
+    match their hash without being read again, unless a paranoid
+    verification is explicitly requested.
+
+    Each hash is prefixed with the name of the algorithm that produced it, so
+    a manifest can contain entries hashed with different algorithms.  Entries
+    are always verified with their own algorithm while new hashes are
+    calculated with the configured ``hash_method``.
+
+    The manifest also stores a fingerprint for each subsystem that records
+    the inputs and outputs of its last update, see :meth:`get_fingerprint`.
+    In the json file these are kept under the reserved ``#fingerprints`` key.
+
     Args:
         path (str): The path to the manifest file.  If it does not exist it
             will be initialized as empty.
@@ -30,66 +52,192 @@ class ManifestFile(object):
         reporter (object): An error reporter class that has a ``warning``,
             `error`` and ``info`` method.  This is compatible with the
             signatures of the Repository class so it can be passed directly.
+        hash_method (str): The hash algorithm used for all newly recorded
+            hashes.  Default: md5.
     """
 
-    def __init__(self, path, base_path, reporter):
+    MAX_HASH_WORKERS = 8
+    """The maximum number of threads used to hash files concurrently."""
+
+    FINGERPRINT_KEY = "#fingerprints"
+
+    def __init__(self, path, base_path, reporter, hash_method="md5"):
         self.path = path
+        self.hash_method = hash_method
         self._relative_base = os.path.abspath(base_path)
         self._relative_path = os.path.relpath(path, start=self._relative_base)
         self._logger = logging.getLogger(__name__)
         self._reporter = reporter
-        self.files = {}
+        self._dirty = False
+        self._changed_keys = set()
+        self._changed_fingerprints = set()
+        self._files = {}
+        self._fingerprints = {}
 
         self._try_load()
 
+    @property
+    def files(self):
+        """A dict of all ManagedFile entries in this manifest by key.
+
+        Whether each file exists is checked the first time this property is
+        accessed rather than when the manifest is loaded.
+        """
+
+        self._load_all()
+        self._resolve_statuses(list(self._files))
+        return self._files
+
+    def _load_all(self):
+        """Make sure every entry is loaded into memory."""
+
+    def _load_fingerprints(self):
+        """Make sure every subsystem fingerprint is loaded into memory."""
+
     def _try_load(self):
-        if not os.path.exists(self.path):
-            self._reporter.error(self._relative_path, "Manifest file does not exist",
-                                     "Run `multipackage init --force`")
+        # If the manifest cannot be loaded it will be rewritten on the next save
+        self._dirty = True
+
+        data = self._read_json(self.path)
+        if data is None:
             return
 
+        self._dirty = False
+        self._parse_entries(data)
+
+    def _read_json(self, path):
         try:
-            with open(self.path, "r") as infile:
-                data = json.load(infile)
+            with open(path, "r") as infile:
+                return json.load(infile)
         except ValueError:
-            self._logger.exception("Error parsing manifest file %s", self.path)
+            self._logger.exception("Error parsing manifest file %s", path)
             self._reporter.error(self._relative_path, "Could not parse JSON in manifest file",
                                      "Run `multipackage init --force`")
-            return
-        except IOError:
-            self._logger.exception("Error loading manifest file %s", self.path)
+            return None
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                self._reporter.error(self._relative_path, "Manifest file does not exist",
+                                         "Run `multipackage init --force`")
+                return None
+
+            self._logger.exception("Error loading manifest file %s", path)
             self._reporter.error(self._relative_path, "Could not load manifest file",
                                      "Run `multipackage init --force`")
-            return
+            return None
+
+    def _parse_entries(self, data):
+        fingerprints = data.pop(self.FINGERPRINT_KEY, {})
+        if isinstance(fingerprints, dict):
+            self._fingerprints.update(fingerprints)
 
         for key, value in viewitems(data):
-            status = PRESENT_UNKNOWN
-            path = os.path.join(self._relative_base, key)
-            if not os.path.exists(path):
-                status = NOT_PRESENT
+            info = self._parse_entry(key, value)
+            if info is None:
+                self._dirty = True
+                continue
 
-            hash_value = value.get('hash')
-            hash_type = value.get('hash_type')
+            self._files[key] = info
 
-            if hash_value is None or hash_type is None:
-                self._logger.error("Invalid manifest file entry for key %s: %s", key, value)
-                self._reporter.error(self._relative_path, "Invalid manifest entry for key %s" % key,
-                                         "Run `multipackage init --force`")
-                continue
+    def _parse_entry(self, key, value):
+        path = os.path.join(self._relative_base, key)
+        hash_value = value.get('hash')
+        hash_type = value.get('hash_type')
 
-            self.files[key] = ManagedFile(key, path, status, hash_value, hash_type)
+        if hash_value is None or hash_type is None:
+            self._logger.error("Invalid manifest file entry for key %s: %s", key, value)
+            self._reporter.error(self._relative_path, "Invalid manifest entry for key %s" % key,
+                                     "Run `multipackage init --force`")
+            return None
+
+        file_stat = None
+        if all(value.get(x) is not None for x in ('size', 'mtime_ns', 'inode')):
+            file_stat = (value['size'], value['mtime_ns'], value['inode'])
+
+        return ManagedFile(key, path, _UNRESOLVED, hash_value, hash_type, file_stat)
+
+    def _resolve_statuses(self, keys):
+        """Check whether the files for entries with an unresolved status exist.
+
+        Files are grouped by folder so that each folder with more than one
+        unresolved entry is listed once using os.scandir rather than checking
+        every file individually.
+        """
+
+        folders = {}
+        for key in keys:
+            info = self._files[key]
+            if info.status is _UNRESOLVED:
+                folder, name = os.path.split(info.absolute_path)
+                folders.setdefault(folder, []).append((name, info))
+
+        for folder, entries in viewitems(folders):
+            if len(entries) == 1:
+                name, info = entries[0]
+                present = {name} if os.path.exists(info.absolute_path) else set()
+            else:
+                present = _list_folder(folder)
+
+            for name, info in entries:
+                status = PRESENT_UNKNOWN if name in present else NOT_PRESENT
+                self._files[info.relative_path] = info._replace(status=status)
+
+    def _lookup(self, key):
+        """Find the entry for a key, None if it is not in the manifest."""
+
+        return self._files.get(key)
+
+    def _store(self, info, changed=True):
+        """Store an entry, marking it as needing to be saved if it changed."""
+
+        self._files[info.relative_path] = info
 
-    def verify_all(self, report=False):
+        if changed:
+            self._changed_keys.add(info.relative_path)
+            self._dirty = True
+
+    def _discard(self, key):
+        """Remove the entry for a key."""
+
+        del self._files[key]
+        self._changed_keys.add(key)
+        self._dirty = True
+
+    def verify_all(self, report=False, paranoid=False):
         """Verify the hashes of all managed files.
 
+        Files whose size, modification time and inode are the same as when
+        they were last hashed are assumed to be unchanged and are not read
+        from disk unless ``paranoid`` is True.
+
         Args:
             report (bool): Report errors for all invalid files.
+            paranoid (bool): Rehash every file even if its stat information
+                has not changed since its hash was recorded.
         """
 
-        for key, info in viewitems(self.files):
+        to_hash = []
+        entries = {}
+
+        self._load_all()
+        for key, info in list(viewitems(self._files)):
+            file_stat = _stat_signature(info.absolute_path)
+            if file_stat is None:
+                self._store(info._replace(status=NOT_PRESENT), changed=False)
+            elif not paranoid and info.file_stat is not None and file_stat == info.file_stat:
+                self._store(info._replace(status=VALID), changed=False)
+            else:
+                entries[key] = info
+                to_hash.append((key, file_stat))
+
+        jobs = [HashJob(entries[key].absolute_path, entries[key].hash_type) for key, _file_stat in to_hash]
+        methods = [self._entry_method(entries[key]) for key, _file_stat in to_hash]
+        hashes = self._load_files(jobs, methods)
+
+        for (key, file_stat), actual_hash in zip(to_hash, hashes):
+            info = entries[key]
             status = NOT_PRESENT
+            changed = False
 
-            actual_hash = self._load_file(info.absolute_path, hash_type=info.hash_type)
             if actual_hash is not None and actual_hash != info.expected_hash:
                 self._logger.error("Invalid hash for file %s, found %s, expected: %s",
                                    info.absolute_path, actual_hash, info.expected_hash)
@@ -99,10 +247,16 @@ class ManifestFile(object):
                 if report:
                     self._reporter.error(key, "File hash does not match",
                                              "Run `multipackage update`")
+            elif actual_hash is not None:
+                # The contents are unchanged so refresh the stat information to
+                # allow the fast path to be taken the next time this manifest is saved
+                status = VALID
+                changed = info.file_stat != file_stat
+                info = info._replace(file_stat=file_stat)
 
-            self.files[key] = ManagedFile(key, info.absolute_path, status, info.expected_hash, info.hash_type)
+            self._store(info._replace(status=status), changed=changed)
 
-    def verify_file(self, path):
+    def verify_file(self, path, paranoid=False):
         """Verify the status of a given file.
 
         The argument should be the path to a given file.  If the file is
@@ -111,6 +265,8 @@ class ManifestFile(object):
 
         Args:
             path (str): The path to the file to check.
+            paranoid (bool): Rehash the file even if its stat information
+                has not changed since its hash was recorded.
 
         Returns:
             str: The status of the file.
@@ -126,11 +282,14 @@ class ManifestFile(object):
 
         key = self._make_key(path)
 
-        info = self.files.get(key)
+        info = self._lookup(key)
         if info is None:
             raise InternalError("ManifestFile.verify_file called on file that is not in the manifest: %s" % path)
 
-        actual_hash = self._load_file(info.absolute_path, hash_type=info.hash_type)
+        if not paranoid and info.file_stat is not None and _stat_signature(info.absolute_path) == info.file_stat:
+            return "unchanged"
+
+        actual_hash = self._load_file(info.absolute_path, hash_type=info.hash_type, method=self._entry_method(info))
         if actual_hash is None:
             return "not_present"
 
@@ -161,22 +320,100 @@ class ManifestFile(object):
                 the rest is not.  Default: "line"
         """
 
-        if hash_type not in ('line', 'json', 'section'):
-            self._logger.error("Invalid hash type in update_file: %s, supported: line, json", hash_type)
-            raise InternalError("update_file called with invalid hash type: %s" % hash_type)
+        self.update_files([HashJob(path, hash_type)])
 
-        abspath = os.path.abspath(path)
-        actual_hash = self._load_file(path, hash_type=hash_type)
-        key = self._make_key(path)
+    def update_files(self, jobs):
+        """Add or update the hashes for many files at once.
 
-        if actual_hash is None:
-            status = NOT_PRESENT
-            self._logger.error("ManifestFile.update_file called on path that does not exist: %s", path)
-        else:
-            status = VALID
+        This is the batched equivalent of calling :meth:`update_file` for
+        each file.  The files are hashed concurrently.  Files that were not
+        touched since their hash was recorded, i.e. whose stat information is
+        unchanged, keep their existing hash without being read again.
 
-        info = ManagedFile(key, abspath, status, actual_hash, hash_type)
-        self.files[key] = info
+        If a job includes a known_hash calculated with this manifest's hash
+        method while the file was written, it is trusted and the file is not
+        read again.
+
+        Args:
+            jobs (list of HashJob): The path and hash type of each file that
+                should be updated.  See :meth:`update_file` for the supported
+                hash types.
+        """
+
+        for job in jobs:
+            if job.hash_type not in ('line', 'json', 'section'):
+                self._logger.error("Invalid hash type in update_file: %s, supported: line, json", job.hash_type)
+                raise InternalError("update_file called with invalid hash type: %s" % job.hash_type)
+
+        # Stat before hashing so that a concurrent modification can never be
+        # recorded with a stat signature that matches its new contents.
+        file_stats = [_stat_signature(job.path) for job in jobs]
+        old_entries = [self._lookup(self._make_key(job.path)) for job in jobs]
+
+        known_hashes = [self._known_hash(job, file_stat) for job, file_stat in zip(jobs, file_stats)]
+
+        to_hash = [job for job, file_stat, old_info, known_hash in zip(jobs, file_stats, old_entries, known_hashes)
+                   if known_hash is None and not self._is_current(old_info, job.hash_type, file_stat)]
+        hashes = iter(self._load_files(to_hash, [self.hash_method] * len(to_hash)))
+
+        for job, file_stat, old_info, known_hash in zip(jobs, file_stats, old_entries, known_hashes):
+            abspath = os.path.abspath(job.path)
+            key = self._make_key(job.path)
+
+            if known_hash is not None:
+                actual_hash = known_hash
+            elif self._is_current(old_info, job.hash_type, file_stat):
+                actual_hash = old_info.expected_hash
+            else:
+                actual_hash = next(hashes)
+
+            if actual_hash is None:
+                status = NOT_PRESENT
+                file_stat = None
+                self._logger.error("ManifestFile.update_file called on path that does not exist: %s", job.path)
+            else:
+                status = VALID
+
+            info = ManagedFile(key, abspath, status, actual_hash, job.hash_type, file_stat)
+            changed = old_info is None or self._serialize_entry(old_info) != self._serialize_entry(info)
+            self._store(info, changed=changed)
+
+    def _known_hash(self, job, file_stat):
+        """Get a precomputed hash for a job if it can be trusted."""
+
+        if job.known_hash is None or file_stat is None:
+            return None
+
+        if hash_method(job.known_hash) != self.hash_method:
+            return None
+
+        return job.known_hash
+
+    def migrate_hashes(self):
+        """Rehash entries that were recorded with a different hash method.
+
+        Only entries whose file still matches its recorded hash are migrated
+        to the configured ``hash_method``.  Entries for missing or locally
+        modified files keep their old hash so that the modification is still
+        detected.
+
+        Returns:
+            list of str: The keys of all entries that were migrated.
+        """
+
+        self._load_all()
+        outdated = [info for info in self._files.values() if self._entry_method(info) != self.hash_method]
+        if len(outdated) == 0:
+            return []
+
+        jobs = [HashJob(info.absolute_path, info.hash_type) for info in outdated]
+        old_hashes = self._load_files(jobs, [self._entry_method(info) for info in outdated])
+
+        unchanged = [job for job, info, old_hash in zip(jobs, outdated, old_hashes)
+                     if old_hash is not None and old_hash == info.expected_hash]
+
+        self.update_files(unchanged)
+        return [self._make_key(job.path) for job in unchanged]
 
     def remove_file(self, path, force=False):
         """Remove a managed file from the manifest.
@@ -196,19 +433,143 @@ class ManifestFile(object):
         """
 
         key = self._make_key(path)
-        if key not in self.files and not force:
+        exists = self._lookup(key) is not None
+        if not exists and not force:
             self._logger.error("Attempted to remove unkown file %s from manifest", path)
             raise InternalError("Attempted to remove file %s from Manifest but it was not present" % path, "Try using ManifestFile.remove_file(path, force=True)")
 
-        if key in self.files:
-            del self.files[key]
+        if exists:
+            self._discard(key)
+
+    def get(self, path):
+        """Get the manifest entry for a file.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            ManagedFile: The entry for the file or None if it is not in the
+            manifest.
+        """
+
+        key = self._make_key(path)
+        if self._lookup(key) is None:
+            return None
+
+        self._resolve_statuses([key])
+        return self._files[key]
+
+    def find_prefix(self, path):
+        """Find all manifest entries for files inside a folder.
+
+        This is useful for working with the files of a single component
+        without visiting every entry in the manifest.
+
+        Args:
+            path (str): The path to the folder.  All entries for files
+                inside it, including its subfolders, are returned.
+
+        Returns:
+            list of ManagedFile: The matching entries sorted by key.
+        """
+
+        prefix = self._make_prefix(path)
+        keys = sorted(key for key in self._files if key.startswith(prefix))
 
-    def save(self):
-        """Atomically save this file to disk."""
+        self._resolve_statuses(keys)
+        return [self._files[key] for key in keys]
+
+    def clear(self):
+        """Remove all entries and fingerprints from this manifest."""
+
+        self._load_all()
+        for key in list(self._files):
+            self._discard(key)
+
+        self._load_fingerprints()
+        for name in list(self._fingerprints):
+            self.set_fingerprint(name, None)
+
+    def get_fingerprint(self, name):
+        """Get the stored fingerprint of a subsystem.
+
+        Args:
+            name (str): The name of the subsystem.
+
+        Returns:
+            dict: The fingerprint that was last stored with
+            :meth:`set_fingerprint` or None if there is none.
+        """
+
+        self._load_fingerprints()
+        return self._fingerprints.get(name)
+
+    def set_fingerprint(self, name, fingerprint):
+        """Store or remove the fingerprint of a subsystem.
+
+        Args:
+            name (str): The name of the subsystem.
+            fingerprint (dict): A json serializable description of the
+                subsystem's last update, or None to remove it.
+        """
+
+        self._load_fingerprints()
+        if self._fingerprints.get(name) == fingerprint:
+            return
+
+        if fingerprint is None:
+            del self._fingerprints[name]
+        else:
+            self._fingerprints[name] = fingerprint
+
+        self._changed_fingerprints.add(name)
+        self._dirty = True
+
+    @property
+    def dirty(self):
+        """Whether there are changes that have not been saved to disk."""
+
+        return self._dirty
+
+    def save(self, force=False):
+        """Atomically save this file to disk.
+
+        The file is only written if an entry has changed since it was loaded
+        or last saved so that an unchanged manifest keeps its modification
+        time.
+
+        Args:
+            force (bool): Write the file even if nothing has changed.
+        """
+
+        if not (self._dirty or force):
+            self._logger.debug("Manifest file %s is unchanged, not saving", self.path)
+            return
+
+        with timed('manifest', 'save %s' % os.path.basename(self.path)):
+            self._write()
+
+        self._dirty = False
+        self._changed_keys.clear()
+        self._changed_fingerprints.clear()
+
+    def _write(self):
+        data = {key: self._serialize_entry(info) for key, info in viewitems(self._files)}
+
+        if len(self._fingerprints) > 0:
+            data[self.FINGERPRINT_KEY] = self._fingerprints
 
-        data = {key: {'hash': info.expected_hash, 'hash_type': info.hash_type} for key, info in viewitems(self.files)}
         atomic_json(self.path, data)
 
+    @classmethod
+    def _serialize_entry(cls, info):
+        entry = {'hash': info.expected_hash, 'hash_type': info.hash_type}
+
+        if info.file_stat is not None:
+            entry['size'], entry['mtime_ns'], entry['inode'] = info.file_stat
+
+        return entry
+
     def _make_key(self, path):
         abspath = os.path.abspath(path)
         key = os.path.normpath(os.path.relpath(abspath, self._relative_base))
@@ -216,24 +577,297 @@ class ManifestFile(object):
         key = key.replace('\\', '/')
         return key
 
+    def _make_prefix(self, path):
+        key = self._make_key(path)
+        if key == '.':
+            return ''
+
+        return key + '/'
+
+    def _is_current(self, info, hash_type, file_stat):
+        """Check if an entry's hash is still valid for an untouched file."""
+
+        return (info is not None and file_stat is not None and info.file_stat == file_stat
+                and info.hash_type == hash_type and self._entry_method(info) == self.hash_method)
+
+    def _entry_method(self, info):
+        try:
+            return hash_method(info.expected_hash)
+        except ValueError:
+            return self.hash_method
+
+    @classmethod
+    def _load_files(cls, jobs, methods=None):
+        """Hash a batch of files using a bounded pool of worker threads.
+
+        Hashing is dominated by file I/O latency, which threads can overlap
+        even with the GIL.  The returned list is in the same order as
+        ``jobs`` regardless of the order in which the hashes complete.
+
+        Args:
+            jobs (list of HashJob): The files to hash.
+            methods (list of str): Optional hash method to use for each job.
+                Defaults to md5 for all jobs.
+
+        Returns:
+            list of str: The hash of each file, None if it does not exist.
+        """
+
+        if methods is None:
+            methods = ["md5"] * len(jobs)
+
+        load = lambda job, method: cls._load_file(job.path, hash_type=job.hash_type, method=method)
+
+        if len(jobs) < 2:
+            return [load(job, method) for job, method in zip(jobs, methods)]
+
+        workers = min(cls.MAX_HASH_WORKERS, len(jobs))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(load, jobs, methods))
+
     @classmethod
-    def _load_file(cls, path, hash_type="line", delimiter_start='#', delimiter_end=''):
+    def _load_file(cls, path, hash_type="line", method="md5", delimiter_start='#', delimiter_end=''):
+        with timed('hash', path):
+            return cls._hash_file(path, hash_type, method, delimiter_start, delimiter_end)
+
+    @classmethod
+    def _hash_file(cls, path, hash_type, method, delimiter_start, delimiter_end):
         if not os.path.exists(path):
             return None
 
         if hash_type == 'line':
-            with open(path, "r", encoding="utf-8", newline='') as infile:
-                lines = infile.readlines()
-
-            return line_hash(lines)
+            return line_hash_file(path, method)
         elif hash_type == 'json':
             with open(path, "r") as infile:
                 data = json.load(infile)
-                return dict_hash(data)
+                return dict_hash(data, method)
         elif hash_type == 'section':
             section = ManagedFileSection(path, delimiter_start=delimiter_start,
                                          delimiter_end=delimiter_end)
 
-            return section.actual_hash
+            if not section.has_section:
+                return None
+
+            return line_hash(section.section_contents, method)
 
         raise InternalError("ManifestFile._load_file called with invalid hash type: %s" % hash_type)
+
+
+class SQLiteManifestFile(ManifestFile):
+    """A manifest stored in an indexed SQLite database.
+
+    This class has the same API as :class:`ManifestFile` but it is meant for
+    repositories that manage a very large number of files.  Entries are only
+    loaded from the database when they are needed, lookups and
+    :meth:`find_prefix` queries use the primary key index, and saving only
+    writes the entries that changed inside a single transaction.
+
+    Accessing the ``files`` property loads every entry.
+
+    If the database does not exist yet but a json manifest is present, its
+    entries are imported and written to the database on the next save.
+
+    Args:
+        path (str): The path to the manifest database.
+        base_path (str): The base path that will be used to store relative
+            paths for keys.
+        reporter (object): An error reporter class that has a ``warning``,
+            `error`` and ``info`` method.
+        hash_method (str): The hash algorithm used for all newly recorded
+            hashes.  Default: md5.
+        legacy_path (str): Optional path to a json manifest file that should
+            be imported if the database does not exist.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+              "hash_type TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, inode INTEGER)")
+    COLUMNS = "key, hash, hash_type, size, mtime_ns, inode"
+    FINGERPRINT_SCHEMA = "CREATE TABLE IF NOT EXISTS fingerprints (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+
+    def __init__(self, path, base_path, reporter, hash_method="md5", legacy_path=None):
+        self._legacy_path = legacy_path
+        self._connection = None
+        self._all_loaded = False
+        self._fingerprints_loaded = False
+        self._rebuild = False
+
+        super(SQLiteManifestFile, self).__init__(path, base_path, reporter, hash_method=hash_method)
+
+    def _load_all(self):
+        if not self._all_loaded:
+            self._add_rows(self._query("SELECT %s FROM files" % self.COLUMNS))
+            self._all_loaded = True
+
+    def _load_fingerprints(self):
+        if not self._fingerprints_loaded:
+            for name, value in self._query("SELECT name, value FROM fingerprints"):
+                if name not in self._changed_fingerprints:
+                    self._fingerprints[name] = json.loads(value)
+
+            self._fingerprints_loaded = True
+
+    def _try_load(self):
+        # sqlite3 is only needed by repositories that use this manifest so keep it out of CLI startup
+        import sqlite3
+
+        if os.path.exists(self.path):
+            try:
+                self._open()
+                return
+            except sqlite3.DatabaseError:
+                self._logger.exception("Error loading manifest database %s", self.path)
+                self._reporter.error(self._relative_path, "Could not load manifest database",
+                                         "Run `multipackage init --force`")
+        elif self._legacy_path is not None and os.path.exists(self._legacy_path):
+            self._logger.info("Importing json manifest %s into %s", self._legacy_path, self.path)
+
+            data = self._read_json(self._legacy_path)
+            if data is not None:
+                self._parse_entries(data)
+        else:
+            self._reporter.error(self._relative_path, "Manifest file does not exist",
+                                     "Run `multipackage init --force`")
+
+        # Whatever could be loaded is written to a fresh database on the next save
+        self._rebuild = True
+        self._dirty = True
+        self._all_loaded = True
+        self._fingerprints_loaded = True
+
+    def _open(self):
+        import sqlite3
+
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute(self.SCHEMA)
+        self._connection.execute(self.FINGERPRINT_SCHEMA)
+
+    def close(self):
+        """Close the connection to the manifest database."""
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _query(self, query, args=()):
+        if self._connection is None:
+            return []
+
+        return self._connection.execute(query, args).fetchall()
+
+    def _add_rows(self, rows):
+        """Add entries for database rows that are not already loaded."""
+
+        for row in rows:
+            key = row[0]
+            if key in self._files or key in self._changed_keys:
+                continue
+
+            value = dict(zip(('hash', 'hash_type', 'size', 'mtime_ns', 'inode'), row[1:]))
+            info = self._parse_entry(key, value)
+            if info is not None:
+                self._files[key] = info
+
+    def _lookup(self, key):
+        if key not in self._files and not self._all_loaded:
+            self._add_rows(self._query("SELECT %s FROM files WHERE key = ?" % self.COLUMNS, (key,)))
+
+        return self._files.get(key)
+
+    def find_prefix(self, path):
+        """Find all manifest entries for files inside a folder.
+
+        Args:
+            path (str): The path to the folder.  All entries for files
+                inside it, including its subfolders, are returned.
+
+        Returns:
+            list of ManagedFile: The matching entries sorted by key.
+        """
+
+        prefix = self._make_prefix(path)
+
+        if prefix == '':
+            self._load_all()
+        elif not self._all_loaded:
+            # All keys starting with "dir/" sort between "dir/" and "dir0"
+            end = prefix[:-1] + '0'
+            self._add_rows(self._query("SELECT %s FROM files WHERE key >= ? AND key < ?" % self.COLUMNS,
+                                       (prefix, end)))
+
+        return super(SQLiteManifestFile, self).find_prefix(path)
+
+    def _write(self):
+        if self._rebuild:
+            self._write_database()
+            return
+
+        changed = sorted(self._changed_keys)
+        updated = [self._serialize_row(self._files[key]) for key in changed if key in self._files]
+        removed = [(key,) for key in changed if key not in self._files]
+
+        changed_names = sorted(self._changed_fingerprints)
+        updated_fingerprints = [(name, json.dumps(self._fingerprints[name], sort_keys=True))
+                                for name in changed_names if name in self._fingerprints]
+        removed_fingerprints = [(name,) for name in changed_names if name not in self._fingerprints]
+
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO files (%s) VALUES (?, ?, ?, ?, ?, ?)"
+                                         % self.COLUMNS, updated)
+            self._connection.executemany("DELETE FROM files WHERE key = ?", removed)
+            self._connection.executemany("INSERT OR REPLACE INTO fingerprints (name, value) VALUES (?, ?)",
+                                         updated_fingerprints)
+            self._connection.executemany("DELETE FROM fingerprints WHERE name = ?", removed_fingerprints)
+
+    def _write_database(self):
+        """Atomically replace the database with all loaded entries."""
+
+        import sqlite3
+
+        self.close()
+
+        tmp_path = self.path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        connection = sqlite3.connect(tmp_path)
+        try:
+            with connection:
+                connection.execute(self.SCHEMA)
+                connection.execute(self.FINGERPRINT_SCHEMA)
+                connection.executemany("INSERT INTO files (%s) VALUES (?, ?, ?, ?, ?, ?)" % self.COLUMNS,
+                                       [self._serialize_row(info) for info in self._files.values()])
+                connection.executemany("INSERT INTO fingerprints (name, value) VALUES (?, ?)",
+                                       [(name, json.dumps(value, sort_keys=True))
+                                        for name, value in viewitems(self._fingerprints)])
+        finally:
+            connection.close()
+
+        os.replace(tmp_path, self.path)
+
+        self._open()
+        self._rebuild = False
+
+    @classmethod
+    def _serialize_row(cls, info):
+        size, mtime_ns, inode = info.file_stat if info.file_stat is not None else (None, None, None)
+        return (info.relative_path, info.expected_hash, info.hash_type, size, mtime_ns, inode)
+
+
+def _list_folder(path):
+    """Return the names of all entries in a folder, empty if it is missing."""
+
+    try:
+        return set(entry.name for entry in os.scandir(path))
+    except OSError:
+        return set()
+
+
+def _stat_signature(path):
+    """Return the (size, mtime_ns, inode) tuple of a file or None if missing."""
+
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+
+    return (info.st_size, info.st_mtime_ns, info.st_ino)
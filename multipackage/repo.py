@@ -1,16 +1,22 @@
 """Main entry point for dealing with repositories."""
 
 from __future__ import unicode_literals
+import io
 import os
 import re
 import json
-import shutil
+import stat
+import threading
 import logging
 from builtins import open
 from collections import namedtuple
+from future.utils import viewitems
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from .exceptions import UsageError, InternalError, InvalidEnvironmentError, InvalidSettingError
-from .utilities import atomic_json, ManagedFileSection, render_template
-from .manifest import ManifestFile
+from .utilities import (atomic_json, dict_hash, FileOverlay, ManagedFileSection, LineHasher, stream_template,
+                        SUPPORTED_HASH_METHODS, timed)
+from .manifest import ManifestFile, SQLiteManifestFile, HashJob
 from .templates import PyPIPackageTemplate, ManualTemplate
 
 
@@ -20,6 +26,79 @@ EnvironmentVariable = namedtuple("EnvironmentVariable", ['name', 'subsystem', 'c
 
 _MISSING = object()
 
+# Resolved relative to this file rather than through pkg_resources, which is slow to import
+_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def _data_signature(folder, name):
+    """Return the size and mtime of a packaged template or script."""
+
+    info = os.stat(os.path.join(_DATA_DIR, folder, name))
+    return [info.st_size, info.st_mtime_ns]
+
+
+def _paths_overlap(path1, path2):
+    """Check if two absolute paths are the same or one contains the other."""
+
+    if path1 == path2:
+        return True
+
+    return path1.startswith(path2 + os.sep) or path2.startswith(path1 + os.sep)
+
+
+def _group_subsystems(outputs):
+    """Group subsystems so that no two groups write an overlapping path.
+
+    Args:
+        outputs (list of set): The declared output paths of each subsystem,
+            or None if a subsystem could write anything.
+
+    Returns:
+        list of list of int: The indices of the subsystems in each group, in
+        their original order.
+    """
+
+    groups = []
+
+    for index, paths in enumerate(outputs):
+        merged = [index]
+        merged_paths = set() if paths is not None else None
+
+        if paths is not None:
+            merged_paths.update(paths)
+
+        remaining = []
+        for group, group_paths in groups:
+            conflict = paths is None or group_paths is None or any(_paths_overlap(x, y) for x in paths for y in group_paths)
+            if not conflict:
+                remaining.append((group, group_paths))
+                continue
+
+            merged.extend(group)
+            if merged_paths is not None and group_paths is not None:
+                merged_paths.update(group_paths)
+            else:
+                merged_paths = None
+
+        remaining.append((sorted(merged), merged_paths))
+        groups = remaining
+
+    return sorted(group for group, _paths in groups)
+
+
+def _output_signature(path):
+    """Describe the current state of a file or folder produced by a subsystem."""
+
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+
+    if stat.S_ISDIR(info.st_mode):
+        return "directory"
+
+    return [info.st_size, info.st_mtime_ns, info.st_ino]
+
 
 class Repository(object):
     """High-level representation of an entire repository.
@@ -43,9 +122,13 @@ class Repository(object):
     MULTIPACKAGE_DIR = ".multipackage"
     SETTINGS_VERSION = "0.1"
 
+    MAX_SUBSYSTEM_WORKERS = 4
+    """The maximum number of threads used to update subsystems concurrently."""
+
     SCRIPT_DIR = os.path.join(MULTIPACKAGE_DIR, "scripts")
     SETTINGS_FILE = os.path.join(MULTIPACKAGE_DIR, "settings.json")
     MANIFEST_FILE = os.path.join(MULTIPACKAGE_DIR, "manifest.json")
+    MANIFEST_DB_FILE = os.path.join(MULTIPACKAGE_DIR, "manifest.db")
     COMPONENT_FILE = os.path.join(MULTIPACKAGE_DIR, "components.txt")
 
     COMPONENT_REGEX = r"^(?P<package>[a-zA-Z_0-9]+):\s*(?P<path>[\.a-zA-Z_\-0-9\\/]+)(?P<options>(\s*,\s*[a-zA-Z_0-9_]+\s*=\s*[a-zA-Z_0-9_]+)+)?$"
@@ -75,9 +158,19 @@ class Repository(object):
         self._messages = []
         self._env_variables = {}
         self._original_settings = {}
+        self._settings_dirty = False
+        self._settings_batch_depth = 0
+        self._overlay = None
+        self._overlay_hash_types = {}
+        self._local = threading.local()
+        self._path_locks = {}
+        self._path_locks_lock = threading.Lock()
 
-        template_name = self._try_load()
-        self.manifest = ManifestFile(os.path.join(self.path, self.MANIFEST_FILE), self.path, self)
+        with timed('repo', 'load settings'):
+            template_name = self._try_load()
+
+        self.hash_algorithm = self._get_hash_algorithm()
+        self.manifest = self._create_manifest()
 
         if self.initialized:
             self._try_load_components()
@@ -105,6 +198,43 @@ class Repository(object):
         status = self.manifest.verify_file(os.path.join(self.path, self.SETTINGS_FILE))
         return status != "unchanged"
 
+    def _get_hash_algorithm(self):
+        """Get the hash algorithm that should be used for managed files.
+
+        This is configured using the ``manifest.hash_algorithm`` option in
+        settings.json and defaults to md5.
+        """
+
+        algorithm = self.get_setting('manifest.hash_algorithm', 'md5')
+        if algorithm not in SUPPORTED_HASH_METHODS:
+            self.error(self.SETTINGS_FILE, "Unsupported manifest hash algorithm '%s'" % algorithm,
+                       "Set manifest.hash_algorithm to one of: %s" % ", ".join(SUPPORTED_HASH_METHODS))
+            return 'md5'
+
+        return algorithm
+
+    def _create_manifest(self):
+        """Create the manifest using the configured storage backend.
+
+        This is configured using the ``manifest.backend`` option in
+        settings.json.  The default ``json`` backend stores the manifest in
+        manifest.json while the ``sqlite`` backend stores it in an indexed
+        database that scales to a very large number of managed files.
+        """
+
+        backend = self.get_setting('manifest.backend', 'json')
+        json_path = os.path.join(self.path, self.MANIFEST_FILE)
+
+        if backend == 'sqlite':
+            return SQLiteManifestFile(os.path.join(self.path, self.MANIFEST_DB_FILE), self.path, self,
+                                      hash_method=self.hash_algorithm, legacy_path=json_path)
+
+        if backend != 'json':
+            self.error(self.SETTINGS_FILE, "Unsupported manifest backend '%s'" % backend,
+                       "Set manifest.backend to json or sqlite")
+
+        return ManifestFile(json_path, self.path, self, hash_method=self.hash_algorithm)
+
     def _try_load_components(self):
         """Try to load the list of components from this repository.
 
@@ -442,6 +572,7 @@ class Repository(object):
         self.name = settings.get('name', "Unknown Project")
 
         self.options = settings.get('options', {})
+        self._original_settings = settings
         return settings.get('template', self.DEFAULT_TEMPLATE)
 
     def get_setting(self, name, default=_MISSING):
@@ -493,7 +624,10 @@ class Repository(object):
     def set_setting(self, name, value):
         """Change or set an option in settings.json.
 
-        The change is flushed out to the settings file immediately.
+        The change is flushed out to the settings file immediately unless
+        this call is made inside a :meth:`batch_settings` block, in which
+        case it is flushed once at the end of the block.  Setting an option
+        to the value it already has does not touch the settings file.
 
         Args:
             name (str): The name of the setting you want to set or change.
@@ -506,6 +640,7 @@ class Repository(object):
             names = [name]
 
         curr = self.options
+        changed = False
 
         for i, component in enumerate(names[:-1]):
             if not isinstance(curr, dict):
@@ -514,6 +649,7 @@ class Repository(object):
 
             if component not in curr:
                 curr[component] = {}
+                changed = True
 
             curr = curr[component]
 
@@ -522,13 +658,44 @@ class Repository(object):
             subname = ".".join(names[:-1])
             raise InvalidSettingError(name, "Cannot set key %s because subkey %s exists and is not a dictionary" % (name, subname))
 
+        if not changed and curr.get(component, _MISSING) == value:
+            return
+
         curr[component] = value
+        self._settings_dirty = True
+
+        if self._settings_batch_depth == 0:
+            self._flush_settings()
+
+    @contextmanager
+    def batch_settings(self):
+        """Group multiple calls to set_setting into a single write.
+
+        All settings changed inside the ``with`` block are written to
+        settings.json once when the outermost block exits.  Nothing is
+        written if no setting actually changed.
+        """
+
+        self._settings_batch_depth += 1
+
+        try:
+            yield self
+        finally:
+            self._settings_batch_depth -= 1
+
+            if self._settings_batch_depth == 0:
+                self._flush_settings()
+
+    def _flush_settings(self):
+        if not self._settings_dirty:
+            return
 
         out_path = os.path.join(self.path, self.SETTINGS_FILE)
 
         self._original_settings['options'] = self.options
         atomic_json(out_path, self._original_settings)
         self.manifest.update_file(out_path, hash_type="json")
+        self._settings_dirty = False
 
     def initialize(self, clean=False, platforms=('macos', 'windows', 'linux'), python_versions=('2.7', '3.6')):
         """Initialize or reinitialize this repository."""
@@ -564,9 +731,14 @@ class Repository(object):
         self.ensure_directory(os.path.join(self.path, self.MULTIPACKAGE_DIR))
         self.ensure_directory(os.path.join(self.path, self.SCRIPT_DIR))
 
+        # Keep the manifest storage options so the existing manifest stays in use
+        manifest_options = self.get_setting('manifest', None)
+        if manifest_options is not None:
+            settings['options']['manifest'] = manifest_options
+
         atomic_json(os.path.join(self.path, self.SETTINGS_FILE), settings)
-        atomic_json(os.path.join(self.path, self.MANIFEST_FILE), {})
 
+        self.manifest.clear()
         self.manifest.update_file(os.path.join(self.path, self.SETTINGS_FILE), hash_type="json")
 
         # Make sure we start off with a blank components file if it doesn't exist already
@@ -584,7 +756,8 @@ class Repository(object):
         This method is idempotent. It will only add a line to the file if it
         does not already exist.
 
-        The lines are automatically saved to disk.
+        The lines are automatically saved to disk, or when the current
+        transaction is committed if called inside :meth:`transaction`.
 
         Args:
             relative_path (str): The relative path to the file that we want to
@@ -610,10 +783,16 @@ class Repository(object):
         """
 
         path = os.path.join(self.path, relative_path)
-        section = ManagedFileSection(path, delimiter_start=delimiter_start, delimiter_end=delimiter_end)
-        section.ensure_lines(lines, match, present=present, multi=multi)
 
-        self.manifest.update_file(path, hash_type="section")
+        with timed('ensure', 'ensure_lines %s' % relative_path), self.transaction() as overlay, self._path_lock(path):
+            data = overlay.read(path)
+            if data is not None:
+                data = data.decode('utf-8')
+
+            section = ManagedFileSection(path, delimiter_start=delimiter_start, delimiter_end=delimiter_end,
+                                         method=self.hash_algorithm, data=data)
+            data = section.ensure_lines(lines, match, present=present, multi=multi, save=False)
+            self._stage_file(path, data, hash_type="section")
 
     def ensure_directory(self, relative_path, gitkeep=False):
         """Ensure that a given directory exists.
@@ -626,23 +805,25 @@ class Repository(object):
         """
 
         path = os.path.join(self.path, relative_path)
-        if os.path.exists(path) and not os.path.isdir(path):
-            raise UsageError("Cannot create directory, a file is in its place: %s" % relative_path, "Remove or rename the file to make space for the directory")
 
-        if not os.path.exists(path):
-            os.mkdir(path)
+        with timed('ensure', 'ensure_directory %s' % relative_path), self.transaction() as overlay, self._path_lock(path):
+            if overlay.exists(path) and not overlay.isdir(path):
+                raise UsageError("Cannot create directory, a file is in its place: %s" % relative_path, "Remove or rename the file to make space for the directory")
 
-        if gitkeep:
-            gitkeep_path = os.path.join(path, ".gitkeep")
-            if not os.path.exists(gitkeep_path):
-                with open(gitkeep_path, "wb"):
-                    pass
+            overlay.makedirs(path)
+            self._record_output(path)
+
+            if gitkeep:
+                gitkeep_path = os.path.join(path, ".gitkeep")
+                if not overlay.exists(gitkeep_path):
+                    overlay.write(gitkeep_path, b'')
 
     def ensure_script(self, relative_path, source, present=True, overwrite=True):
         """Ensure that a script file is copied.
 
         This function will copy or remove the given script file. All script
-        files come from the multipackage/data/scripts folder.
+        files come from the multipackage/data/scripts folder.  An existing
+        file is only rewritten if its contents differ from the script.
 
         Args:
             relative_path (str): The relative path to the file that we want to
@@ -656,30 +837,29 @@ class Repository(object):
                 subsequently overwriting them.
         """
 
-        from pkg_resources import resource_filename, Requirement
-
         path = os.path.join(self.path, relative_path)
 
-        if present is False:
-            self.manifest.remove_file(path, force=True)
-            if os.path.exists(path):
-                os.remove(path)
-
-            return
-
-        if overwrite is False and os.path.exists(path):
-            return
+        with timed('ensure', 'ensure_script %s' % relative_path), self.transaction() as overlay, self._path_lock(path):
+            if present is False:
+                self._stage_file(path, None)
+                return
 
-        source_path = os.path.join(resource_filename(Requirement.parse("multipackage"), "multipackage/data/scripts"), source)
-        shutil.copyfile(source_path, path)
+            # Still an output so that deleting the file reruns the subsystem
+            if overwrite is False and overlay.exists(path):
+                self._record_output(path)
+                return
 
-        self.manifest.update_file(path)
+            source_path = os.path.join(_DATA_DIR, 'scripts', source)
+            with open(source_path, "rb") as infile:
+                self._stage_file(path, infile.read())
 
     def ensure_template(self, relative_path, template, variables=None, present=True, overwrite=True, raw=False, filters=None):
         """Ensure that the contents of a given file match a template.
 
         This function will render the given template shipped with the
-        multipackage package.
+        multipackage package.  The template is streamed into a buffer and
+        hashed in the same pass, and an existing file is only rewritten if its
+        contents differ.
 
         Args:
             relative_path (str): The relative path to the file that we want to
@@ -702,33 +882,151 @@ class Repository(object):
 
         path = os.path.join(self.path, relative_path)
 
-        if present is False:
-            self.manifest.remove_file(path, force=True)
-            if os.path.exists(path):
-                os.remove(path)
+        with timed('ensure', 'ensure_template %s' % relative_path), self.transaction() as overlay, self._path_lock(path):
+            if present is False:
+                self._stage_file(path, None)
+                return
 
-            return
+            # Still an output so that deleting the file reruns the subsystem
+            if overwrite is False and overlay.exists(path):
+                self._record_output(path)
+                return
+
+            if raw:
+                source_path = os.path.join(_DATA_DIR, 'templates', template)
+                with open(source_path, "rb") as infile:
+                    data = infile.read()
+            else:
+                if variables is None:
+                    variables = {}
+
+                # Hash while rendering so the manifest never rereads the file
+                hasher = LineHasher(self.manifest.hash_method)
+                buffer = io.BytesIO()
+                stream_template(template, variables, buffer, filters=filters, hasher=hasher)
+
+                self._stage_file(path, buffer.getvalue(), known_hash=hasher.hexdigest())
+                return
+
+            self._stage_file(path, data)
+
+    @contextmanager
+    def transaction(self, dry_run=False):
+        """Buffer all changes to managed files and write them at once.
+
+        Inside the ``with`` block, ensure_lines, ensure_template and
+        ensure_script only record their changes in memory, so repeated edits
+        of the same file are coalesced.  When the outermost block exits, each
+        changed file is written once and then hashed once into the manifest.
+        Files whose contents did not change are not written at all.
+
+        If an exception is raised inside the block, no files are modified.
+        Nested calls join the transaction that is already open.  A dry run
+        cannot be nested inside another transaction since its changes could
+        not be kept apart from the changes that will be committed.
+
+        Args:
+            dry_run (bool): Never commit the changes, so they can only be
+                inspected through the yielded FileOverlay.
+
+        Yields:
+            FileOverlay: The pending file changes.
+        """
 
-        if overwrite is False and os.path.exists(path):
+        if self._overlay is not None:
+            if dry_run:
+                raise InternalError("A dry run transaction cannot be nested inside another transaction")
+
+            yield self._overlay
             return
 
-        if raw:
-            from pkg_resources import resource_filename, Requirement
-            source_path = os.path.join(resource_filename(Requirement.parse("multipackage"), "multipackage/data/templates"), template)
-            shutil.copyfile(source_path, path)
+        self._overlay = FileOverlay()
+        self._overlay_hash_types = {}
+
+        try:
+            yield self._overlay
+
+            if not dry_run:
+                self._commit_overlay()
+        finally:
+            self._overlay = None
+            self._overlay_hash_types = {}
+
+    def _stage_file(self, path, data, hash_type="line", known_hash=None):
+        """Record a pending write, or a removal if data is None.
+
+        known_hash is the hash of data if it was already calculated, so that
+        it does not need to be hashed again when the change is committed.
+        """
+
+        path = os.path.abspath(path)
+
+        if data is None:
+            self._overlay.remove(path)
+            hash_type = None
         else:
-            if variables is None:
-                variables = {}
+            self._overlay.write(path, data)
 
-            render_template(template, variables, out_path=path, filters=filters)
+        self._overlay_hash_types[path] = (hash_type, known_hash)
+        self._record_output(path)
+
+    def _record_output(self, path):
+        """Remember a path produced by the subsystem updating in this thread."""
+
+        outputs = getattr(self._local, 'output_paths', None)
+        if outputs is not None:
+            outputs.add(os.path.abspath(path))
+
+    @contextmanager
+    def _path_lock(self, path):
+        """Serialize changes to a single path made by concurrent subsystems."""
+
+        path = os.path.abspath(path)
+
+        with self._path_locks_lock:
+            lock = self._path_locks.setdefault(path, threading.RLock())
+
+        with lock:
+            yield
+
+    def _commit_overlay(self):
+        # Labelled with the staged paths, counting changes would read every file twice
+        with timed('write', 'commit %d staged files' % len(self._overlay.paths)):
+            self._overlay.commit()
+
+        jobs = []
+        for path, (hash_type, known_hash) in viewitems(self._overlay_hash_types):
+            if hash_type is None:
+                self.manifest.remove_file(path, force=True)
+            else:
+                jobs.append(HashJob(path, hash_type, known_hash))
 
-        self.manifest.update_file(path)
+        self.manifest.update_files(jobs)
 
-    def update(self):
+    def update(self, dry_run=False, force=False):
         """Update all of the managed files in this multipackage installation.
 
         This method delegates to all of the enabled multipackage subsystems to
-        actually update each subcomponent.
+        actually update each subcomponent.  All subsystems run inside a single
+        :meth:`transaction` so each managed file is written at most once and
+        nothing is written if any subsystem fails.
+
+        Subsystems that declare their inputs with an ``inputs(options)``
+        method are skipped if neither their inputs nor any of the files they
+        produced have changed since their last update, see
+        :meth:`_subsystem_unchanged`.
+
+        Args:
+            dry_run (bool): Only calculate the changes that an update would
+                make without modifying anything on disk, including the
+                manifest.
+            force (bool): Update every subsystem even if it appears to be up
+                to date.
+
+        Returns:
+            FileOverlay or list of str: If dry_run is True, the changes that
+            would have been made, otherwise the class names of the subsystems
+            that were updated.
         """
 
         if not self.initialized:
@@ -739,11 +1037,159 @@ class Repository(object):
             raise UsageError("Correct repository errors before updating",
                              "multipackage info")
 
+        if dry_run:
+            with self.transaction(dry_run=True) as overlay:
+                self._update_subsystems(force)
+
+            return overlay
+
         try:
-            for subsystem in self.subsystems:
-                subsystem.update(self.options)
+            with self.transaction():
+                updated = self._update_subsystems(force)
 
-            self.manifest.update_file(os.path.join(self.path, self.SETTINGS_FILE), hash_type='json')
-            self.manifest.update_file(os.path.join(self.path, self.COMPONENT_FILE))
+            for name, inputs_hash, outputs in updated:
+                self._store_fingerprint(name, inputs_hash, outputs)
+
+            self.manifest.update_files([HashJob(os.path.join(self.path, self.SETTINGS_FILE), 'json'),
+                                        HashJob(os.path.join(self.path, self.COMPONENT_FILE), 'line')])
+            self.manifest.migrate_hashes()
         finally:
             self.manifest.save()
+
+        return [name for name, _inputs_hash, _outputs in updated]
+
+    def _update_subsystems(self, force):
+        """Update each subsystem that is out of date.
+
+        Subsystems that declare the paths they write with an
+        ``outputs(options)`` method are split into groups that share no
+        paths.  Each group runs in its own thread, with the subsystems inside
+        a group running in order, so a slow subsystem, e.g. one waiting on
+        the network, does not hold up the others.  Subsystems that do not
+        declare their outputs are placed in a single group with everything
+        else.  Changes to each individual path are additionally serialized by
+        :meth:`_path_lock`.
+
+        Returns:
+            list of (str, str, set): The name, inputs hash and output paths of
+            each subsystem that was updated, in the order of self.subsystems.
+        """
+
+        pending = []
+
+        for subsystem in self.subsystems:
+            name = type(subsystem).__name__
+            inputs_hash = self._subsystem_inputs_hash(subsystem)
+
+            if not force and self._subsystem_unchanged(name, inputs_hash):
+                self._logger.debug("Skipping subsystem %s, inputs and outputs are unchanged", name)
+                continue
+
+            pending.append((subsystem, name, inputs_hash))
+
+        groups = _group_subsystems([self._declared_outputs(subsystem) for subsystem, _name, _inputs in pending])
+        results = {}
+
+        def _run_group(group):
+            for index in group:
+                subsystem, name, inputs_hash = pending[index]
+                results[index] = (name, inputs_hash, self._run_subsystem(subsystem, name))
+
+        if len(groups) < 2:
+            for group in groups:
+                _run_group(group)
+        else:
+            workers = min(self.MAX_SUBSYSTEM_WORKERS, len(groups))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_run_group, group) for group in groups]
+
+            # Only raise once every group has finished so no thread is still
+            # modifying the overlay when the transaction is abandoned
+            for future in futures:
+                future.result()
+
+        return [results[index] for index in sorted(results)]
+
+    def _declared_outputs(self, subsystem):
+        """Get the absolute paths a subsystem declares it writes, None if unknown."""
+
+        get_outputs = getattr(subsystem, 'outputs', None)
+        if get_outputs is None:
+            return None
+
+        return set(os.path.abspath(os.path.join(self.path, x)) for x in get_outputs(self.options))
+
+    def _run_subsystem(self, subsystem, name):
+        """Update a single subsystem and return the paths it produced."""
+
+        self._local.output_paths = set()
+        try:
+            with timed('subsystem', name):
+                subsystem.update(self.options)
+            outputs = self._local.output_paths
+        finally:
+            self._local.output_paths = None
+
+        declared = self._declared_outputs(subsystem)
+        if declared is not None:
+            undeclared = [x for x in outputs if not any(_paths_overlap(x, y) for y in declared)]
+            if len(undeclared) > 0:
+                self._logger.warning("Subsystem %s wrote undeclared paths: %s", name, ", ".join(sorted(undeclared)))
+
+        return outputs
+
+    def _subsystem_inputs_hash(self, subsystem):
+        """Hash everything that a subsystem's update depends on.
+
+        Subsystems describe their inputs by returning a json serializable dict
+        from ``inputs(options)``.  The ``templates`` and ``scripts`` keys
+        list the names of the data files that are used, which are replaced
+        with their size and modification time so that a new multipackage
+        version is detected.  The ``secrets`` key lists the environment
+        variables whose presence matters.  Only the presence of secrets is
+        recorded, so a changed secret value requires ``update --force``.
+
+        Returns:
+            str: The hash or None if the subsystem does not declare its inputs.
+        """
+
+        get_inputs = getattr(subsystem, 'inputs', None)
+        if get_inputs is None:
+            return None
+
+        inputs = dict(get_inputs(self.options))
+        inputs['templates'] = {name: _data_signature('templates', name) for name in inputs.get('templates', [])}
+        inputs['scripts'] = {name: _data_signature('scripts', name) for name in inputs.get('scripts', [])}
+        inputs['secrets'] = {name: name in os.environ for name in inputs.get('secrets', [])}
+        inputs['repo'] = [self.name, self.author, self.hash_algorithm]
+
+        return dict_hash(inputs, self.hash_algorithm)
+
+    def _subsystem_unchanged(self, name, inputs_hash):
+        """Check if a subsystem's inputs and outputs match its fingerprint.
+
+        Outputs are compared using only their stat information so checking
+        an unchanged subsystem does not read any files.
+        """
+
+        fingerprint = self.manifest.get_fingerprint(name)
+        if inputs_hash is None or fingerprint is None or fingerprint.get('inputs') != inputs_hash:
+            return False
+
+        for relative_path, signature in viewitems(fingerprint.get('outputs', {})):
+            if _output_signature(os.path.join(self.path, relative_path)) != signature:
+                return False
+
+        return True
+
+    def _store_fingerprint(self, name, inputs_hash, outputs):
+        if inputs_hash is None:
+            self.manifest.set_fingerprint(name, None)
+            return
+
+        signatures = {}
+        for path in outputs:
+            relative_path = os.path.relpath(path, self.path).replace('\\', '/')
+            signatures[relative_path] = _output_signature(path)
+
+        self.manifest.set_fingerprint(name, {'inputs': inputs_hash, 'outputs': signatures})
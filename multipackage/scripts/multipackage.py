@@ -4,11 +4,11 @@ from __future__ import unicode_literals, absolute_import, print_function
 import argparse
 import sys
 import os
+import json
 import logging
 from multipackage import Repository
-from multipackage.external import TravisCI
 from multipackage.exceptions import InvalidEnvironmentError, UsageError
-from multipackage.utilities import GITRepository, render_template
+from multipackage.utilities import GITRepository, render_template, start_profiling, stop_profiling, timed
 
 
 DESCRIPTION = \
@@ -29,7 +29,11 @@ $ multipackage init [path to repo, default cwd]
 $ multipackage update [path to repo, default cwd]
 
     Update the build and release scripts in the given repository to the
-    latest version included with this multipackage program.
+    latest version included with this multipackage program.  Pass --dry-run
+    to print a diff of the changes without modifying anything.  The exit code
+    is nonzero if any managed file is out of date.  Parts of the repository
+    whose settings and files have not changed are skipped unless --force is
+    passed.
 
 $ multipackage doctor [path to repo, default cwd]
 
@@ -45,6 +49,24 @@ $ multipackage info [path to repo, default cwd]
     This will also verify that all of the multipackage build/release scripts
     in the given repository are correctly installed and check for common
     errors.
+
+$ multipackage watch [path to repo, default cwd]
+
+    Keep running and update the managed files in the repository whenever
+    its settings, components or managed files change.  Only the parts of
+    the repository affected by a change are updated.  Stop with Ctrl-C.
+
+$ multipackage update --all <root>
+$ multipackage info --all <root>
+
+    Run update or info on every initialized repository found below root,
+    in parallel worker processes, and print a single JSON report of the
+    results.  Use -j to set the number of worker processes.
+
+Any command can be run with --profile to print how long each stage took,
+e.g. each subsystem, template render, file hash and git or HTTP call.  Add
+--profile-pstats PATH to also save cProfile statistics and --profile-trace
+PATH to save a trace that can be viewed in chrome://tracing.
 """
 
 def _variable_status(value, declarations):
@@ -117,8 +139,20 @@ def init_repo(repo_path, clean):
 
     return 0
 
-def update_repo(repo_path):
-    """Update the installed files in a repository."""
+def update_repo(repo_path, dry_run=False, force=False):
+    """Update the installed files in a repository.
+
+    Args:
+        repo_path (str): The path to the repository.
+        dry_run (bool): Print a unified diff and summary of the changes
+            instead of writing them.
+        force (bool): Update every subsystem even if it appears to be up to
+            date.
+
+    Returns:
+        int: An error code indicating any issues.  In dry run mode, 1 is
+        returned if the update would change any file.
+    """
 
     repo = create_repo(repo_path)
 
@@ -132,15 +166,64 @@ def update_repo(repo_path):
         print("    multipackage info {}".format(repo_path))
         return 2
 
-    repo.update()
-    return 0
+    if not dry_run:
+        repo.update(force=force)
+        return 0
+
+    overlay = repo.update(dry_run=True, force=force)
+    return print_changes(overlay, repo.path)
+
+
+def print_changes(overlay, base_path):
+    """Print a unified diff and summary of pending changes.
+
+    Args:
+        overlay (FileOverlay): The pending changes.
+        base_path (str): The folder that paths should be printed relative to.
+
+    Returns:
+        int: 1 if there are any changes, otherwise 0.
+    """
+
+    changes = overlay.changes()
+    directories = overlay.directories
+
+    if len(changes) == 0 and len(directories) == 0:
+        print("STATUS: All managed files are up to date.")
+        return 0
 
+    sys.stdout.write(overlay.diff(base_path))
 
-def info_repo(repo_path):
+    summary = []
+    for path in directories:
+        summary.append(("created", os.path.relpath(path, base_path) + os.sep))
+
+    for path, data in changes:
+        if data is None:
+            kind = "removed"
+        elif os.path.exists(path):
+            kind = "modified"
+        else:
+            kind = "created"
+
+        summary.append((kind, os.path.relpath(path, base_path)))
+
+    counts = {kind: len([x for x in summary if x[0] == kind]) for kind in ("created", "modified", "removed")}
+
+    print("\nSUMMARY: %d created, %d modified, %d removed" % (counts['created'], counts['modified'], counts['removed']))
+    for kind, path in summary:
+        print("  %-9s %s" % (kind, path))
+
+    return 1
+
+
+def info_repo(repo_path, paranoid=False):
     """Get info on the given repository.
 
     Args:
         repo_path (str): The path to the repository.
+        paranoid (bool): Rehash every managed file rather than trusting
+            unchanged file stat information.
 
     Returns:
         int: An error code indicating any issues.
@@ -163,7 +246,7 @@ def info_repo(repo_path):
         print("Set it up with:\n\n\tmultipackage init {}\n".format(repo_path))
         return 1
 
-    repo.manifest.verify_all(report=True)
+    repo.manifest.verify_all(report=True, paranoid=paranoid)
 
     variables = {
         "repo": repo,
@@ -179,10 +262,81 @@ def info_repo(repo_path):
     return 0
 
 
+def watch_repo(repo_path, polling=False, interval=0.25):
+    """Update a repository every time that it changes, until interrupted.
+
+    Args:
+        repo_path (str): The path to the repository.
+        polling (bool): Poll for changes instead of using inotify.
+        interval (float): How often to poll for changes in seconds.
+
+    Returns:
+        int: An error code indicating any issues.
+    """
+
+    from multipackage.watch import RepositoryWatcher
+
+    if repo_path is None:
+        repo_path = os.getcwd()
+
+    watcher = RepositoryWatcher(repo_path, polling=polling, interval=interval)
+
+    try:
+        _print_updated(watcher.apply())
+        print("Watching %s for changes, press Ctrl-C to stop" % watcher.path)
+
+        while True:
+            updated = watcher.poll()
+            if updated is not None:
+                _print_updated(updated)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    return 0
+
+
+def _print_updated(updated):
+    if len(updated) == 0:
+        print("STATUS: All managed files are up to date.")
+    else:
+        print("UPDATED: %s" % ", ".join(updated))
+
+    sys.stdout.flush()
+
+
+def fleet_repos(root, action, force=False, dry_run=False, paranoid=False, jobs=None):
+    """Run an action on every repository below root and print a JSON report.
+
+    Args:
+        root (str): The folder to search for initialized repositories.
+        action (str): Either 'info' or 'update'.
+        force (bool): Update every subsystem even if it appears to be up to
+            date.
+        dry_run (bool): Only report which files update would change.
+        paranoid (bool): Rehash all managed files when checking them.
+        jobs (int): The number of worker processes to use.
+
+    Returns:
+        int: The largest error code of any repository.
+    """
+
+    from multipackage.fleet import run_fleet
+
+    report = run_fleet(root, action, force=force, dry_run=dry_run, paranoid=paranoid, jobs=jobs)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    return report['exit_code']
+
+
 def build_parser():
     """Build the argument parser."""
     parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-v', '--verbose', action="count", default=0, help="Increase logging level (goes error, warn, info, debug)")
+    parser.add_argument('--profile', action="store_true", help="Print the time spent in each stage of the command to stderr")
+    parser.add_argument('--profile-pstats', metavar="PATH", help="Also run cProfile and save its statistics to PATH (implies --profile)")
+    parser.add_argument('--profile-trace', metavar="PATH", help="Save a Chrome trace-event JSON file to PATH (implies --profile)")
     subparser = parser.add_subparsers(title="Supported Subcommands", dest='action')
 
     init_parser = subparser.add_parser('init', description="Initialize or forcibly clean and reinitialize a repository.",
@@ -196,12 +350,25 @@ def build_parser():
 
     info_parser = subparser.add_parser('info', description="Get info on the given repository and verify it is correctly installed",
                                        help="get info and any errors with a repository")
+    info_parser.add_argument('--paranoid', action="store_true", help="Rehash all managed files even if they appear unchanged")
+    info_parser.add_argument('--all', metavar="ROOT", help="Check every initialized repository below ROOT and print a JSON report")
+    info_parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes used with --all, defaults to the number of CPUs")
     info_parser.add_argument('repo', nargs='?', help="Optional path to repository, defaults to cwd")
 
     update_parser = subparser.add_parser('update', description="Update all managed files to their latest versions",
                                          help="update all managed files to their latest versions")
+    update_parser.add_argument('--dry-run', action="store_true", help="Print a diff of the changes without writing anything")
+    update_parser.add_argument('-f', '--force', action="store_true", help="Update all managed files even if they appear up to date")
+    update_parser.add_argument('--all', metavar="ROOT", help="Update every initialized repository below ROOT and print a JSON report")
+    update_parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes used with --all, defaults to the number of CPUs")
     update_parser.add_argument('repo', nargs='?', help="Optional path to repository, defaults to cwd")
 
+    watch_parser = subparser.add_parser('watch', description="Update all managed files whenever the repository changes",
+                                        help="keep managed files up to date as the repository changes")
+    watch_parser.add_argument('--poll', action="store_true", help="Poll for changes instead of using inotify")
+    watch_parser.add_argument('--interval', type=float, default=0.25, help="Seconds between checks when polling, default 0.25")
+    watch_parser.add_argument('repo', nargs='?', help="Optional path to repository, defaults to cwd")
+
     return parser
 
 
@@ -259,28 +426,40 @@ def print_usage_error(err):
         print("Suggestion: %s" % err.suggestion)
 
 
-def main(argv=None):
-    """Main entry point for multipackage console script."""
+def save_profile(profiler, args):
+    """Print a profile summary and save any requested profile files."""
 
-    if argv is None:
-        argv = sys.argv[1:]
+    sys.stderr.write(profiler.format_summary())
 
-    parser = build_parser()
+    if args.profile_pstats is not None:
+        profiler.save_pstats(args.profile_pstats)
+        sys.stderr.write("Saved cProfile statistics to %s\n" % args.profile_pstats)
 
-    args = parser.parse_args(argv)
-    setup_logging(args)
+    if args.profile_trace is not None:
+        profiler.save_trace(args.profile_trace)
+        sys.stderr.write("Saved Chrome trace to %s\n" % args.profile_trace)
+
+
+def run_command(args):
+    """Run the command selected on the command line."""
 
     retval = 0
 
     try:
-        if args.action == 'doctor':
+        if args.action in ('info', 'update') and args.all is not None:
+            retval = fleet_repos(args.all, args.action, force=getattr(args, 'force', False),
+                                 dry_run=getattr(args, 'dry_run', False), paranoid=getattr(args, 'paranoid', False),
+                                 jobs=args.jobs)
+        elif args.action == 'doctor':
             retval = doctor_repo(args.repo)
         elif args.action == 'info':
-            retval = info_repo(args.repo)
+            retval = info_repo(args.repo, args.paranoid)
         elif args.action == "init":
             retval = init_repo(args.repo, args.force)
         elif args.action == "update":
-            retval = update_repo(args.repo)
+            retval = update_repo(args.repo, args.dry_run, args.force)
+        elif args.action == "watch":
+            retval = watch_repo(args.repo, args.poll, args.interval)
         else:
             print("ERROR: Command Not Supported Yet")
             retval = 1
@@ -295,3 +474,28 @@ def main(argv=None):
 
     return retval
 
+
+def main(argv=None):
+    """Main entry point for multipackage console script."""
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = build_parser()
+
+    args = parser.parse_args(argv)
+    setup_logging(args)
+
+    profiler = None
+    if args.profile or args.profile_pstats is not None or args.profile_trace is not None:
+        profiler = start_profiling(use_cprofile=args.profile_pstats is not None)
+
+    try:
+        with timed('command', str(args.action)):
+            retval = run_command(args)
+    finally:
+        if profiler is not None:
+            stop_profiling()
+            save_profile(profiler, args)
+
+    return retval
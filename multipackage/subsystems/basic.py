@@ -24,6 +24,27 @@ class BasicPythonSupport(object):
                              'URL of a custom PyPI index that we should release to',
                              context="deploy")
 
+    def inputs(self, options):
+        """Describe everything that update() depends on."""
+
+        return {
+            'options': options,
+            'components': self._repo.components,
+            'templates': ["editorconfig", "components.txt", "release_by_name.py.tpl", "test_by_name.py.tpl",
+                          "components.py.tpl", "tag_release.py.tpl"],
+            'scripts': ["shared_errors.py", "release_notes.py", "release_component.py"]
+        }
+
+    def outputs(self, options):
+        """List the paths that update() writes."""
+
+        scripts = ["release_by_name.py", "test_by_name.py", "components.py", "tag_release.py",
+                   "shared_errors.py", "release_notes.py", "release_component.py"]
+
+        return [".gitignore", ".editorconfig", "requirements_build.txt",
+                os.path.join(self._repo.MULTIPACKAGE_DIR, "components.txt")] + \
+               [os.path.join(self._repo.SCRIPT_DIR, x) for x in scripts]
+
     def update(self, options):
         """Update the basic subsystem."""
 
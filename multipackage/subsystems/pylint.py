@@ -11,6 +11,19 @@ class PylintLinter(object):
         self._pylintrc_template = pylintrc_template
         self._logger = logging.getLogger(__name__)
 
+    def inputs(self, options):
+        """Describe everything that update() depends on."""
+
+        return {
+            'options': options.get('linting', {}),
+            'templates': [self._pylintrc_template]
+        }
+
+    def outputs(self, options):
+        """List the paths that update() writes."""
+
+        return ["requirements_build.txt", ".pylintrc"]
+
     def update(self, options):
         """Update the linting subsystem."""
 
@@ -37,13 +37,34 @@ class SphinxDocumentation(object):
             desired_components = set(desired_components)
         self._components = desired_components
 
+    def inputs(self, options):
+        """Describe everything that update() depends on."""
+
+        return {
+            'options': options,
+            'components': {key: value for key, value in self._repo.components.items() if self._components is None or key in self._components},
+            'packages': [self._desired_packages, self._toplevel_packages, self._namespace_packages],
+            'templates': ["module.rst", "package.rst", "conf.py.tpl", "index.rst.tpl", "api.rst.tpl",
+                          "release.rst.tpl", "build_documentation.py.tpl"],
+            'scripts': ["generate_api.py", "better_apidocs.py"]
+        }
+
+    def outputs(self, options):
+        """List the paths that update() writes."""
+
+        return ["requirements_doc.txt", ".gitignore", "doc", "built_docs",
+                os.path.join(self._repo.SCRIPT_DIR, "generate_api.py"),
+                os.path.join(self._repo.SCRIPT_DIR, "better_apidocs.py"),
+                os.path.join(self._repo.SCRIPT_DIR, "build_documentation.py")]
+
     def update(self, options):
         """Update the documentation subsystem."""
 
         # Make sure we pin all of our versions
         self._repo.ensure_lines("requirements_doc.txt",
                                 ["sphinx ~= 1.8", "jinja2 ~= 2.10", "sphinx_rtd_theme ~= 0.4", "sphinxcontrib-programoutput ~= 0.11", "recommonmark ~= 0.4"],
-                                [r"^sphinx", r"^jinja2", r"^sphinx_rtd_theme", r"^sphinxcontrib-programoutput", r"^recommonmark"],
+                                [r"^sphinx(\s|[~=<>!]|$)", r"^jinja2", r"^sphinx_rtd_theme", r"^sphinxcontrib-programoutput",
+                                 r"^recommonmark"],
                                 multi=True)
 
         self._repo.ensure_lines(".gitignore", ['.tmp_docs', 'built_docs'])
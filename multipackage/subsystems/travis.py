@@ -2,7 +2,6 @@
 
 import logging
 import os
-from ..external import TravisCI
 from ..utilities import GITRepository
 
 
@@ -31,9 +30,33 @@ class TravisSubsystem(object):
                              'Slack web hook URL if notifications on project release are desired',
                              context="deploy")
 
+    def inputs(self, options):
+        """Describe everything that update() depends on.
+
+        The encrypted environment section includes every declared secret so
+        the presence of all of them matters.  Secrets are encrypted with the
+        key of the github repository that the origin remote points to.
+        """
+
+        return {
+            'options': options,
+            'components': self._repo.components,
+            'templates': ["travis.yml.tpl"],
+            'secrets': [name for name, _decl, _value in self._repo.iter_secrets()],
+            'github_slug': GITRepository(self._repo.path).github_slug()
+        }
+
+    def outputs(self, options):
+        """List the paths that update() writes."""
+
+        return [".travis.yml"]
+
     def update(self, options):
         """Update the linting subsystem."""
 
+        # requests and pycryptodome are slow to import so only load them when needed
+        from ..external import TravisCI
+
         git = GITRepository(self._repo.path)
         travis = TravisCI()
 
@@ -2,9 +2,10 @@
 
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from .repo_template import RepositoryTemplate
 from .. import subsystems
-from ..utilities import find_toplevel_packages
+from ..utilities import find_toplevel_packages, user_cache_dir, PackageCache, timed
 from ..exceptions import InternalError
 
 
@@ -14,6 +15,9 @@ class PyPIPackageTemplate(RepositoryTemplate):
     INFO_TEMPLATE = "pypi_info_template.tpl"
     DOCTOR_TEMPLATE = "pypi_doctor_template.tpl"
 
+    MAX_SEARCH_WORKERS = 8
+    """The maximum number of threads used to search components for packages."""
+
     def __init__(self):
         super(PyPIPackageTemplate, self).__init__()
         self.namespace_packages = []
@@ -31,7 +35,9 @@ class PyPIPackageTemplate(RepositoryTemplate):
         """
 
         self._verify_options(repo)
-        self._find_packages(repo)
+
+        with timed('packages', 'find packages'):
+            self._find_packages(repo)
 
         repo.add_subsystem(subsystems.BasicPythonSupport(repo))
         repo.add_subsystem(subsystems.PylintLinter(repo))
@@ -50,35 +56,56 @@ class PyPIPackageTemplate(RepositoryTemplate):
                                "Choices are universal, python2 or python3")
 
     def _find_packages(self, repo):
-        self.toplevel_packages = self.find_toplevel_packages(repo.path, repo.components)
+        cache_dir = user_cache_dir()
+        cache = PackageCache(os.path.join(cache_dir, 'packages.json') if cache_dir is not None else None)
+
+        self.toplevel_packages = self.find_toplevel_packages(repo.path, repo.components, cache=cache)
         self.namespace_packages = self.find_namespace_packages(self.toplevel_packages)
 
         if len(self.namespace_packages) == 0:
             self.desired_packages = self.toplevel_packages
         else:
             self._logger.info("Found namespace packages: %s, pruning them", ", ".join(self.namespace_packages))
-            self.desired_packages = self.find_toplevel_packages(repo.path, repo.components, self.namespace_packages)
+            self.desired_packages = self.find_toplevel_packages(repo.path, repo.components, self.namespace_packages,
+                                                                cache=cache)
+
+        try:
+            cache.save()
+        except (IOError, OSError):
+            self._logger.warning("Could not save package discovery cache to %s", cache.path)
 
     @classmethod
-    def find_toplevel_packages(cls, base_path, components, prefixes=None):
-        """Find all top level python packages in each component."""
+    def find_toplevel_packages(cls, base_path, components, prefixes=None, cache=None):
+        """Find all top level python packages in each component.
 
-        packages = {}
+        Components are searched concurrently.  If a PackageCache is passed,
+        components whose directory trees have not changed since they were
+        last searched are not listed again.
+        """
 
-        for key, comp in components.items():
+        def _find(key, comp):
             path = os.path.join(base_path, comp.relative_path)
-            toplevel_packages = find_toplevel_packages(path)
+            toplevel_packages = find_toplevel_packages(path, cache=cache)
 
             if prefixes is not None:
                 if len(toplevel_packages) != 1:
                     raise InternalError("Cannot support multiple packages per component in '%s' if there is a namespace package" % key)
 
                 if toplevel_packages[0] in prefixes:
-                    toplevel_packages = find_toplevel_packages(path, prefix=toplevel_packages[0])
+                    toplevel_packages = find_toplevel_packages(path, prefix=toplevel_packages[0], cache=cache)
+
+            return toplevel_packages
 
-            packages[key] = toplevel_packages
+        keys = list(components)
+        comps = [components[key] for key in keys]
+
+        if len(keys) < 2:
+            results = [_find(key, comp) for key, comp in zip(keys, comps)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(cls.MAX_SEARCH_WORKERS, len(keys))) as executor:
+                results = list(executor.map(_find, keys, comps))
 
-        return packages
+        return dict(zip(keys, results))
 
     @classmethod
     def find_namespace_packages(cls, packages):
@@ -1,12 +1,19 @@
 """Common standalone utility routines."""
 
-from .file_ops import atomic_save, atomic_json
+from .file_ops import atomic_save, atomic_json, file_matches, user_cache_dir
 from .managed_section import ManagedFileSection
-from .obj_hash import line_hash, dict_hash, directory_hash
-from .template import render_template
+from .overlay import FileOverlay
+from .obj_hash import (line_hash, line_hash_file, LineHasher, dict_hash, directory_hash,
+                       DirectoryHashCache, hash_method, SUPPORTED_HASH_METHODS)
+from .template import render_template, stream_template, template_cache_stats, clear_template_cache, warm_template_cache
 from .git import GITRepository
-from .packages import find_toplevel_packages
+from .packages import find_toplevel_packages, PackageCache
+from .profiling import Profiler, timed, start_profiling, stop_profiling
 
-__all__ = ['render_template', 'find_toplevel_packages', 'atomic_save',
-           'atomic_json', 'line_hash', 'dict_hash', 'directory_hash',
-           'ManagedFileSection', 'GITRepository']
+__all__ = ['render_template', 'stream_template', 'template_cache_stats', 'clear_template_cache', 'warm_template_cache',
+           'find_toplevel_packages', 'PackageCache', 'atomic_save', 'user_cache_dir',
+           'atomic_json', 'file_matches', 'line_hash', 'line_hash_file', 'LineHasher',
+           'dict_hash', 'directory_hash', 'DirectoryHashCache', 'hash_method',
+           'SUPPORTED_HASH_METHODS', 'ManagedFileSection', 'FileOverlay',
+           'GITRepository', 'Profiler', 'timed',
+           'start_profiling', 'stop_profiling']
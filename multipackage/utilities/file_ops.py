@@ -37,6 +37,79 @@ def atomic_save(target_path, data, encoding="utf-8"):
     os.rename(new_path, real_path)
 
 
+def file_matches(path, data, encoding="utf-8"):
+    """Check if a file already contains exactly the given data.
+
+    The size of the file is checked first so that files with different
+    lengths are never read.
+
+    Args:
+        path (str): The path to the file to check.
+        data (str or bytes): The expected contents of the file.
+        encoding (str): The encoding used to convert data to bytes if it
+            is a string, defaults to utf-8 if not specified.
+
+    Returns:
+        bool: True if the file exists and its contents are identical.
+    """
+
+    if not isinstance(data, bytes):
+        data = data.encode(encoding)
+
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+
+        with open(path, "rb") as infile:
+            return infile.read() == data
+    except (IOError, OSError):
+        return False
+
+
+def user_cache_dir(*subdirs):
+    """Get a directory for caching data between multipackage invocations.
+
+    The location can be set with the ``MULTIPACKAGE_CACHE_DIR`` environment
+    variable, setting it to an empty string disables caching.  Otherwise
+    ``$XDG_CACHE_HOME/multipackage`` is used, falling back to
+    ``~/.cache/multipackage`` (or ``%LOCALAPPDATA%\\multipackage`` on
+    Windows).
+
+    Args:
+        *subdirs (str): Optional subdirectories inside the cache directory.
+
+    Returns:
+        str: The path to the directory, which is created if needed, or None
+        if caching is disabled or the directory could not be created.
+    """
+
+    base = os.environ.get('MULTIPACKAGE_CACHE_DIR')
+
+    if base is None:
+        root = None
+        if platform.system() == 'Windows':
+            root = os.environ.get('LOCALAPPDATA')
+        else:
+            root = os.environ.get('XDG_CACHE_HOME')
+
+        if not root:
+            root = os.path.join(os.path.expanduser('~'), '.cache')
+
+        base = os.path.join(root, 'multipackage')
+    elif base == '':
+        return None
+
+    path = os.path.join(base, *subdirs)
+
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    except OSError:
+        return None
+
+    return path
+
+
 def atomic_json(target_path, obj):
     """Atomically dump a dict as a json file.
 
@@ -0,0 +1,332 @@
+"""Watch folders for changes using inotify or by polling.
+
+Both watchers observe a set of folders non-recursively and report the paths
+of the entries inside them that were created, modified, moved or removed.
+:class:`InotifyWatcher` uses the Linux inotify API through ctypes, so it
+needs no extra dependencies, and :func:`create_watcher` falls back to
+:class:`PollingWatcher` everywhere else.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (_IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE |
+               _IN_DELETE_SELF | _IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    """Detect changes by comparing the stat information of folder entries.
+
+    Each poll lists every watched folder and compares the size, mtime and
+    inode of its entries to the previous poll.
+
+    Args:
+        folders (list of str): The folders to watch.
+        interval (float): How often to poll while waiting, in seconds.
+    """
+
+    def __init__(self, folders=(), interval=0.25):
+        self.interval = interval
+        self._folders = set()
+        self._snapshot = {}
+
+        self.set_folders(folders)
+
+    @classmethod
+    def _scan(cls, folder):
+        entries = {}
+
+        try:
+            for entry in os.scandir(folder):
+                try:
+                    info = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                entries[entry.path] = (info.st_size, info.st_mtime_ns, info.st_ino)
+        except OSError:
+            return None
+
+        return entries
+
+    def set_folders(self, folders):
+        """Change the set of watched folders.
+
+        Folders that were already watched keep their state so no change is
+        lost.
+
+        Args:
+            folders (list of str): The folders to watch.
+        """
+
+        folders = set(os.path.abspath(x) for x in folders)
+
+        for folder in folders - self._folders:
+            self._snapshot[folder] = self._scan(folder)
+
+        for folder in self._folders - folders:
+            del self._snapshot[folder]
+
+        self._folders = folders
+
+    def reset(self):
+        """Forget all changes made up until now."""
+
+        for folder in self._folders:
+            self._snapshot[folder] = self._scan(folder)
+
+    def _changes(self):
+        changed = set()
+
+        for folder in self._folders:
+            old = self._snapshot[folder]
+            new = self._scan(folder)
+            self._snapshot[folder] = new
+
+            if old == new:
+                continue
+
+            if old is None or new is None:
+                changed.add(folder)
+                continue
+
+            for path in set(old) | set(new):
+                if old.get(path) != new.get(path):
+                    changed.add(path)
+
+        return changed
+
+    def wait(self, timeout=None):
+        """Wait until something changes.
+
+        Args:
+            timeout (float): The maximum time to wait in seconds, or None to
+                wait forever.
+
+        Returns:
+            set of str: The paths that changed, empty if timeout expired.
+        """
+
+        end = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            changed = self._changes()
+            if len(changed) > 0:
+                return changed
+
+            if end is not None and time.monotonic() >= end:
+                return set()
+
+            delay = self.interval
+            if end is not None:
+                delay = max(0, min(delay, end - time.monotonic()))
+
+            time.sleep(delay)
+
+    def close(self):
+        """Release any resources held by the watcher."""
+
+        self._folders = set()
+        self._snapshot = {}
+
+
+class InotifyWatcher(object):
+    """Detect changes with the Linux inotify API.
+
+    Args:
+        folders (list of str): The folders to watch.
+
+    Raises:
+        OSError: inotify is not available on this system or the watch limit
+            has been reached.
+    """
+
+    def __init__(self, folders=()):
+        self._libc = _load_libc()
+
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._watches = {}
+        self._folders = {}
+        self._overflowed = False
+
+        try:
+            self.set_folders(folders)
+        except OSError:
+            self.close()
+            raise
+
+    def set_folders(self, folders):
+        """Change the set of watched folders.
+
+        Folders that no longer exist are silently skipped.
+
+        Args:
+            folders (list of str): The folders to watch.
+        """
+
+        folders = set(os.path.abspath(x) for x in folders)
+
+        for folder in set(self._folders) - folders:
+            self._libc.inotify_rm_watch(self._fd, self._folders.pop(folder))
+
+        for folder in folders - set(self._folders):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), _WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+
+                raise OSError(err, os.strerror(err), folder)
+
+            self._folders[folder] = wd
+
+        self._watches = {wd: folder for folder, wd in self._folders.items()}
+
+    def _read_events(self):
+        changed = set()
+
+        while True:
+            try:
+                data = os.read(self._fd, 64*1024)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & _IN_Q_OVERFLOW:
+                    self._overflowed = True
+                    continue
+
+                folder = self._watches.get(wd)
+                if folder is None:
+                    continue
+
+                # The folder was removed, it is watched again if it is recreated and set_folders is called
+                if mask & _IN_IGNORED:
+                    del self._watches[wd]
+                    self._folders.pop(folder, None)
+                    changed.add(folder)
+                    continue
+
+                if len(name) == 0:
+                    changed.add(folder)
+                else:
+                    changed.add(os.path.join(folder, os.fsdecode(name)))
+
+        return changed
+
+    def reset(self):
+        """Forget all changes made up until now."""
+
+        self._read_events()
+        self._overflowed = False
+
+    def wait(self, timeout=None):
+        """Wait until something changes.
+
+        If the kernel's event queue overflowed, every watched folder is
+        reported as changed.
+
+        Args:
+            timeout (float): The maximum time to wait in seconds, or None to
+                wait forever.
+
+        Returns:
+            set of str: The paths that changed, empty if timeout expired.
+        """
+
+        end = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            remaining = None if end is None else max(0, end - time.monotonic())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+
+            if len(readable) > 0:
+                changed = self._read_events()
+                if self._overflowed:
+                    self._overflowed = False
+                    changed.update(self._folders)
+
+                if len(changed) > 0:
+                    return changed
+
+            if end is not None and time.monotonic() >= end:
+                return set()
+
+    def close(self):
+        """Release any resources held by the watcher."""
+
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+
+        self._fd = None
+        self._folders = {}
+        self._watches = {}
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, "libc does not support inotify")
+
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def create_watcher(folders=(), polling=False, interval=0.25):
+    """Create the best available watcher for a set of folders.
+
+    Args:
+        folders (list of str): The folders to watch.
+        polling (bool): Always poll instead of using inotify.
+        interval (float): How often a polling watcher checks for changes.
+
+    Returns:
+        InotifyWatcher or PollingWatcher: The watcher.
+    """
+
+    if not polling:
+        try:
+            return InotifyWatcher(folders)
+        except OSError:
+            pass
+
+    return PollingWatcher(folders, interval)
@@ -4,6 +4,7 @@ import subprocess
 import os
 import re
 from ..exceptions import UsageError, MissingPackageError
+from .profiling import timed
 
 
 class GITRepository(object):
@@ -24,7 +25,9 @@ class GITRepository(object):
         """Call git status and parse the results."""
 
         try:
-            contents = subprocess.check_output(['git', '-C', self.path, 'status', '--porcelain=v2', '-b'], stderr=subprocess.PIPE)
+            with timed('subprocess', 'git status'):
+                contents = subprocess.check_output(['git', '-C', self.path, 'status', '--porcelain=v2', '-b'],
+                                                   stderr=subprocess.PIPE)
             contents = contents.decode('utf-8')
         except subprocess.CalledProcessError:
             raise UsageError("Not a valid git repository: %s" % self.path, "Make sure the path is correct")
@@ -41,7 +44,8 @@ class GITRepository(object):
             str: The remote URL.
         """
 
-        contents = subprocess.check_output(['git', '-C', self.path, 'remote', 'get-url', name])
+        with timed('subprocess', 'git remote get-url'):
+            contents = subprocess.check_output(['git', '-C', self.path, 'remote', 'get-url', name])
         contents = contents.decode('utf-8')
         return contents.rstrip()
 
@@ -76,7 +80,8 @@ class GITRepository(object):
         """Return the version of git installed."""
 
         try:
-            version_string = subprocess.check_output(['git', '--version'])
+            with timed('subprocess', 'git --version'):
+                version_string = subprocess.check_output(['git', '--version'])
             version_string = version_string.decode('utf-8')
         except subprocess.CalledProcessError:
             raise MissingPackageError("git", "Git must be installed")
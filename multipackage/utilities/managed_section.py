@@ -1,12 +1,15 @@
 """Helper class for managing a block of content inside a text file."""
 
 from __future__ import unicode_literals
+import io
 import os
 import re
+import mmap
+import bisect
 import platform
 from builtins import open
-from .obj_hash import line_hash
-from .file_ops import atomic_save
+from contextlib import contextmanager
+from .obj_hash import line_hash, hash_method
 from ..exceptions import ManualInterventionError, InternalError
 
 
@@ -18,6 +21,12 @@ class ManagedFileSection(object):
     so that modifications can be detected and the fence data
     can be versioned.
 
+    The fence markers are located with a byte search over a memory map of
+    the file and only the fenced block is decoded.  When the section is
+    updated, the new block is spliced between the untouched bytes before
+    and after it, so the cost of managing a section does not depend on the
+    size of the rest of the file.
+
     Args:
         path (str): The path to the file that we want to manage.
             This file does not need to exist and will be created
@@ -30,6 +39,12 @@ class ManagedFileSection(object):
             section block header line.  This defaults to an emptry string but
             can be set to a value if comments need to be explicitly closed
             such as delimiter_start="<!-- ", delimiter_end=" -->".
+        method (str): The hash method used for the section hash when the
+            section is written.  Existing sections are always verified using
+            the method recorded in their header.  Default: md5.
+        data (str): Optional current contents of the file.  If passed, the
+            section is parsed from data instead of reading the file, for
+            example when the file has pending changes that are not yet saved.
     """
 
     SECTION_START = "BEGIN MULTIPACKAGE MANAGED SECTION, HASH="
@@ -39,8 +54,9 @@ class ManagedFileSection(object):
     MANAGE_ERROR = "A file that needs to be managed by multipackage exists and is a directory, not a file"
     MULTIPLE_SECTION_ERROR = "A file that is managed by multipackage has been corrupted"
 
-    def __init__(self, path, delimiter_start='# ', delimiter_end=''):
+    def __init__(self, path, delimiter_start='# ', delimiter_end='', method="md5", data=None):
         self.path = path
+        self.method = method
         self._delimiter_start = delimiter_start
         self._delimiter_end = delimiter_end
         self.line_ending = self._native_line_ending()
@@ -52,11 +68,15 @@ class ManagedFileSection(object):
         self.has_section = False
         self.actual_hash = None
         self.section_contents = None
-        self.other_lines = []
         self.modified = False
-        self._start_line = 0
+        self._data = None
+        self._span = (0, 0)
+        self._file_signature = None
 
-        if os.path.exists(self.path):
+        if data is not None:
+            self.file_exists = True
+            self._load_section(data)
+        elif os.path.exists(self.path):
             self.file_exists = True
             self._load_section()
 
@@ -67,86 +87,125 @@ class ManagedFileSection(object):
 
         return "\n"
 
-    def _infer_line_ending(self, lines):
-        found_counts = {
-            '\n': 0,
-            '\r\n': 0
-        }
+    @property
+    def other_lines(self):
+        """The lines of the file outside of the managed section.
 
-        for line in lines:
-            if len(line) == 0:
-                continue
+        These are decoded from the file on demand since they are not needed
+        to find or update the section.
+        """
 
-            final_char = line[-1]
-            if final_char == '\n' and len(line) >= 2 and line[-2] == '\r':
-                final_char = '\r\n'
+        if not self.file_exists:
+            return []
 
-            if final_char not in found_counts:
-                continue
+        with self._buffer() as buf:
+            start, end = self._span
+            data = (buf[:start] + buf[end:]).decode('utf-8')
 
-            found_counts[final_char] = found_counts[final_char] + 1
+        return [x.rstrip('\r\n') for x in io.StringIO(data, newline='').readlines()]
 
-        if found_counts['\n'] == 0 and found_counts['\r\n'] == 0:
-            return self._native_line_ending()
+    @contextmanager
+    def _buffer(self):
+        """Get the current file contents as a bytes-like object."""
 
-        if found_counts['\r\n'] > found_counts['\n']:
-            return '\r\n'
+        if self._data is not None:
+            yield self._data
+            return
 
-        return '\n'
+        with open(self.path, "rb") as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                yield b''
+                return
 
-    def _load_section(self):
+            buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield buf
+            finally:
+                buf.close()
+
+    def _load_section(self, data=None):
         """Attempt to load a managed file section."""
 
-        with open(self.path, "r", encoding="utf-8", newline='') as infile:
-            lines = infile.readlines()
+        if data is not None:
+            self._data = data.encode('utf-8')
+        else:
+            self._file_signature = _file_signature(self.path)
 
-        self.line_ending = self._infer_line_ending(lines)
+        with self._buffer() as buf:
+            self._locate_section(buf)
 
-        start_line = None
-        section_hash = None
-        end_line = None
-        for i, line in enumerate(lines):
-            if not line.startswith(self._delimiter_start):
-                continue
+    def _find_headers(self, buf, marker):
+        """Find all header lines in buf that contain the given marker.
 
-            line = line.rstrip('\r\n')
-            line = line[len(self._delimiter_start):]
-            if len(self._delimiter_end) > 0 and not line.endswith(self._delimiter_end):
-                continue
-            elif len(self._delimiter_end) > 0:
-                line = line[:-len(self._delimiter_end)]
+        Returns:
+            list of (int, int, bytes): The start offset of each header line,
+            the offset of the next line and the text after the marker.
+        """
 
-            if line.startswith(self.SECTION_START):
-                if start_line is not None:
-                    raise ManualInterventionError(self.MULTIPLE_SECTION_ERROR, self.path)
+        delimiter_start = self._delimiter_start.encode('utf-8')
+        delimiter_end = self._delimiter_end.encode('utf-8')
+        marker = marker.encode('utf-8')
 
-                start_line = i
-                section_hash = line[len(self.SECTION_START):]
-            elif line.startswith(self.SECTION_END):
-                if start_line is None:
-                    raise ManualInterventionError(self.MULTIPLE_SECTION_ERROR, self.path)
+        headers = []
+        pos = buf.find(marker)
+        while pos >= 0:
+            line_start = pos - len(delimiter_start)
+            line_end = _line_end(buf, pos)
 
-                end_line = i
+            if (line_start >= 0 and buf[line_start:pos] == delimiter_start
+                    and (line_start == 0 or buf[line_start - 1:line_start] in (b'\n', b'\r'))
+                    and buf[pos:line_end].endswith(delimiter_end)):
+                suffix = buf[pos + len(marker):line_end - len(delimiter_end)]
+                headers.append((line_start, _next_line(buf, line_end), suffix))
 
-        if start_line is None and end_line is None:
-            self.other_lines = [x.rstrip('\r\n') for x in lines]
+            pos = buf.find(marker, pos + len(marker))
+
+        return headers
+
+    def _locate_section(self, buf):
+        starts = self._find_headers(buf, self.SECTION_START)
+        ends = self._find_headers(buf, self.SECTION_END)
+
+        if len(starts) > 1:
+            raise ManualInterventionError(self.MULTIPLE_SECTION_ERROR, self.path)
+
+        if len(starts) == 0:
+            if len(ends) > 0:
+                raise ManualInterventionError(self.MULTIPLE_SECTION_ERROR, self.path)
+
+            self.line_ending = _detect_line_ending(buf, 0, self._native_line_ending())
+            self._span = (0, 0)
             return
 
-        # Verify the section hash
-        section_lines = [x.rstrip('\r\n') for x in lines[start_line + 1:end_line]]
-        other_lines = lines[:start_line] + lines[end_line + 1:]
-        other_lines = [x.rstrip('\r\n') for x in other_lines]
+        start, section_start, section_hash = starts[0]
+        if len(ends) == 0 or any(x[0] < start for x in ends):
+            raise ManualInterventionError(self.MULTIPLE_SECTION_ERROR, self.path)
+
+        ends = [x for x in ends if x[0] >= section_start]
+        if len(ends) == 0:
+            raise ManualInterventionError(self.MULTIPLE_SECTION_ERROR, self.path)
 
-        actual_hash = line_hash(section_lines)
+        section_end, end, _suffix = ends[-1]
+        section_hash = section_hash.decode('utf-8')
 
+        data = buf[section_start:section_end].decode('utf-8')
+        section_lines = [x.rstrip('\r\n') for x in io.StringIO(data, newline='').readlines()]
+
+        try:
+            section_method = hash_method(section_hash)
+        except ValueError:
+            section_method = self.method
+
+        actual_hash = line_hash(section_lines, section_method)
+
+        self.line_ending = _detect_line_ending(buf, start, self._native_line_ending())
         self.has_section = True
         self.section_contents = section_lines
-        self.other_lines = other_lines
         self.actual_hash = actual_hash
         self.modified = actual_hash != section_hash
-        self._start_line = start_line
+        self._span = (start, end)
 
-    def ensure_lines(self, lines, match=None, present=True, multi=False):
+    def ensure_lines(self, lines, match=None, present=True, multi=False, save=True):
         """Ensure that the given lines are present or absent in this file.
 
         Each line is added independently and no order is assumed. This method
@@ -174,6 +233,11 @@ class ManagedFileSection(object):
             multi (bool): If true, allow for matching and updating multiple lines
                 for each line in ``lines``.  If False, InternalError is raised
                 if there are multiple lines matching a given line.
+            save (bool): Write the updated file to disk.  Default: True.
+
+        Returns:
+            str: The updated contents of the file if save is False, otherwise
+            None.
         """
 
         if match is not None and len(match) != len(lines):
@@ -185,58 +249,108 @@ class ManagedFileSection(object):
         elif not present and self.section_contents is None:
             pass
         else:
-            for i, line in enumerate(lines):
-                line_match = line
-                if match is not None:
-                    line_match = match[i]
-
-                matches = self._find_line(line_match, self.section_contents, regex=match is not None)
-                if len(matches) > 1 and not multi:
-                    match_string = "\n".join(self.section_contents[i] for i in matches)
-                    raise InternalError("Line %s in ManagedFileSection.ensure_lines matches multiple lines in file:\n%s"
-                                        % (line_match, match_string))
-
-                # If not in section add if present is True
-                # If in section and present is True, update contents
-                # If in section, remove if present is False
-                if len(matches) == 0 and present:
-                    self.section_contents.append(line)
-                elif len(matches) != 0:
-                    matches.sort(reverse=True)
-
-                    if present:
-                        for i in matches[:-1]:
-                            del self.section_contents[i]
-
-                        self.section_contents[matches[-1]] = line
-                    else:
-                        for i in matches:
-                            del self.section_contents[i]
-
-        self.update()
+            self.section_contents = self._plan_lines(lines, match, present, multi)
+
+        return self.update(save=save)
+
+    def _plan_lines(self, lines, match, present, multi):
+        """Calculate the new section contents for ensure_lines.
+
+        The result is the same as processing each line in order against the
+        current section contents: a line that is not found is appended, the
+        first match of a line is replaced and any other matches are removed.
+        Since later lines must also be able to match lines added or replaced
+        by earlier ones, the section is modeled as a list of slots that
+        either still hold their original line or hold one of the requested
+        lines.
+
+        Exact lines are looked up in a hash map and each regular expression
+        is compiled only once.  Regular expressions that start with a literal
+        prefix are only evaluated against the lines that share that prefix,
+        which are found by binary search in a sorted copy of the lines.
+        Matches against requested lines only require comparing the requested
+        lines with each other.
+        """
 
-    @classmethod
-    def _find_line(cls, match, lines, regex=False):
-        if regex:
-            compiled = re.compile(match)
-            matcher = lambda x: compiled.match(x) is not None
+        section = self.section_contents
+        patterns = lines if match is None else match
+
+        if match is None:
+            index = {}
+            for i, line in enumerate(section):
+                index.setdefault(line, []).append(i)
+
+            original_matches = [index.get(line, []) for line in lines]
+
+            requested = {}
+            for k, line in enumerate(lines):
+                requested.setdefault(line, []).append(k)
+
+            line_matches = [requested[line] for line in lines]
         else:
-            matcher = lambda x: x == match
+            compiled = {}
+            for pattern in match:
+                if pattern not in compiled:
+                    compiled[pattern] = re.compile(pattern)
+
+            matchers = [compiled[pattern].match for pattern in match]
+            prefixes = [_literal_prefix(pattern) for pattern in match]
+
+            original_matches = [_find_matches(section, matcher, prefix)
+                                for matcher, prefix in zip(matchers, _presorted(section, prefixes))]
+            line_matches = [_find_matches(lines, matcher, prefix)
+                            for matcher, prefix in zip(matchers, _presorted(lines, prefixes))]
+
+        # Each slot holds (False, i) for original line i or (True, k) for lines[k]
+        slots = [(False, i) for i in range(len(section))]
+        alive = [True] * len(section)
+        holding = {}
+
+        def _content(slot):
+            is_requested, index = slots[slot]
+            return lines[index] if is_requested else section[index]
+
+        for j, line in enumerate(lines):
+            matches = [i for i in original_matches[j] if alive[i] and not slots[i][0]]
+            for k in line_matches[j]:
+                matches.extend(holding.get(k, ()))
+
+            matches.sort()
+
+            if len(matches) > 1 and not multi:
+                match_string = "\n".join(_content(i) for i in matches)
+                raise InternalError("Line %s in ManagedFileSection.ensure_lines matches multiple lines in file:\n%s"
+                                    % (patterns[j], match_string))
+
+            if len(matches) == 0 and present:
+                slots.append((True, j))
+                alive.append(True)
+                holding.setdefault(j, set()).add(len(slots) - 1)
+                continue
 
-        found = []
+            to_remove = matches[1:] if present else matches
+            for i in to_remove:
+                alive[i] = False
+                if slots[i][0]:
+                    holding[slots[i][1]].discard(i)
 
-        for i, line in enumerate(lines):
-            if matcher(line):
-                found.append(i)
+            if present:
+                first = matches[0]
+                if slots[first][0]:
+                    holding[slots[first][1]].discard(first)
 
-        return found
+                slots[first] = (True, j)
+                holding.setdefault(j, set()).add(first)
 
-    def update(self, lines=None):
+        return [_content(i) for i in range(len(slots)) if alive[i]]
+
+    def update(self, lines=None, save=True):
         """Update or add a managed section into the file.
 
         This method will add a new managed section into the file or update the
         section that is currently there, replacing its contents with those
-        specified in update.  The resulting file will we written out to disk.
+        specified in update.  The resulting file will we written out to disk
+        unless its contents are already identical.
 
         If the file does not currently exist, it will be created, otherwise
         its contents will be replaced.
@@ -245,6 +359,12 @@ class ManagedFileSection(object):
             lines (list of str): A list of lines to add to the
                 file.  If this is passed as None, then the current value of
                 self.section_contents will be used instead.
+            save (bool): Write the updated file to disk.  If False, the
+                new contents are only returned.  Default: True.
+
+        Returns:
+            str: The updated contents of the file if save is False, otherwise
+            None so that the rest of the file never needs to be decoded.
         """
 
         if lines is None:
@@ -255,19 +375,164 @@ class ManagedFileSection(object):
 
         new_contents = lines
 
-        hash_hex = line_hash(lines)
+        hash_hex = line_hash(lines, self.method)
 
         start_line = self._delimiter_start + self.SECTION_START + hash_hex + self._delimiter_end
         end_line = self._delimiter_start + self.SECTION_END + self._delimiter_end
 
         new_section = [start_line] + lines + [end_line]
 
-        lines = self.other_lines[:self._start_line] + new_section + self.other_lines[self._start_line:]
-
         # Always terminate with a final newline
-        data = self.line_ending.join(lines) + self.line_ending
-        atomic_save(self.path, data)
+        block = (self.line_ending.join(new_section) + self.line_ending).encode('utf-8')
+
+        if self.file_exists and self._data is None and _file_signature(self.path) != self._file_signature:
+            # The file changed since it was loaded so find the section again
+            self._load_section()
+
+        start, end = self._span
+        result = None
+        staged = None
+
+        if not self.file_exists:
+            if save:
+                staged = _write_spliced(self.path, b'', block, (0, 0))
+            else:
+                result = block.decode('utf-8')
+        else:
+            with self._buffer() as buf:
+                if not save or self._data is not None:
+                    result = (buf[:start] + block + buf[end:]).decode('utf-8')
+
+                if save and buf[start:end] != block:
+                    staged = _write_spliced(self.path, buf, block, self._span)
+
+        # The file is only replaced once it is no longer mapped into memory
+        if staged is not None:
+            os.replace(*staged)
 
         self.section_contents = new_contents
         self.has_section = True
+
+        if self._data is not None:
+            self._data = result.encode('utf-8')
+        elif not save:
+            # Nothing was written so the loaded offsets still describe the file
+            return result
+        else:
+            self._file_signature = _file_signature(self.path)
+
         self.file_exists = True
+        self._span = (start, start + len(block))
+
+        if save:
+            return None
+
+        return result
+
+
+def _line_end(buf, pos):
+    """Find the offset of the line ending after pos, or the end of buf."""
+
+    end = buf.find(b'\n', pos)
+    if end < 0:
+        end = len(buf)
+
+    # Only search for a lone carriage return up to the next newline
+    carriage_return = buf.find(b'\r', pos, end)
+    if carriage_return >= 0:
+        return carriage_return
+
+    return end
+
+
+def _next_line(buf, line_end):
+    """Find the start of the line after a line ending."""
+
+    if buf[line_end:line_end + 2] == b'\r\n':
+        return line_end + 2
+
+    return min(line_end + 1, len(buf))
+
+
+def _detect_line_ending(buf, pos, default):
+    """Determine the line ending used by the line starting at pos."""
+
+    end = buf.find(b'\n', pos)
+    if end < 0:
+        return default
+
+    if end > 0 and buf[end - 1:end] == b'\r':
+        return '\r\n'
+
+    return '\n'
+
+
+def _file_signature(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+
+    return (info.st_size, info.st_mtime_ns)
+
+
+def _write_spliced(path, buf, block, span, chunk_size=1024*1024):
+    """Write buf with the bytes in span replaced by block next to path.
+
+    Returns:
+        (str, str): The path of the new file and the path it should be moved
+        to in order to atomically replace the original file.
+    """
+
+    real_path = os.path.realpath(path)
+    new_path = real_path + '.new'
+    start, end = span
+
+    with open(new_path, "wb") as outfile:
+        for offset in range(0, start, chunk_size):
+            outfile.write(buf[offset:min(offset + chunk_size, start)])
+
+        outfile.write(block)
+
+        for offset in range(end, len(buf), chunk_size):
+            outfile.write(buf[offset:offset + chunk_size])
+
+    return new_path, real_path
+
+
+_LITERAL_PREFIX = re.compile(r"[A-Za-z0-9_\-=~<>!:;,/@'\"% ]*")
+
+
+def _literal_prefix(pattern):
+    """Find a literal string that every match of a regular expression starts with."""
+
+    if '|' in pattern:
+        return ''
+
+    prefix = _LITERAL_PREFIX.match(pattern).group(0)
+    if pattern[len(prefix):len(prefix) + 1] in ('?', '*', '{'):
+        prefix = prefix[:-1]
+
+    return prefix
+
+
+def _presorted(lines, prefixes):
+    """Pair each prefix with a sorted index of lines used to look it up."""
+
+    order = sorted(range(len(lines)), key=lines.__getitem__)
+    keys = [lines[i] for i in order]
+
+    return [(prefix, order, keys) for prefix in prefixes]
+
+
+def _find_matches(lines, matcher, prefix_info):
+    """Find the indices of all lines matched by a compiled regex."""
+
+    prefix, order, keys = prefix_info
+    if prefix == '':
+        return [i for i, line in enumerate(lines) if matcher(line) is not None]
+
+    start = bisect.bisect_left(keys, prefix)
+    end = bisect.bisect_left(keys, prefix + '\U0010ffff', lo=start)
+
+    return sorted(i for i in order[start:end] if matcher(lines[i]) is not None)
@@ -1,10 +1,25 @@
 """Calculate a hex checksum over a list of lines."""
 
 from __future__ import unicode_literals
+from builtins import open
 import hashlib
 import json
 import fnmatch
 import os
+from .file_ops import atomic_json
+
+_HASH_METHODS = {
+    'md5': ('MD5', hashlib.md5),
+    'sha256': ('SHA256', hashlib.sha256)
+}
+
+if hasattr(hashlib, 'blake2b'):
+    _HASH_METHODS['blake2b'] = ('BLAKE2B', hashlib.blake2b)
+
+_HASH_PREFIXES = {prefix: name for name, (prefix, _factory) in _HASH_METHODS.items()}
+
+SUPPORTED_HASH_METHODS = tuple(sorted(_HASH_METHODS))
+"""The names of all hash methods that can be passed as ``method``."""
 
 
 def line_hash(lines, method="md5"):
@@ -15,19 +30,102 @@ def line_hash(lines, method="md5"):
 
     Args:
         lines (list of str): The list of strings to hash
-        method (str): The name of the hash method, currently
-            only md5 is supported.
+        method (str): The name of the hash method, one of
+            SUPPORTED_HASH_METHODS.  Default: md5.
 
     Returns:
         str: The hash digest as a hex string in uppercase.
     """
 
-    if method != 'md5':
-        raise ValueError("Unsupported hash algorithm: %s" % method)
+    data = "\n".join([x.rstrip('\r\n') for x in lines])
+    return _hash_data(data, method)
 
 
-    data = "\n".join([x.rstrip('\r\n') for x in lines])
-    return _md5_hash(data)
+def line_hash_file(path, method="md5", chunk_size=64*1024):
+    r"""Calculate the line hash of a text file without loading it into memory.
+
+    The result is identical to calling :func:`line_hash` on the lines of the
+    file read with universal newline support, i.e. '\r\n', '\r' and '\n' are
+    all treated as line endings, but the file is read in chunks so memory
+    usage does not depend on the size of the file.
+
+    Args:
+        path (str): The path to the utf-8 encoded text file to hash.
+        method (str): The name of the hash method, one of
+            SUPPORTED_HASH_METHODS.  Default: md5.
+        chunk_size (int): The number of characters to read at a time.
+
+    Returns:
+        str: The hash digest as a hex string in uppercase.
+    """
+
+    hasher = LineHasher(method)
+
+    with open(path, "r", encoding="utf-8", newline='') as infile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+class LineHasher(object):
+    r"""Incrementally calculate a :func:`line_hash` over streamed text.
+
+    Text can be passed to :meth:`update` in arbitrarily sized pieces.  Line
+    endings are normalized as they arrive, including a '\r\n' pair that is
+    split across two pieces, and a single trailing line ending is dropped so
+    that the final digest matches what :func:`line_hash` would produce for
+    the same text split into lines.
+
+    Args:
+        method (str): The name of the hash method, one of
+            SUPPORTED_HASH_METHODS.  Default: md5.
+    """
+
+    def __init__(self, method="md5"):
+        self._method = method
+        self._hasher = _new_hasher(method)
+        self._pending_cr = False
+        self._pending_newline = False
+
+    def update(self, text):
+        """Add more text to the hash.
+
+        Args:
+            text (str): The next piece of text.
+        """
+
+        if self._pending_cr and text.startswith('\n'):
+            text = text[1:]
+
+        self._pending_cr = text.endswith('\r')
+
+        if not text:
+            return
+
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+        if self._pending_newline:
+            self._hasher.update(b'\n')
+
+        self._pending_newline = text.endswith('\n')
+        if self._pending_newline:
+            text = text[:-1]
+
+        self._hasher.update(text.encode('utf-8'))
+
+    def hexdigest(self):
+        """Return the hash of all text seen so far.
+
+        Returns:
+            str: The hash digest as a hex string in uppercase.
+        """
+
+        return _format_digest(self._method, self._hasher)
 
 
 def dict_hash(obj, method="md5"):
@@ -40,28 +138,30 @@ def dict_hash(obj, method="md5"):
     Args:
         obj (dict): The json serializable dictionary that should
             be hashed.
-        method (str): The name of the hash method, currently
-            only md5 is supported.
+        method (str): The name of the hash method, one of
+            SUPPORTED_HASH_METHODS.  Default: md5.
 
     Returns:
         str: The hash digest as a hex string in uppercase.
     """
 
-    if method != 'md5':
-        raise ValueError("Unsupported hash algorithm: %s" % method)
-
     data = json.dumps(obj, sort_keys=True)
-    return _md5_hash(data)
+    return _hash_data(data, method)
 
 
 
-def directory_hash(path, glob="*"):
-    """Hash all files in a given folder.
+def directory_hash(path, glob="*", method="md5", cache=None):
+    """Hash all files in a given folder and all of its subfolders.
 
     This will return a hash value that will tell you if any file has changed
-    in the given directory.  You can calculate the hash only over a specific
-    subset of the files by using glob which will be passed to fnmatch to
-    select files.
+    in the given directory tree.  You can calculate the hash only over a
+    specific subset of the files by using glob which will be passed to fnmatch
+    to select files by name in every folder.  Folders that do not contain any
+    selected files, directly or in a subfolder, are ignored.
+
+    The hash is calculated as a Merkle tree: each file is hashed by its
+    contents and each folder's hash covers the names and hashes of its
+    selected files and subfolders.
 
     The hash value will detect:
      - a file is added
@@ -74,6 +174,13 @@ def directory_hash(path, glob="*"):
     the hash value so it is useful for ensuring that a given folder has the
     same contents.
 
+    If a DirectoryHashCache is passed, files whose size, modification time
+    and inode have not changed are not read again and folders whose contents
+    have the same stat information reuse their previous hash.  Every folder
+    still needs to be listed since modifying a file does not change the
+    modification time of its parent folder.  Cached entries inside path that
+    were not used by this call, such as those of deleted files, are removed.
+
     **This function assumes all files are text files and calculates a
     line-ending independing hash**
 
@@ -81,34 +188,247 @@ def directory_hash(path, glob="*"):
         path (str): The path to the directory that we want to hash.
         glob (str): Optional wildcard specifier for selecting which
             files should be hashed.
+        method (str): The name of the hash method, one of
+            SUPPORTED_HASH_METHODS.  Default: md5.
+        cache (DirectoryHashCache): Optional cache of previously calculated
+            file and folder hashes.  It is saved before returning.
 
     Returns:
         str: The hash digest as a hex string in uppercase.
     """
 
-    files = os.listdir(path)
-    selected = fnmatch.filter(files, glob)
-    selected.sort()
+    root = os.path.abspath(path)
+
+    if cache is not None:
+        cache.start_walk()
+
+    digest = _hash_tree(root, glob, method, cache)
+
+    if digest is None:
+        digest = _hash_children([], method)
+
+    if cache is not None:
+        cache.prune(["file:%s:%s" % (method, root), "dir:%s:%s:%s" % (method, glob, root)])
+        cache.save()
+
+    return digest
+
+
+class DirectoryHashCache(object):
+    """A persistent cache of file and folder hashes for directory_hash.
+
+    Each entry is stored along with a signature built from the stat
+    information of the file or folder that it belongs to.  An entry is only
+    used if its signature still matches.  Entries are keyed by absolute
+    path, so one cache can be shared by several directory trees.
+
+    Args:
+        path (str): Optional path to a json file where the cache is stored.
+            If not given, the cache is only kept in memory.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._seen = set()
+        self._dirty = False
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as infile:
+                    data = json.load(infile)
+            except (IOError, ValueError):
+                data = {}
+
+            if data.get('version') == self.VERSION:
+                self._entries = data.get('entries', {})
 
-    md5 = hashlib.md5()
-    hashes = [line_hash(x) for x in selected]
+    def get(self, key, signature):
+        """Get a cached hash if its signature matches.
+
+        Args:
+            key (str): The key of the cached entry.
+            signature (str): The current signature of the entry.
+
+        Returns:
+            str: The cached hash or None if it is missing or outdated.
+        """
+
+        self._seen.add(key)
+
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != signature:
+            return None
+
+        return entry[1]
+
+    def set(self, key, signature, digest):
+        """Store a hash in the cache.
+
+        Args:
+            key (str): The key of the cached entry.
+            signature (str): The current signature of the entry.
+            digest (str): The hash that should be cached.
+        """
+
+        self._seen.add(key)
+
+        entry = [signature, digest]
+        if self._entries.get(key) != entry:
+            self._entries[key] = entry
+            self._dirty = True
+
+    def start_walk(self):
+        """Start tracking which entries are used, see :meth:`prune`."""
+
+        self._seen = set()
+
+    def prune(self, prefixes):
+        """Remove entries that were not used since :meth:`start_walk`.
+
+        Only entries whose key is one of the prefixes, or a path inside one
+        of them, are removed so that entries belonging to other directory
+        trees are kept.
+
+        Args:
+            prefixes (list of str): The keys of the roots that were walked.
+        """
+
+        stale = [key for key in self._entries if key not in self._seen and
+                 any(key == prefix or key.startswith(prefix + os.sep) for prefix in prefixes)]
+
+        for key in stale:
+            del self._entries[key]
+
+        if len(stale) > 0:
+            self._dirty = True
+
+    def save(self):
+        """Save the cache to disk if it has changed."""
+
+        if self.path is None or not self._dirty:
+            return
+
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        atomic_json(self.path, {'version': self.VERSION, 'entries': self._entries})
+        self._dirty = False
+
+
+def _hash_tree(path, glob, method, cache):
+    """Recursively hash a folder, returning None if it has no selected files."""
+
+    entries = sorted(os.scandir(path), key=lambda x: x.name)
+    children = []
+    signature_parts = []
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            digest = _hash_tree(entry.path, glob, method, cache)
+            if digest is None:
+                continue
+
+            children.append(("dir", entry.name, digest))
+            signature_parts.append("%s/%s" % (entry.name, digest))
+        elif entry.is_file() and fnmatch.fnmatch(entry.name, glob):
+            info = entry.stat()
+            file_signature = "%d:%d:%d" % (info.st_size, info.st_mtime_ns, info.st_ino)
+            file_key = "file:%s:%s" % (method, entry.path)
+
+            digest = None
+            if cache is not None:
+                digest = cache.get(file_key, file_signature)
+
+            if digest is None:
+                digest = line_hash_file(entry.path, method)
+
+                if cache is not None:
+                    cache.set(file_key, file_signature, digest)
+
+            children.append(("file", entry.name, digest))
+            signature_parts.append("%s:%s" % (entry.name, file_signature))
+
+    if len(children) == 0:
+        return None
+
+    if cache is None:
+        return _hash_children(children, method)
+
+    info = os.stat(path)
+    signature_parts.insert(0, "%d:%d" % (info.st_mtime_ns, info.st_ino))
+    signature = _hash_data("\n".join(signature_parts), method)
+    dir_key = "dir:%s:%s:%s" % (method, glob, path)
+
+    digest = cache.get(dir_key, signature)
+    if digest is None:
+        digest = _hash_children(children, method)
+        cache.set(dir_key, signature, digest)
+
+    return digest
+
+
+def _hash_children(children, method):
+    hasher = _new_hasher(method)
+
+    hasher.update(b"START OF DIRECTORY")
+    hasher.update(b"Entry count: %d" % len(children))
+
+    for kind, name, hash_value in children:
+        if kind == "dir":
+            hasher.update(b"START OF SUBDIRECTORY: " + name.encode('utf-8'))
+        else:
+            hasher.update(b"START OF FILE: " + name.encode('utf-8'))
+
+        hasher.update(hash_value.encode('utf-8'))
+
+    hasher.update(b"END OF DIRECTORY")
+    return _format_digest(method, hasher)
+
+
+def hash_method(hash_value):
+    """Determine which hash method produced a given hash value.
+
+    Args:
+        hash_value (str): A hash string returned by one of the functions in
+            this module, such as "MD5:07358855AB401EE3EAB3167DA585C70A".
+
+    Returns:
+        str: The name of the hash method, e.g. md5.
+
+    Raises:
+        ValueError: The hash value has an unknown or missing prefix.
+    """
+
+    prefix, _, _digest = hash_value.partition(':')
+
+    method = _HASH_PREFIXES.get(prefix)
+    if method is None:
+        raise ValueError("Unknown hash prefix in hash value: %s" % hash_value)
+
+    return method
+
+
+def _new_hasher(method):
+    info = _HASH_METHODS.get(method)
+    if info is None:
+        raise ValueError("Unsupported hash algorithm: %s" % method)
 
-    md5.update(b"START OF DIRECTORY")
-    md5.update(b"File count: %d" % len(selected))
+    return info[1]()
 
-    for name, hash_value in zip(selected, hashes):
-        md5.update(b"START OF FILE: " + name.encode('utf-8'))
-        md5.update(hash_value.encode('utf-8'))
 
-    md5.update(b"END OF DIRECTORY")
-    return "MD5:" + md5.hexdigest().upper()
+def _format_digest(method, hasher):
+    return _HASH_METHODS[method][0] + ":" + hasher.hexdigest().upper()
 
 
-def _md5_hash(data):
+def _hash_data(data, method):
     if not isinstance(data, bytes):
         data = data.encode('utf-8')
 
-    md5 = hashlib.md5()
-    md5.update(data)
+    hasher = _new_hasher(method)
+    hasher.update(data)
 
-    return "MD5:" + md5.hexdigest().upper()
+    return _format_digest(method, hasher)
@@ -0,0 +1,326 @@
+"""An in-memory layer of pending file changes that is committed at once."""
+
+from builtins import open
+from collections import OrderedDict
+import difflib
+import os
+import shutil
+import threading
+from .file_ops import file_matches
+
+_REMOVED = object()
+
+
+class FileOverlay(object):
+    """Buffer file writes and removals in memory until they are committed.
+
+    Reads see the pending contents of a file if it has been written or
+    removed in this overlay, otherwise they fall through to the file on
+    disk.  This allows many independent edits to the same file to be
+    coalesced into a single write.
+
+    Calling :meth:`commit` writes all changed files to temporary files next
+    to their targets first and only moves them into place once every file
+    has been written successfully.  The previous version of each file is
+    kept as a backup until every change has been applied, so if moving a
+    file into place or removing a file fails, the files that were already
+    changed are restored and none of the changes are applied.  If the
+    overlay is never committed, nothing on disk is modified, which allows
+    previewing changes with :meth:`diff`.
+
+    An overlay can be shared by multiple threads as long as they do not
+    modify the same path at the same time.  Changes are always listed in
+    order of their paths so the result does not depend on which thread
+    staged a change first.
+    """
+
+    BACKUP_SUFFIX = '.old'
+    """Suffix of the backups of changed files that are kept while committing."""
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._directories = []
+        self._lock = threading.Lock()
+
+    def _key(self, path):
+        return os.path.abspath(path)
+
+    def read(self, path):
+        """Read the current contents of a file.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            bytes: The contents of the file or None if it does not exist.
+        """
+
+        data = self._pending.get(self._key(path))
+        if data is _REMOVED:
+            return None
+        elif data is not None:
+            return data
+
+        return self.read_disk(path)
+
+    def exists(self, path):
+        """Check if a file exists after applying pending changes.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            bool: Whether the file exists.
+        """
+
+        data = self._pending.get(self._key(path))
+        if data is not None:
+            return data is not _REMOVED
+
+        return os.path.exists(path)
+
+    def write(self, path, data, encoding="utf-8"):
+        """Replace the contents of a file.
+
+        Args:
+            path (str): The path to the file.
+            data (str or bytes): The new contents of the file.
+            encoding (str): The encoding used to convert data to bytes if it
+                is a string, defaults to utf-8 if not specified.
+        """
+
+        if not isinstance(data, bytes):
+            data = data.encode(encoding)
+
+        with self._lock:
+            self._pending[self._key(path)] = data
+
+    def makedirs(self, path):
+        """Create a directory, including any missing parents.
+
+        Pending directories are created before any files are written.
+
+        Args:
+            path (str): The path to the directory.
+        """
+
+        path = self._key(path)
+
+        with self._lock:
+            if not os.path.isdir(path) and path not in self._directories:
+                self._directories.append(path)
+
+    def isdir(self, path):
+        """Check if a directory exists after applying pending changes.
+
+        Args:
+            path (str): The path to the directory.
+
+        Returns:
+            bool: Whether the directory exists.
+        """
+
+        return self._key(path) in self._directories or os.path.isdir(path)
+
+    @property
+    def directories(self):
+        """The paths of all directories that will be created, in sorted order."""
+
+        return sorted(self._directories)
+
+    def remove(self, path):
+        """Remove a file.
+
+        Args:
+            path (str): The path to the file.
+        """
+
+        with self._lock:
+            self._pending[self._key(path)] = _REMOVED
+
+    def changes(self):
+        """List the pending changes that would modify the filesystem.
+
+        Writes of identical contents and removals of missing files are not
+        included.
+
+        Returns:
+            list of (str, bytes): The path of each changed file and its new
+            contents, or None if it is removed.
+        """
+
+        with self._lock:
+            pending = sorted(self._pending.items(), key=lambda x: x[0])
+
+        changes = []
+        for path, data in pending:
+            if data is _REMOVED:
+                if os.path.exists(path):
+                    changes.append((path, None))
+            elif not file_matches(path, data):
+                changes.append((path, data))
+
+        return changes
+
+    @property
+    def paths(self):
+        """The paths of all files that were written or removed."""
+
+        return list(self._pending)
+
+    def diff(self, base_path=None):
+        """Render all pending changes as a unified diff.
+
+        Args:
+            base_path (str): Optional folder that paths in the diff should be
+                relative to.
+
+        Returns:
+            str: The unified diff, empty if there are no changes.
+        """
+
+        output = []
+
+        for path, data in self.changes():
+            name = path if base_path is None else os.path.relpath(path, base_path)
+            name = name.replace('\\', '/')
+
+            old_data = self.read_disk(path)
+            old_lines = [] if old_data is None else _split_lines(old_data)
+            new_lines = [] if data is None else _split_lines(data)
+
+            from_name = 'a/' + name if old_data is not None else '/dev/null'
+            to_name = 'b/' + name if data is not None else '/dev/null'
+
+            output.extend(difflib.unified_diff(old_lines, new_lines, from_name, to_name))
+
+        return "".join(output)
+
+    @classmethod
+    def read_disk(cls, path):
+        """Read the contents of a file on disk ignoring pending changes.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            bytes: The contents of the file or None if it does not exist.
+        """
+
+        try:
+            with open(path, "rb") as infile:
+                return infile.read()
+        except (IOError, OSError):
+            return None
+
+    def commit(self):
+        """Apply all pending changes to disk.
+
+        Returns:
+            list of str: The paths of the files that were modified.
+        """
+
+        for path in self._directories:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        changes = self.changes()
+        staged = []
+
+        try:
+            for path, data in changes:
+                if data is None:
+                    continue
+
+                real_path = os.path.realpath(path)
+                new_path = real_path + '.new'
+                staged.append((new_path, real_path))
+
+                with open(new_path, "wb") as outfile:
+                    outfile.write(data)
+
+                if os.path.exists(real_path):
+                    shutil.copymode(real_path, new_path)
+        except Exception:
+            for new_path, _real_path in staged:
+                if os.path.exists(new_path):
+                    os.remove(new_path)
+
+            raise
+
+        # (path, backup) of every file changed so far, backup is None if the file is new
+        applied = []
+
+        try:
+            for index, (new_path, real_path) in enumerate(staged):
+                backup = self._backup(real_path, move=False)
+                applied.append((real_path, backup))
+                os.replace(new_path, real_path)
+                staged[index] = None
+
+            for path, data in changes:
+                if data is None:
+                    applied.append((path, self._backup(path, move=True)))
+        except Exception:
+            for item in staged:
+                if item is not None and os.path.exists(item[0]):
+                    os.remove(item[0])
+
+            for path, backup in reversed(applied):
+                if backup is not None:
+                    os.replace(backup, path)
+                elif os.path.exists(path):
+                    os.remove(path)
+
+            raise
+
+        for _path, backup in applied:
+            if backup is not None:
+                os.remove(backup)
+
+        self._pending.clear()
+        self._directories = []
+        return [path for path, _data in changes]
+
+    @classmethod
+    def _backup(cls, path, move):
+        """Keep the current version of a file so it can be restored.
+
+        Returns:
+            str: The path of the backup or None if the file does not exist.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        backup = path + cls.BACKUP_SUFFIX
+        if os.path.exists(backup):
+            os.remove(backup)
+
+        if move:
+            os.replace(path, backup)
+            return backup
+
+        # A hard link leaves the file in place and costs no copying
+        try:
+            os.link(path, backup)
+        except (OSError, AttributeError):
+            shutil.copy2(path, backup)
+
+        return backup
+
+    def discard(self):
+        """Drop all pending changes without touching the disk."""
+
+        self._pending.clear()
+        self._directories = []
+
+
+def _split_lines(data):
+    """Split file contents into lines for diffing, ensuring a final newline."""
+
+    lines = data.decode('utf-8', 'replace').splitlines(True)
+    if len(lines) > 0 and not lines[-1].endswith(('\n', '\r')):
+        lines[-1] += '\n\\ No newline at end of file\n'
+
+    return lines
@@ -1,11 +1,13 @@
 """Utilities for finding python packages."""
 
+from builtins import open
 import os
-import platform
-from setuptools import find_packages
+import json
+import fnmatch
+from .file_ops import atomic_json
 
 
-def find_toplevel_packages(path, exclude=("test",), prefix=None):
+def find_toplevel_packages(path, exclude=("test",), prefix=None, cache=None):
     """Find all top level python packages in the given directory.
 
     This will automatically exclude all subpackages and only
@@ -27,13 +29,17 @@ def find_toplevel_packages(path, exclude=("test",), prefix=None):
     multipackage
     other_package
 
+    Only the folders that can contain a top level package are listed, so
+    data, docs and nested subpackages are never walked.
+
     Args:
         path (str): The path to the directory in which to search
         exclude (list of str): Exclude the given packages
         prefix (str): Optional package prefix to search under.
-            If this is not None then it must not end with a .
-            and will be used to find the next level of packages
-            under a given prefix.
+            If this is not None then it will be used to find the
+            next level of packages under a given prefix.
+        cache (PackageCache): Optional cache of previously found packages
+            that is used if the directory tree has not changed.
 
     Returns:
         list of str: The list of top level packages.
@@ -41,19 +47,174 @@ def find_toplevel_packages(path, exclude=("test",), prefix=None):
 
     path = os.path.normpath(path)
 
-    if os.pathsep == "\\":
-        path = path.replace("\\", "/")
+    if cache is not None:
+        return cache.find_toplevel_packages(path, exclude, prefix)
+
+    packages, _folders = _scan_packages(path, exclude, prefix)
+    return packages
+
+
+def _is_excluded(name, exclude):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude)
+
+
+def _is_package(path, name):
+    return '.' not in name and os.path.isfile(os.path.join(path, '__init__.py'))
+
+
+def _scan_packages(path, exclude=(), prefix=None):
+    """Find the packages directly below a prefix without walking the tree.
+
+    Only the folder of the prefix package is listed and its subfolders are
+    checked for an __init__.py file, nothing below the first package level
+    is visited.  Excluded packages are skipped as they are found.
+
+    Returns:
+        (list of str, dict): The sorted package names and the mtime of every
+        folder that was looked at, which changes whenever a file or folder is
+        added to or removed from it.  Each mtime is read before the folder's
+        contents so a concurrent change is never missed.
+    """
+
+    folders = {'.': os.stat(path).st_mtime_ns}
+    current = path
+    base_name = ''
+
+    if prefix is not None:
+        prefix = prefix.rstrip('.')
+
+        for part in prefix.split('.'):
+            current = os.path.join(current, part)
+
+            try:
+                folders[os.path.relpath(current, path)] = os.stat(current).st_mtime_ns
+            except OSError:
+                return [], folders
+
+            if not _is_package(current, part):
+                return [], folders
+
+        base_name = prefix + '.'
+
+    packages = []
+    for entry in os.scandir(current):
+        if not entry.is_dir():
+            continue
+
+        folders[os.path.relpath(entry.path, path)] = entry.stat().st_mtime_ns
+
+        name = base_name + entry.name
+        if _is_package(entry.path, entry.name) and not _is_excluded(name, exclude):
+            packages.append(name)
+
+    return sorted(packages), folders
+
+
+def _fingerprint_matches(path, folders):
+    try:
+        for rel_path, mtime_ns in folders.items():
+            if os.stat(os.path.join(path, rel_path)).st_mtime_ns != mtime_ns:
+                return False
+    except OSError:
+        return False
+
+    return True
+
+
+class PackageCache(object):
+    """A persistent cache of the packages found in a directory tree.
+
+    Each entry is stored along with the mtimes of all of the folders that
+    package discovery looked at.  An entry is only used if none of those
+    folders has changed, so an ``__init__.py`` file appearing or disappearing
+    anywhere that matters invalidates it, while checking the cache only
+    requires a stat of each folder instead of listing them.
+
+    The cache can be shared by threads that search different paths.  Several
+    processes can also share the same cache file since entries written by
+    other processes are merged in when the cache is saved.  Entries for
+    paths that no longer exist are dropped when the cache is saved.
+
+    Args:
+        path (str): Optional path to a json file where the cache is stored.
+            If not given, the cache is only kept in memory.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = self._load()
+        self._verified = set()
+        self._changed = set()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+        except (IOError, ValueError):
+            return {}
+
+        if data.get('version') != self.VERSION:
+            return {}
+
+        return data.get('entries', {})
+
+    def find_toplevel_packages(self, path, exclude=(), prefix=None):
+        """Find the top level packages in a directory, using the cache if possible.
+
+        See :func:`find_toplevel_packages` for a description of the arguments.
+
+        Returns:
+            list of str: The list of top level packages.
+        """
+
+        path = os.path.abspath(path)
+        key = "|".join([",".join(sorted(exclude)), prefix or ''])
+        entries = self._entries.setdefault(path, {})
+
+        old_entry = entries.get(key)
+        entry = old_entry
+        if entry is not None and (path, key) not in self._verified:
+            if not _fingerprint_matches(path, entry['folders']):
+                entry = None
+
+        if entry is None:
+            packages, folders = _scan_packages(path, exclude, prefix)
+            entry = {'folders': folders, 'packages': packages}
+            entries[key] = entry
+
+            if entry != old_entry:
+                self._changed.add((path, key))
+
+        self._verified.add((path, key))
+        return list(entry['packages'])
+
+    def save(self):
+        """Save the cache to disk if it has changed.
+
+        The file is read again first so that entries saved by other processes
+        since this cache was loaded are kept, while entries for paths that no
+        longer exist are removed.  Nothing is written if the result is the
+        same as the file.
+        """
+
+        if self.path is None or len(self._changed) == 0:
+            return
 
-    packages = find_packages(path, exclude=exclude)
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
 
-    if prefix is None:
-        toplevel = set(x.split('.')[0] for x in packages)
-    else:
-        prefix_dots = prefix.count('.')
-        if prefix.endswith('.'):
-            prefix_dots -= 1
-            prefix = prefix + '.'
+        saved = self._load()
+        entries = {path: dict(value) for path, value in saved.items() if os.path.isdir(path)}
+        for path, key in self._changed:
+            entries.setdefault(path, {})[key] = self._entries[path][key]
 
-        toplevel = [x for x in packages if x.startswith(prefix) and x.count('.') == prefix_dots + 1]
+        if entries != saved:
+            atomic_json(self.path, {'version': self.VERSION, 'entries': entries})
 
-    return sorted(list(toplevel))
+        self._changed = set()
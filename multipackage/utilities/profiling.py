@@ -0,0 +1,259 @@
+"""Optional timing of the stages of a multipackage command.
+
+Code that does something worth measuring wraps it in :func:`timed`, which
+does nothing unless a :class:`Profiler` has been started with
+:func:`start_profiling`.  The profiler records the wall and CPU time of each
+span along with the thread that ran it, so it can print a summary, save a
+Chrome trace-event file and optionally run cProfile at the same time.
+"""
+
+import os
+import time
+import json
+import threading
+from collections import namedtuple
+
+Span = namedtuple("Span", ['category', 'name', 'start', 'wall', 'cpu', 'thread'])
+
+_ACTIVE = None
+
+# CPU time of the calling thread where supported, since spans run concurrently
+_thread_cpu = getattr(time, 'thread_time', time.process_time)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, profiler, category, name):
+        self._profiler = profiler
+        self._category = category
+        self._name = name
+        self._start = None
+        self._cpu = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._cpu = _thread_cpu()
+        return self
+
+    def __exit__(self, *_args):
+        wall = time.perf_counter() - self._start
+        cpu = _thread_cpu() - self._cpu
+
+        self._profiler.record(Span(self._category, self._name, self._start, wall, cpu, threading.current_thread().ident))
+        return False
+
+
+class Profiler(object):
+    """Collect timing spans and optionally a cProfile profile.
+
+    Args:
+        use_cprofile (bool): Also run cProfile while profiling.  Only the
+            thread that calls :meth:`start` is profiled by cProfile.
+    """
+
+    def __init__(self, use_cprofile=False):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._origin = None
+        self._cprofile = None
+
+        if use_cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+
+    def start(self):
+        """Start collecting timing information."""
+
+        self._origin = time.perf_counter()
+
+        if self._cprofile is not None:
+            self._cprofile.enable()
+
+    def stop(self):
+        """Stop collecting timing information."""
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def record(self, span):
+        """Record a finished span.
+
+        Args:
+            span (Span): The span to record.
+        """
+
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """Total up the time spent in each span.
+
+        Returns:
+            list of (str, str, int, float, float): The category, name, number
+            of calls, wall time and CPU time in seconds of each distinct span,
+            sorted with the longest wall time first.
+        """
+
+        totals = {}
+        for span in self.spans:
+            key = (span.category, span.name)
+            calls, wall, cpu = totals.get(key, (0, 0.0, 0.0))
+            totals[key] = (calls + 1, wall + span.wall, cpu + span.cpu)
+
+        rows = [(category, name, calls, wall, cpu) for (category, name), (calls, wall, cpu) in totals.items()]
+        return sorted(rows, key=lambda x: (-x[3], x[0], x[1]))
+
+    def format_summary(self, limit=25):
+        """Format the time spent in each category and the slowest spans.
+
+        Args:
+            limit (int): The maximum number of individual spans to list.
+
+        Returns:
+            str: A human readable table.
+        """
+
+        rows = self.summary()
+
+        categories = {}
+        for category, _name, calls, wall, cpu in rows:
+            old_calls, old_wall, old_cpu = categories.get(category, (0, 0.0, 0.0))
+            categories[category] = (old_calls + calls, old_wall + wall, old_cpu + cpu)
+
+        lines = ["PROFILE: time per category (spans may overlap or run concurrently)",
+                 "  %-12s %7s %10s %10s" % ("category", "calls", "wall (ms)", "cpu (ms)")]
+
+        for category, (calls, wall, cpu) in sorted(categories.items(), key=lambda x: -x[1][1]):
+            lines.append("  %-12s %7d %10.1f %10.1f" % (category, calls, wall*1000, cpu*1000))
+
+        lines.append("")
+        lines.append("PROFILE: slowest spans")
+        lines.append("  %-12s %7s %10s %10s  %s" % ("category", "calls", "wall (ms)", "cpu (ms)", "name"))
+
+        for category, name, calls, wall, cpu in rows[:limit]:
+            lines.append("  %-12s %7d %10.1f %10.1f  %s" % (category, calls, wall*1000, cpu*1000, name))
+
+        if len(rows) > limit:
+            lines.append("  ... %d more" % (len(rows) - limit))
+
+        return "\n".join(lines) + "\n"
+
+    def trace_events(self):
+        """Convert the recorded spans to Chrome trace events.
+
+        Returns:
+            dict: The trace in the Chrome trace-event JSON format, which can
+            be loaded in chrome://tracing or https://ui.perfetto.dev.
+        """
+
+        origin = self._origin
+        if origin is None:
+            origin = min([x.start for x in self.spans] + [0.0])
+
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round((span.start - origin) * 1e6, 3),
+                'dur': round(span.wall * 1e6, 3),
+                'pid': pid,
+                'tid': span.thread,
+                'args': {'cpu_ms': round(span.cpu * 1000, 3)}
+            })
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_trace(self, path):
+        """Save a Chrome trace-event JSON file.
+
+        Args:
+            path (str): The file to write.
+        """
+
+        with open(path, "w") as outfile:
+            json.dump(self.trace_events(), outfile)
+
+    def save_pstats(self, path):
+        """Save the cProfile statistics in pstats format.
+
+        Args:
+            path (str): The file to write, which can be loaded with
+                ``pstats.Stats(path)`` or tools like snakeviz.
+        """
+
+        if self._cprofile is None:
+            raise ValueError("Profiler was not created with use_cprofile=True")
+
+        self._cprofile.dump_stats(path)
+
+
+def timed(category, name):
+    """Time a block of code if profiling is active.
+
+    Use as a context manager::
+
+        with timed('template', template_name):
+            ...
+
+    Args:
+        category (str): The kind of work being done, e.g. template or http.
+        name (str): What specifically is being done.
+
+    Returns:
+        A context manager that records the span.
+    """
+
+    profiler = _ACTIVE
+    if profiler is None:
+        return _NULL_SPAN
+
+    return _Span(profiler, category, name)
+
+
+def start_profiling(use_cprofile=False):
+    """Create and start the profiler used by :func:`timed`.
+
+    Args:
+        use_cprofile (bool): Also run cProfile.
+
+    Returns:
+        Profiler: The active profiler.
+    """
+
+    global _ACTIVE  # pylint: disable=global-statement
+
+    profiler = Profiler(use_cprofile)
+    profiler.start()
+    _ACTIVE = profiler
+    return profiler
+
+
+def stop_profiling():
+    """Stop the active profiler.
+
+    Returns:
+        Profiler: The profiler that was active, or None.
+    """
+
+    global _ACTIVE  # pylint: disable=global-statement
+
+    profiler = _ACTIVE
+    _ACTIVE = None
+
+    if profiler is not None:
+        profiler.stop()
+
+    return profiler
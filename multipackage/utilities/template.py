@@ -1,10 +1,237 @@
-"""jinja based template rendering."""
+"""jinja based template rendering.
 
+jinja2 itself is only imported by :mod:`.template_env` once the first
+template is rendered, so importing this module is cheap.
+"""
+
+import io
 import os
-from jinja2 import Environment, PackageLoader
+import re
+import threading
+from collections import Counter
+from .profiling import timed
+
+_ENVIRONMENTS = {}
+_ENVIRONMENT_LOCK = threading.Lock()
+_STATS = Counter()
+_STATS_LOCK = threading.Lock()
+
+# The same line boundaries that str.splitlines() uses, with '\r\n' as one break
+_LINE_BREAK = re.compile(r'\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
+
+
+def _missing_filter(name):
+    def _filter(*_args, **_kwargs):
+        raise RuntimeError("Template filter %s used without being passed to render_template" % name)
+
+    return _filter
+
+
+def _count(name):
+    """Increment a cache counter, templates are rendered by several threads at once."""
+
+    with _STATS_LOCK:
+        _STATS[name] += 1
+
+
+def _get_environment(filters):
+    """Get the shared environment for a set of filter names."""
+
+    key = frozenset(filters) if filters is not None else frozenset()
+
+    with _ENVIRONMENT_LOCK:
+        cached = _ENVIRONMENTS.get(key)
+        if cached is None:
+            _count('environment_misses')
+
+            from .template_env import CachedEnvironment
+            cached = CachedEnvironment(key)
+            _ENVIRONMENTS[key] = cached
+        else:
+            _count('environment_hits')
+
+    return cached
+
+
+def template_cache_stats():
+    """Get the hit and miss counters of the template caches.
+
+    Returns:
+        dict: The number of ``environment_hits``, ``environment_misses``,
+        ``precompiled_hits``, ``bytecode_hits`` and ``bytecode_misses`` since
+        the process started or :func:`clear_template_cache` was last called.
+    """
+
+    keys = ('environment_hits', 'environment_misses', 'precompiled_hits', 'bytecode_hits', 'bytecode_misses')
+    with _STATS_LOCK:
+        return {key: _STATS[key] for key in keys}
 
-def _quote(obj):
-    return '"' + obj + '"'
+
+def clear_template_cache():
+    """Drop all shared template environments and reset the counters.
+
+    The on-disk bytecode cache is kept.
+    """
+
+    with _ENVIRONMENT_LOCK, _STATS_LOCK:
+        _ENVIRONMENTS.clear()
+        _STATS.clear()
+
+
+def warm_template_cache(filter_sets=((), ('encrypt',), ('variable_status',))):
+    """Load every packaged template ahead of time.
+
+    This fills the shared environments (and the on-disk bytecode cache) so
+    that later renders do not compile anything.  It is most useful before
+    forking worker processes, which then inherit the loaded templates.
+
+    Templates that use a filter outside of a filter set fail to compile in
+    that set's environment and are skipped there.
+
+    Args:
+        filter_sets (list of list of str): The filter names passed to
+            render_template by the callers whose environments should be
+            warmed.
+
+    Returns:
+        int: The number of templates that were loaded.
+    """
+
+    from jinja2 import TemplateError
+    from .template_compiler import TEMPLATE_DIR, RAW_TEMPLATES
+
+    names = sorted(x for x in os.listdir(TEMPLATE_DIR) if x not in RAW_TEMPLATES)
+
+    loaded = 0
+    for filter_names in filter_sets:
+        cached = _get_environment(filter_names)
+
+        with cached.lock:
+            for name in names:
+                try:
+                    cached.env.get_template(name)
+                except TemplateError:
+                    continue
+
+                loaded += 1
+
+    return loaded
+
+
+class _NewlineNormalizer(object):
+    r"""Incrementally convert line endings in streamed text to os.linesep.
+
+    The output is identical to joining ``text.splitlines()`` with
+    os.linesep, which means that a single trailing line ending is dropped.
+    A line break is only written once some text or another line break
+    follows it, and a trailing '\r' is held back in case the next piece
+    starts with '\n'.
+    """
+
+    def __init__(self):
+        self._owed_break = False
+        self._carry = ''
+
+    def feed(self, text):
+        """Normalize the next piece of text.
+
+        Args:
+            text (str): The next piece of text.
+
+        Returns:
+            list of str: The normalized pieces that can be written.
+        """
+
+        text = self._carry + text
+        self._carry = ''
+
+        if text.endswith('\r'):
+            self._carry = '\r'
+            text = text[:-1]
+
+        return self._normalize(text)
+
+    def finish(self):
+        """Flush any held back text at the end of the stream.
+
+        Returns:
+            list of str: The normalized pieces that can be written.
+        """
+
+        carry = self._carry
+        self._carry = ''
+        return self._normalize(carry)
+
+    def _normalize(self, text):
+        output = []
+
+        for i, part in enumerate(_LINE_BREAK.split(text)):
+            if i > 0:
+                if self._owed_break:
+                    output.append(os.linesep)
+
+                self._owed_break = True
+
+            if part:
+                if self._owed_break:
+                    output.append(os.linesep)
+                    self._owed_break = False
+
+                output.append(part)
+
+        return output
+
+
+def stream_template(template_name, info, outfile, adjust_newlines=True, filters=None, hasher=None):
+    """Render a template directly into a binary file object.
+
+    The template is rendered piece by piece using jinja2's generate() so the
+    full output is never held in memory as a single string.  Each piece has
+    its newlines normalized, is encoded as UTF-8 and written to outfile
+    immediately.
+
+    Args:
+        template_name (str): The name of the template to load.  This must
+            be a file in data/templates inside this package
+        info (dict): A dictionary of variables passed into the template to
+            perform substitutions.
+        outfile (file): A file-like object opened in binary mode that the
+            rendered template is written to.
+        adjust_newlines (bool): Automatically convert the output to have
+            platform specific newlines.  Default: True.
+        filters (dict): Optional dict of callables that are provided as filters
+            to the underlying template.
+        hasher (LineHasher): Optional hasher that is updated with exactly
+            the text written to outfile, so the line hash of the output is
+            available without reading it back.
+    """
+
+    normalizer = _NewlineNormalizer() if adjust_newlines else None
+
+    def _write(pieces):
+        for piece in pieces:
+            outfile.write(piece.encode('utf-8'))
+            if hasher is not None:
+                hasher.update(piece)
+
+    cached = _get_environment(filters)
+
+    # Filters are looked up while rendering so they can be swapped in for
+    # each call while holding the environment's lock.
+    with timed('template', template_name), cached.lock:
+        if filters is not None:
+            cached.env.filters.update(filters)
+
+        try:
+            template = cached.env.get_template(template_name)
+            for chunk in template.generate(info):
+                _write(normalizer.feed(chunk) if normalizer is not None else [chunk])
+        finally:
+            if filters is not None:
+                cached.env.filters.update({name: _missing_filter(name) for name in filters})
+
+    if normalizer is not None:
+        _write(normalizer.finish())
 
 
 def render_template(template_name, info, out_path=None, adjust_newlines=True, filters=None):
@@ -12,11 +239,23 @@ def render_template(template_name, info, out_path=None, adjust_newlines=True, fi
 
     You can optionally render to a file by passing out_path.  This assumes
     that you are rendering text files that will be saved with UTF-8 encoding.
+    The file is written to a temporary file next to out_path and then moved
+    into place.  Use :func:`stream_template` to render into a file without
+    building up the rendered text in memory.
 
     By default, it modifies the generated template to have platform-specific
     newlines.  If you want the template's output to be unmodified, pass
     adjust_newlines=False.
 
+    Templates are loaded through a jinja2 environment that is shared by all
+    calls with the same set of filter names, so each template is only
+    compiled once per process.  Compiled templates are also stored in a
+    bytecode cache inside the user's cache directory so that later
+    invocations of multipackage can skip compilation entirely.  If the
+    package was built with precompiled templates (see
+    :func:`.template_compiler.compile_templates`), those are used instead of parsing the
+    template source.
+
     Args:
         template_name (str): The name of the template to load.  This must
             be a file in config/templates inside this package
@@ -33,23 +272,23 @@ def render_template(template_name, info, out_path=None, adjust_newlines=True, fi
         string: The rendered template data.
     """
 
-    env = Environment(loader=PackageLoader('multipackage', 'data/templates'),
-                      trim_blocks=True, lstrip_blocks=True)
-
-    env.filters['quote'] = _quote
+    buffer = io.BytesIO()
+    stream_template(template_name, info, buffer, adjust_newlines, filters)
+    data = buffer.getvalue()
 
-    if filters is not None:
-        env.filters.update(filters)
+    if out_path is not None:
+        real_path = os.path.realpath(out_path)
+        new_path = real_path + '.new'
 
-    template = env.get_template(template_name)
-    result = template.render(info)
+        try:
+            with io.open(new_path, 'wb') as outfile:
+                outfile.write(data)
+        except Exception:
+            if os.path.exists(new_path):
+                os.remove(new_path)
 
-    if adjust_newlines:
-        result_lines = result.splitlines()
-        result = os.linesep.join(result_lines)
+            raise
 
-    if out_path is not None:
-        with open(out_path, 'wb') as outfile:
-            outfile.write(result.encode('utf-8'))
+        os.replace(new_path, real_path)
 
-    return result
+    return data.decode('utf-8')
@@ -0,0 +1,101 @@
+"""Precompile the packaged jinja templates into python modules.
+
+This module is loaded directly by setup.py during the build, before
+multipackage is installed, so it must only depend on jinja2 and the
+standard library.
+"""
+
+import os
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'templates')
+COMPILED_TEMPLATE_DIR = os.path.join(os.path.dirname(TEMPLATE_DIR), 'compiled_templates')
+
+# Custom filters referenced by our templates, they must exist at compile time
+TEMPLATE_FILTERS = ('quote', 'encrypt', 'variable_status')
+
+# Templates that are copied verbatim and rendered later by sphinx
+RAW_TEMPLATES = frozenset(['module.rst', 'package.rst'])
+
+# Records the jinja2 version that compiled the templates, since compiled
+# modules are only guaranteed to work with that exact version
+VERSION_FILE = 'jinja2_version.txt'
+
+
+def _placeholder_filter(value, *_args, **_kwargs):
+    return value
+
+
+def create_environment(loader):
+    """Create a jinja2 environment with the options used by multipackage.
+
+    Compiled templates must be produced by an environment with the same
+    options as the one that renders them.
+
+    Args:
+        loader (jinja2.BaseLoader): The loader used to find templates.
+
+    Returns:
+        jinja2.Environment: The configured environment.
+    """
+
+    from jinja2 import Environment
+
+    return Environment(loader=loader, trim_blocks=True, lstrip_blocks=True)
+
+
+def compile_templates(output_dir, template_dir=None):
+    """Compile all of the templates into python modules.
+
+    The resulting folder can be loaded with a ``jinja2.ModuleLoader`` so that
+    templates do not need to be parsed when multipackage runs.
+
+    Args:
+        output_dir (str): The folder where the compiled modules are saved.
+        template_dir (str): Optional folder of templates to compile, defaults
+            to the templates included in multipackage.
+
+    The jinja2 version is saved alongside the modules so that
+    :func:`compiled_templates_usable` can reject them if a different version
+    is installed when they are loaded.
+
+    Returns:
+        list of str: The names of the templates that were compiled.
+    """
+
+    import jinja2
+    from jinja2 import FileSystemLoader
+
+    if template_dir is None:
+        template_dir = TEMPLATE_DIR
+
+    env = create_environment(FileSystemLoader(template_dir))
+    for name in TEMPLATE_FILTERS:
+        env.filters[name] = _placeholder_filter
+
+    names = [x for x in env.list_templates() if x not in RAW_TEMPLATES]
+    env.compile_templates(output_dir, zip=None, filter_func=lambda x: x in names, ignore_errors=False)
+
+    with open(os.path.join(output_dir, VERSION_FILE), "w") as outfile:
+        outfile.write(jinja2.__version__)
+
+    return names
+
+
+def compiled_templates_usable(compiled_dir):
+    """Check if a folder of compiled templates matches the installed jinja2.
+
+    Args:
+        compiled_dir (str): A folder created by :func:`compile_templates`.
+
+    Returns:
+        bool: True if the templates were compiled by the installed version
+        of jinja2.
+    """
+
+    import jinja2
+
+    try:
+        with open(os.path.join(compiled_dir, VERSION_FILE), "r") as infile:
+            return infile.read().strip() == jinja2.__version__
+    except (IOError, OSError):
+        return False
@@ -0,0 +1,63 @@
+"""The jinja2 environments shared by all render_template calls.
+
+This module is imported lazily by :mod:`.template` so that jinja2 is only
+loaded when a template is actually rendered.
+"""
+
+import threading
+from jinja2 import PackageLoader, ModuleLoader, ChoiceLoader, FileSystemBytecodeCache
+from .file_ops import user_cache_dir
+from .template import _count, _missing_filter
+from .template_compiler import create_environment, compiled_templates_usable, COMPILED_TEMPLATE_DIR
+
+
+def _quote(obj):
+    return '"' + obj + '"'
+
+
+class _CountingBytecodeCache(FileSystemBytecodeCache):
+    """A bytecode cache that records hits and misses in the template cache stats."""
+
+    def load_bytecode(self, bucket):
+        super(_CountingBytecodeCache, self).load_bytecode(bucket)
+
+        if bucket.code is None:
+            _count('bytecode_misses')
+        else:
+            _count('bytecode_hits')
+
+
+class _CountingModuleLoader(ModuleLoader):
+    """A loader for precompiled templates that records hits in the template cache stats."""
+
+    def load(self, environment, name, globals=None):  # pylint: disable=redefined-builtin
+        template = super(_CountingModuleLoader, self).load(environment, name, globals)
+        _count('precompiled_hits')
+        return template
+
+
+class CachedEnvironment(object):
+    """A shared jinja2 environment and the lock that guards its filters."""
+
+    def __init__(self, filter_names):
+        bytecode_cache = None
+
+        cache_dir = user_cache_dir('templates')
+        if cache_dir is not None:
+            bytecode_cache = _CountingBytecodeCache(cache_dir)
+
+        loader = PackageLoader('multipackage', 'data/templates')
+
+        # Prefer templates compiled into python modules at build time by the same jinja2 version
+        if compiled_templates_usable(COMPILED_TEMPLATE_DIR):
+            loader = ChoiceLoader([_CountingModuleLoader(COMPILED_TEMPLATE_DIR), loader])
+
+        self.env = create_environment(loader)
+        self.env.bytecode_cache = bytecode_cache
+        self.env.filters['quote'] = _quote
+
+        # Placeholders so templates can be compiled before the real filters are set
+        for name in filter_names:
+            self.env.filters[name] = _missing_filter(name)
+
+        self.lock = threading.Lock()
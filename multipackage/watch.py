@@ -0,0 +1,192 @@
+"""Keep a repository's managed files up to date as it is edited."""
+
+from __future__ import unicode_literals
+import os
+import logging
+from .exceptions import UsageError
+from .repo import Repository
+from .utilities import FileOverlay
+from .utilities.file_watch import create_watcher
+
+
+class RepositoryWatcher(object):
+    """Reapply a repository's managed files whenever its inputs change.
+
+    The Repository is kept loaded between changes so each update only pays
+    for the subsystems that are affected, which :meth:`Repository.update`
+    finds using the fingerprints of their inputs and outputs.  The
+    Repository is only reloaded if its settings, its components or the
+    folders that package discovery looks at change.
+
+    The folders containing the repository's settings, the managed files
+    declared by each subsystem and each component are watched, along with
+    the direct subfolders of each component since they decide which python
+    packages are found.
+
+    Args:
+        path (str): The path to the repository.
+        polling (bool): Poll for changes instead of using inotify.
+        interval (float): How often to poll, in seconds, if polling.
+        settle (float): How long to wait for more changes after the first
+            one so that a burst of edits causes a single update.
+    """
+
+    # Files that multipackage writes itself while updating
+    IGNORED_NAMES = frozenset([os.path.basename(Repository.MANIFEST_FILE), os.path.basename(Repository.MANIFEST_DB_FILE),
+                               os.path.basename(Repository.MANIFEST_DB_FILE) + '-journal'])
+
+    def __init__(self, path, polling=False, interval=0.25, settle=0.05):
+        self.path = os.path.abspath(path)
+        self.settle = settle
+
+        self._logger = logging.getLogger(__name__)
+        self._repo = None
+        self._reload_pending = False
+        self._settings_files = set()
+        self._component_dirs = set()
+        self._package_dirs = set()
+        self._watcher = create_watcher(polling=polling, interval=interval)
+
+    @property
+    def repo(self):
+        """The currently loaded Repository."""
+
+        return self._repo
+
+    def _load(self):
+        repo = Repository(self.path)
+
+        if not repo.initialized:
+            raise UsageError("Repository at {} has not been set up with multipackage".format(self.path),
+                             "multipackage init {}".format(self.path))
+
+        self._repo = repo
+
+        self._component_dirs = set()
+        self._package_dirs = set()
+        for component in self._repo.components.values():
+            folder = os.path.normpath(os.path.join(self.path, component.relative_path))
+            self._component_dirs.add(folder)
+
+            try:
+                self._package_dirs.update(entry.path for entry in os.scandir(folder)
+                                          if entry.is_dir() and not entry.name.startswith('.'))
+            except OSError:
+                pass
+
+        settings_dir = os.path.join(self.path, Repository.MULTIPACKAGE_DIR)
+        self._settings_files = set([os.path.join(self.path, Repository.SETTINGS_FILE),
+                                    os.path.join(self.path, Repository.COMPONENT_FILE)])
+
+        output_dirs = set()
+        for subsystem in self._repo.subsystems:
+            declared = self._repo._declared_outputs(subsystem)  # pylint: disable=protected-access
+            for output in declared or ():
+                output_dirs.add(os.path.dirname(output))
+                if os.path.isdir(output):
+                    output_dirs.add(output)
+
+        self._watcher.set_folders(self._component_dirs | self._package_dirs | output_dirs | set([self.path, settings_dir]))
+
+    def _needs_reload(self, changed):
+        """Check if any change could affect settings, components or packages."""
+
+        for path in changed:
+            folder = os.path.dirname(path)
+
+            if path in self._settings_files:
+                return True
+
+            # A folder was added to or removed from a component
+            if folder in self._component_dirs and (os.path.isdir(path) or not os.path.exists(path)):
+                return True
+
+            if folder in self._package_dirs and os.path.basename(path) == '__init__.py':
+                return True
+
+        return False
+
+    def _is_relevant(self, path):
+        name = os.path.basename(path)
+        return (name not in self.IGNORED_NAMES and not name.endswith(('.new', FileOverlay.BACKUP_SUFFIX)) and
+                name != '.git')
+
+    def apply(self, reload=False):
+        """Update the repository, reloading it first if needed.
+
+        Changes made while updating are ignored so that the files written by
+        the update do not trigger another one.
+
+        Once the repository has been loaded, errors raised while reloading or
+        updating it, e.g. because a file is only partially saved, are logged
+        and the next change is applied normally.  A failed reload is retried
+        on the next call.
+
+        Args:
+            reload (bool): Reload the Repository from disk before updating.
+
+        Returns:
+            list of str: The class names of the subsystems that were updated.
+            This is empty if the repository has errors or the update failed,
+            which are logged.
+        """
+
+        first = self._repo is None
+        updated = []
+
+        try:
+            if reload or first or self._reload_pending:
+                self._reload_pending = True
+                self._load()
+                self._reload_pending = False
+
+            if not self._repo.clean:
+                for msg in self._repo.iter_messages('error'):
+                    self._logger.error("Not updating repository, error in %s: %s", msg.file, msg.message)
+            else:
+                updated = self._repo.update()
+        except Exception as err:  # pylint: disable=broad-except
+            if first:
+                raise
+
+            self._logger.error("Could not update repository, waiting for the next change: %s", err)
+            self._logger.debug("Update failed", exc_info=True)
+        finally:
+            self._watcher.reset()
+
+        return updated
+
+    def poll(self, timeout=None):
+        """Wait for a relevant change and then update the repository.
+
+        Args:
+            timeout (float): The maximum time to wait for a change in
+                seconds, or None to wait forever.
+
+        Returns:
+            list of str: The class names of the subsystems that were updated,
+            or None if nothing relevant changed before timeout expired.
+        """
+
+        changed = set(x for x in self._watcher.wait(timeout) if self._is_relevant(x))
+        if len(changed) == 0:
+            return None
+
+        # Collect the rest of a burst of changes, e.g. an editor saving several files
+        while True:
+            more = self._watcher.wait(self.settle)
+            if len(more) == 0:
+                break
+
+            changed.update(x for x in more if self._is_relevant(x))
+
+        reload = self._needs_reload(changed)
+        self._logger.info("Detected changes in %s%s", ", ".join(sorted(os.path.relpath(x, self.path) for x in changed)),
+                          ", reloading repository" if reload else "")
+
+        return self.apply(reload=reload)
+
+    def close(self):
+        """Stop watching for changes."""
+
+        self._watcher.close()
@@ -1,8 +1,41 @@
 """Setup file for multipackage."""
 
+import os
+import runpy
+import logging
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 from version import version
 
+log = logging.getLogger(__name__)
+
+
+class build_py_with_templates(build_py):
+    """Build the package and precompile its jinja2 templates.
+
+    The compiled templates are saved in multipackage/data/compiled_templates
+    inside the build folder, where multipackage loads them in preference to
+    parsing the template source.
+    """
+
+    def run(self):
+        build_py.run(self)
+
+        if self.dry_run:
+            return
+
+        compiler = runpy.run_path(os.path.join('multipackage', 'utilities', 'template_compiler.py'))
+        output_dir = os.path.join(self.build_lib, 'multipackage', 'data', 'compiled_templates')
+
+        try:
+            names = compiler['compile_templates'](output_dir)
+        except ImportError:
+            log.warning("jinja2 is not installed, skipping template precompilation")
+            return
+
+        log.info("precompiled %d templates into %s", len(names), output_dir)
+
+
 setup(
     name="multipackage",
     packages=find_packages(exclude=("test",)),
@@ -14,6 +47,9 @@ setup(
         "pyyaml"
     ],
     include_package_data=True,
+    cmdclass={
+        "build_py": build_py_with_templates
+    },
     entry_points={
         "console_scripts": ['multipackage = multipackage.scripts.multipackage:main']
     },
@@ -0,0 +1,252 @@
+"""Benchmarks of multipackage against large synthetic repositories.
+
+Benchmarks only run when pytest is passed --benchmark.  Their timings are
+printed at the end of the session and can be saved to a json file with
+--benchmark-save and compared against a previously saved file with
+--benchmark-compare, which fails any benchmark stage that got slower than
+the allowed tolerance.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import subprocess
+from collections import namedtuple
+
+import pytest
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# Stages that took less than this long are too noisy to compare
+MIN_COMPARE_SECONDS = 0.01
+
+RepoShape = namedtuple("RepoShape", ['components', 'packages', 'module_lines', 'managed_lines', 'namespace'])
+
+
+def shape_id(shape):
+    """Get a short unique name for a repository shape."""
+
+    return "c%d-p%d-m%d-l%d%s" % (shape.components, shape.packages, shape.module_lines, shape.managed_lines,
+                                  "-ns" if shape.namespace else "")
+
+
+def parse_shape(text):
+    """Parse a shape from components[xpackages[xmodule_lines[xmanaged_lines]]][ns].
+
+    For example, ``300`` is 300 components with the default layout and
+    ``50x4x200x1000ns`` is 50 components with 4 namespace packages each,
+    each with a 200 line module and 1000 extra lines in each managed file.
+    """
+
+    namespace = text.endswith('ns')
+    if namespace:
+        text = text[:-2]
+
+    values = [int(x) for x in text.split('x')]
+    defaults = [10, 3, 100, 100]
+    values += defaults[len(values):]
+
+    return RepoShape(values[0], values[1], values[2], values[3], namespace)
+
+
+def _write(path, lines):
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    with io.open(path, "w", encoding="utf-8") as outfile:
+        outfile.write("\n".join(lines) + "\n")
+
+
+def generate_repo(folder, shape):
+    """Create a git repository with many synthetic components.
+
+    Each component is a folder with ``shape.packages`` python packages that
+    each contain a module of ``shape.module_lines`` lines.  If
+    ``shape.namespace`` is True, every component puts its packages inside a
+    shared ``bench_ns`` namespace package.  The managed files that
+    multipackage edits start out with ``shape.managed_lines`` unmanaged lines.
+
+    The repository is not initialized, so its components are returned to be
+    added to the components file after ``multipackage init``.
+
+    Args:
+        folder (str): The folder to create the repository in.
+        shape (RepoShape): The size and layout of the repository.
+
+    Returns:
+        list of str: The lines that declare each component.
+    """
+
+    components = []
+    module = ["def function_%d(value):" % i if i % 2 == 0 else "    return value + %d" % i
+              for i in range(shape.module_lines)]
+
+    for i in range(shape.components):
+        name = "component_%03d" % i
+        comp_dir = os.path.join(folder, name)
+
+        _write(os.path.join(comp_dir, 'setup.py'), ["from setuptools import setup", "setup(name='%s')" % name])
+        _write(os.path.join(comp_dir, 'RELEASE.md'), ["# Release Notes", "", "## 1.0.0", "", "- Initial release"])
+
+        package_dir = comp_dir
+        if shape.namespace:
+            package_dir = os.path.join(comp_dir, 'bench_ns')
+            _write(os.path.join(package_dir, '__init__.py'), ["__path__ = __import__('pkgutil').extend_path(__path__, __name__)"])
+
+        for j in range(shape.packages):
+            package = os.path.join(package_dir, "pkg_%03d_%02d" % (i, j))
+            _write(os.path.join(package, '__init__.py'), ['"""Package %d of component %d."""' % (j, i)])
+            _write(os.path.join(package, 'module.py'), module)
+
+        os.makedirs(os.path.join(comp_dir, 'test'))
+        components.append("%s: ./%s, compatibility=universal" % (name, name))
+
+    unmanaged = ["unmanaged_line_%d" % i for i in range(shape.managed_lines)]
+    _write(os.path.join(folder, '.gitignore'), ["# local ignores"] + unmanaged)
+    _write(os.path.join(folder, 'requirements_build.txt'), ["# local requirements"] + ["# " + x for x in unmanaged])
+
+    subprocess.check_call(['git', 'init', '-q', folder])
+    subprocess.check_call(['git', '-C', folder, 'remote', 'add', 'origin', "git@github.com:com/my_package.git"])
+
+    return components
+
+
+class BenchmarkRecorder(object):
+    """Collects the timings of every benchmark in a session."""
+
+    def __init__(self, config):
+        self.results = {}
+        self.tolerance = config.getoption('benchmark_tolerance')
+        self.baseline = {}
+
+        compare_path = config.getoption('benchmark_compare')
+        if compare_path is not None:
+            with io.open(compare_path, "r", encoding="utf-8") as infile:
+                self.baseline = json.load(infile).get('results', {})
+
+    def time(self, benchmark, stage, func, rounds=1):
+        """Time a function, keeping the fastest of several rounds.
+
+        Args:
+            benchmark (str): The name of the benchmark, usually the shape id.
+            stage (str): The name of the stage being timed.
+            func (callable): The function to time.
+            rounds (int): How many times to call func.
+
+        Returns:
+            object: The return value of the last call to func.
+        """
+
+        best = None
+        for _i in range(rounds):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        self.results.setdefault(benchmark, {})[stage] = best
+        return result
+
+    def regressions(self, benchmark):
+        """Find stages that are slower than the baseline allows.
+
+        Returns:
+            list of str: A description of each regression.
+        """
+
+        found = []
+        baseline = self.baseline.get(benchmark, {})
+
+        for stage, seconds in sorted(self.results.get(benchmark, {}).items()):
+            old = baseline.get(stage)
+            if old is None:
+                continue
+
+            if seconds > old * (1 + self.tolerance) and seconds - old > MIN_COMPARE_SECONDS:
+                found.append("%s %s: %.3fs vs %.3fs baseline" % (benchmark, stage, seconds, old))
+
+        return found
+
+    def report(self):
+        """Build the json report of every timing."""
+
+        return {
+            'version': BENCHMARK_FORMAT_VERSION,
+            'python': platform.python_version(),
+            'platform': sys.platform,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': self.results
+        }
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('multipackage benchmarks')
+    group.addoption('--benchmark', action='store_true', default=False,
+                    help="Run the benchmarks against synthetic repositories")
+    group.addoption('--benchmark-shapes', default="10,100,20x3x100x100ns",
+                    help="Comma separated repository shapes to benchmark, see benchmark_repos.parse_shape")
+    group.addoption('--benchmark-save', metavar="PATH", help="Save benchmark timings to a json file")
+    group.addoption('--benchmark-compare', metavar="PATH", help="Fail benchmark stages slower than this saved json file")
+    group.addoption('--benchmark-tolerance', type=float, default=0.5,
+                    help="Allowed slowdown compared to --benchmark-compare, default 0.5 (50%%)")
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "benchmark: a slow benchmark that only runs with --benchmark")
+
+
+def pytest_generate_tests(metafunc):
+    if 'repo_shape' in metafunc.fixturenames:
+        shapes = [parse_shape(x.strip()) for x in metafunc.config.getoption('benchmark_shapes').split(',') if x.strip()]
+        metafunc.parametrize('repo_shape', shapes, ids=[shape_id(x) for x in shapes])
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('benchmark'):
+        return
+
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark")
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+_RECORDER_KEY = '_multipackage_benchmark_recorder'
+
+
+@pytest.fixture(scope="session")
+def benchmark_recorder(request):
+    """The recorder shared by all benchmarks in this session."""
+
+    recorder = BenchmarkRecorder(request.config)
+    setattr(request.config, _RECORDER_KEY, recorder)
+    return recorder
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    recorder = getattr(config, _RECORDER_KEY, None)
+    if recorder is None or len(recorder.results) == 0:
+        return
+
+    terminalreporter.section("multipackage benchmarks")
+    for benchmark, stages in sorted(recorder.results.items()):
+        terminalreporter.write_line(benchmark)
+        for stage, seconds in sorted(stages.items(), key=lambda x: x[0]):
+            baseline = recorder.baseline.get(benchmark, {}).get(stage)
+            change = "" if baseline is None else " (%+.0f%%)" % ((seconds / baseline - 1) * 100 if baseline > 0 else 0)
+            terminalreporter.write_line("  %-20s %9.1f ms%s" % (stage, seconds * 1000, change))
+
+    save_path = config.getoption('benchmark_save')
+    if save_path is not None:
+        with io.open(save_path, "w", encoding="utf-8") as outfile:
+            outfile.write(json.dumps(recorder.report(), indent=4, sort_keys=True))
+
+        terminalreporter.write_line("Saved benchmark timings to %s" % save_path)
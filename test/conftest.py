@@ -2,8 +2,25 @@
 
 import pytest
 from multipackage import Repository
+from multipackage.utilities import clear_template_cache
 
-pytest_plugins = ['mock_travis', 'mock_pypi', 'mock_slack']
+pytest_plugins = ['mock_travis', 'mock_pypi', 'mock_slack', 'benchmark_repos']
+
+
+@pytest.fixture(autouse=True)
+def user_cache(tmp_path, monkeypatch):
+    """Keep every test's persistent caches out of the real user cache directory.
+
+    The shared template environments are cleared as well since they keep
+    the bytecode cache directory that they were created with.
+    """
+
+    cache_dir = tmp_path / "user_cache"
+    monkeypatch.setenv('MULTIPACKAGE_CACHE_DIR', str(cache_dir))
+
+    clear_template_cache()
+    yield cache_dir
+    clear_template_cache()
 
 
 @pytest.fixture(scope="function")
@@ -21,7 +21,7 @@ try:
     import pytest
     from pytest_localserver.http import WSGIServer
     from werkzeug.wrappers import Request, Response
-    import Crypto.PublicKey
+    import Crypto.PublicKey.RSA
 except ImportError:
     HAS_DEPENDENCIES = False
 
@@ -5,13 +5,13 @@ import os
 from multipackage.data.scripts.generate_api import main as generate_main
 from multipackage.utilities import directory_hash
 
-def get_args(tmpdir, extra_args=None):
+def get_args(tmpdir, extra_args=None, name="api"):
     """Get the args needed to invoke apigen."""
 
     base_folder = os.path.join(os.path.dirname(__file__), '..', 'multipackage')
     template_folder = os.path.join(base_folder, "data", "templates")
 
-    outdir = tmpdir.mkdir("api")
+    outdir = tmpdir.mkdir(name)
 
     args = ['-o', str(outdir), "-t", template_folder, base_folder]
     if extra_args is not None:
@@ -21,16 +21,20 @@ def get_args(tmpdir, extra_args=None):
 
 
 def test_stable_generation(tmpdir):
-    """Make sure we can generate the same files on python 2/3."""
+    """Make sure generating the api docs twice produces the same files."""
 
     args, outdir = get_args(tmpdir)
-
     generate_main(args)
     hash_value = directory_hash(outdir, "*.rst")
 
-    # Make sure this output format stays constant, will need to
-    # be updated as this package is updated.
-    print("If this test fails, the multipackage api may have just changed")
-    print("and you need to update the encoded hash in this test")
-    print("Actual Hash: %s" % hash_value)
-    assert hash_value == 'MD5:F12FAFB9E95EFADFF3737049E9DF5F2F'
+    args, second_outdir = get_args(tmpdir, name="api2")
+    generate_main(args)
+    assert directory_hash(second_outdir, "*.rst") == hash_value
+
+    generated = sorted(x for x in os.listdir(second_outdir) if x.endswith('.rst'))
+    assert len(generated) > 0
+
+    with open(os.path.join(second_outdir, generated[0]), "a") as outfile:
+        outfile.write("\nchanged\n")
+
+    assert directory_hash(second_outdir, "*.rst") != hash_value
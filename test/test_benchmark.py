@@ -0,0 +1,64 @@
+"""Benchmarks of the main multipackage operations on large repositories.
+
+These only run when pytest is passed --benchmark, see benchmark_repos.py.
+"""
+
+import os
+import pytest
+from multipackage import Repository
+from multipackage.utilities import render_template
+from benchmark_repos import generate_repo, shape_id
+
+# Repeat the stages that do not modify the repository and keep the fastest
+ROUNDS = 3
+
+
+@pytest.fixture(scope="function")
+def bench_env(tmpdir, travis, monkeypatch):
+    """Provide the secrets needed to update."""
+
+    monkeypatch.setenv('GITHUB_TOKEN', "github_token")
+    monkeypatch.setenv('PYPI_USER', 'test_user')
+    monkeypatch.setenv('PYPI_PASS', 'test_pass')
+    monkeypatch.setenv('SLACK_TOKEN', 'test_slack_token')
+    monkeypatch.setenv('SLACK_WEB_HOOK', 'http://127.0.0.1:8000/nothing')
+
+    return tmpdir
+
+
+@pytest.mark.benchmark
+def test_benchmark_repository(bench_env, repo_shape, benchmark_recorder):
+    """Time each stage of managing a synthetic repository."""
+
+    name = shape_id(repo_shape)
+    folder = str(bench_env.join('repo'))
+
+    components = generate_repo(folder, repo_shape)
+
+    benchmark_recorder.time(name, 'initialize', lambda: Repository(folder).initialize())
+
+    with open(os.path.join(folder, '.multipackage', 'components.txt'), 'a') as outfile:
+        outfile.write("\n" + "\n".join(components) + "\n")
+
+    repo = benchmark_recorder.time(name, 'construct', lambda: Repository(folder), rounds=ROUNDS)
+    assert repo.clean
+    assert len(repo.components) == repo_shape.components
+    assert repo.template.namespace_packages == (['bench_ns'] if repo_shape.namespace else [])
+
+    benchmark_recorder.time(name, 'update', lambda: Repository(folder).update())
+    benchmark_recorder.time(name, 'update_unchanged', lambda: Repository(folder).update(), rounds=ROUNDS)
+    benchmark_recorder.time(name, 'update_force', lambda: Repository(folder).update(force=True))
+
+    repo = Repository(folder)
+    benchmark_recorder.time(name, 'verify_all', lambda: repo.manifest.verify_all(report=True), rounds=ROUNDS)
+    benchmark_recorder.time(name, 'verify_paranoid', lambda: repo.manifest.verify_all(report=True, paranoid=True),
+                            rounds=ROUNDS)
+    assert repo.clean
+
+    variables = {'repo': repo, 'repo_path': folder}
+    info = benchmark_recorder.time(name, 'info_render', lambda: render_template(repo.template.INFO_TEMPLATE, variables),
+                                   rounds=ROUNDS)
+    assert 'component_000' in info
+
+    regressions = benchmark_recorder.regressions(name)
+    assert regressions == [], "Benchmark regressions:\n" + "\n".join(regressions)
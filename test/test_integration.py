@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import os
+import json
 import sys
 import subprocess
 import shlex
@@ -10,7 +11,9 @@ import pytest
 from multipackage.scripts.multipackage import main as multipackage_main
 from multipackage import Repository
 from multipackage.subsystems import TravisSubsystem
+from multipackage.watch import RepositoryWatcher
 from multipackage.utilities import line_hash
+from multipackage.exceptions import ManualInterventionError
 
 
 def assert_file(folder, relpath, expected_hash):
@@ -353,3 +356,265 @@ def test_travis_encryption(bare_uni):
     travis_sub = [x for x in repo.subsystems if isinstance(x, TravisSubsystem)][0]
 
     travis_sub.update(repo.options)
+
+
+def test_update_dry_run(bare_uni, capsys):
+    """Make sure update --dry-run prints a diff without writing anything."""
+
+    def _snapshot():
+        found = {}
+        for root, _dirs, files in os.walk(bare_uni):
+            if '.git' in root.split(os.sep):
+                continue
+
+            for name in files:
+                path = os.path.join(root, name)
+                found[path] = os.stat(path).st_mtime_ns
+
+        return found
+
+    before = _snapshot()
+    capsys.readouterr()
+
+    assert multipackage_main(['update', '--dry-run']) == 1
+    assert _snapshot() == before
+
+    stdout = capsys.readouterr().out
+    assert '+++ b/.gitignore' in stdout
+    assert '--- /dev/null' in stdout
+    assert 'SUMMARY:' in stdout
+    assert 'created   doc' in stdout
+
+    assert multipackage_main(['update']) == 0
+    assert os.path.exists('.gitignore')
+
+
+# Startup budget for importing the CLI, importing it takes about 75-120 ms
+CLI_IMPORT_BUDGET_US = 150000
+
+# Modules that are slow to import and only needed by some commands
+HEAVY_MODULES = ('jinja2', 'sqlite3', 'ctypes', 'Crypto', 'requests', 'setuptools', 'pkg_resources')
+
+
+def test_cli_lazy_imports():
+    """Make sure the CLI does not import heavy dependencies at startup."""
+
+    script = "import sys; import multipackage.scripts.multipackage; print(' '.join(sorted(sys.modules)))"
+    modules = set(subprocess.check_output([sys.executable, '-c', script], universal_newlines=True).split())
+
+    toplevel = set(name.split('.')[0] for name in modules)
+    assert [name for name in HEAVY_MODULES if name in toplevel] == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime requires python 3.7+")
+def test_cli_import_budget():
+    """Make sure importing the CLI stays within its startup budget."""
+
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import multipackage.scripts.multipackage'],
+                                     stderr=subprocess.STDOUT, universal_newlines=True)
+
+    cumulative = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(cumulative_us)
+
+    assert cumulative['multipackage.scripts.multipackage'] < CLI_IMPORT_BUDGET_US
+
+
+def test_update_skips_unchanged(bare_uni, travis, monkeypatch, caplog):
+    """Make sure update only reruns subsystems whose inputs or outputs changed."""
+
+    assert multipackage_main(['update']) == 0
+    assert 'undeclared paths' not in caplog.text
+
+    updated = []
+    orig_update_subsystems = Repository._update_subsystems
+
+    def _record(self, force):
+        result = orig_update_subsystems(self, force)
+        updated[:] = [name for name, _inputs, _outputs in result]
+        return result
+
+    monkeypatch.setattr(Repository, '_update_subsystems', _record)
+
+    manifest_path = os.path.join(bare_uni, '.multipackage', 'manifest.json')
+    travis_mtime = os.stat('.travis.yml').st_mtime_ns
+    manifest_mtime = os.stat(manifest_path).st_mtime_ns
+
+    assert multipackage_main(['update']) == 0
+    assert updated == []
+    assert os.stat('.travis.yml').st_mtime_ns == travis_mtime
+    assert os.stat(manifest_path).st_mtime_ns == manifest_mtime
+
+    # Touching an output reruns only the subsystem that produced it
+    with open('.pylintrc', 'a') as outfile:
+        outfile.write('\n# local change\n')
+
+    assert multipackage_main(['update']) == 0
+    assert updated == ['PylintLinter']
+
+    with open('.pylintrc', 'r') as infile:
+        assert '# local change' not in infile.read()
+
+    # Changing a secret's presence reruns the subsystems that use it
+    monkeypatch.delenv('SLACK_TOKEN')
+    assert multipackage_main(['update']) == 0
+    assert updated == ['TravisSubsystem']
+
+    assert multipackage_main(['update', '--force']) == 0
+    assert len(updated) == 4
+
+    # Files that are only created if missing are still outputs
+    os.remove(os.path.join('doc', 'index.rst'))
+    assert multipackage_main(['update']) == 0
+    assert updated == ['SphinxDocumentation']
+    assert os.path.exists(os.path.join('doc', 'index.rst'))
+
+    # Secrets are encrypted for the repository that origin points to
+    travis.quick_add_project('com/renamed_package', server="com")
+    subprocess.check_call(['git', 'remote', 'set-url', 'origin', 'git@github.com:com/renamed_package.git'])
+    assert multipackage_main(['update']) == 0
+    assert updated == ['TravisSubsystem']
+
+
+def test_fleet(tmpdir, travis, monkeypatch, capsys):
+    """Make sure update --all and info --all process every repository."""
+
+    root = str(tmpdir.join('fleet'))
+    repos = [os.path.join(root, 'repo_a'), os.path.join(root, 'nested', 'repo_b')]
+
+    monkeypatch.setenv('GITHUB_TOKEN', "github_token")
+    monkeypatch.setenv('PYPI_USER', 'test_user')
+    monkeypatch.setenv('PYPI_PASS', 'test_pass')
+    monkeypatch.setenv('SLACK_TOKEN', 'test_slack_token')
+    monkeypatch.setenv('SLACK_WEB_HOOK', 'http://127.0.0.1:8000/nothing')
+
+    for folder in repos:
+        copy_repo('test_project', folder)
+        multipackage_main(['init', folder])
+
+        with open(os.path.join(folder, ".multipackage", "components.txt"), 'a') as outfile:
+            outfile.write('\nmy_package: ./, compatibility=universal\n')
+
+    # Uninitialized and hidden folders are ignored
+    copy_repo('test_project', os.path.join(root, 'uninitialized'))
+    shutil.copytree(repos[0], os.path.join(root, '.hidden'))
+
+    def _run(args):
+        capsys.readouterr()
+        retval = multipackage_main(args)
+        return retval, json.loads(capsys.readouterr().out)
+
+    retval, report = _run(['update', '--dry-run', '--all', root, '-j', '2'])
+    assert retval == 1
+    assert [x['path'] for x in report['repositories']] == sorted(repos)
+    assert report['summary']['outdated'] == 2
+    assert all('.travis.yml' in x['changes'] for x in report['repositories'])
+
+    retval, report = _run(['update', '--all', root, '-j', '2'])
+    assert retval == 0
+    assert report['summary'] == {'ok': 2, 'outdated': 0, 'unclean': 0, 'error': 0}
+    for folder in repos:
+        assert os.path.exists(os.path.join(folder, '.travis.yml'))
+
+    # Rerendering with unchanged secrets reuses their encrypted values
+    retval, report = _run(['update', '--dry-run', '--force', '--all', root])
+    assert retval == 0
+    assert [x['changes'] for x in report['repositories']] == [[], []]
+
+    retval, report = _run(['info', '--all', root])
+    assert retval == 0
+    assert report['action'] == 'info'
+    assert report['summary']['ok'] == 2
+
+    with open(os.path.join(repos[1], '.travis.yml'), 'a') as outfile:
+        outfile.write('\n# local change\n')
+
+    retval, report = _run(['info', '--all', root, '-j', '1'])
+    assert retval == 1
+    assert [x['status'] for x in report['repositories']] == ['unclean', 'ok']
+    assert report['repositories'][0]['errors'][0]['file'] == '.travis.yml'
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch(bare_uni, polling):
+    """Make sure watch mode only reapplies the subsystems affected by a change."""
+
+    watcher = RepositoryWatcher(bare_uni, polling=polling, interval=0.01, settle=0.05)
+
+    try:
+        assert len(watcher.apply()) == 4
+        assert watcher.poll(0.1) is None
+
+        with open('.pylintrc', 'a') as outfile:
+            outfile.write('\n# local change\n')
+
+        assert watcher.poll(5) == ['PylintLinter']
+
+        with open('.pylintrc', 'r') as infile:
+            assert '# local change' not in infile.read()
+
+        # A new package is found by reloading the repository
+        os.mkdir('new_package')
+        with open(os.path.join('new_package', '__init__.py'), 'w') as outfile:
+            outfile.write('\n')
+
+        assert watcher.poll(5) == ['SphinxDocumentation']
+        assert 'new_package' in watcher.repo.template.toplevel_packages['my_package']
+    finally:
+        watcher.close()
+
+
+def test_watch_survives_errors(bare_uni, monkeypatch, caplog):
+    """Make sure a failed update does not stop later changes from being applied."""
+
+    watcher = RepositoryWatcher(bare_uni, polling=True, interval=0.01, settle=0.05)
+
+    try:
+        assert len(watcher.apply()) == 4
+
+        orig_update = Repository.update
+
+        def _fail_once(self, *args, **kwargs):
+            monkeypatch.setattr(Repository, 'update', orig_update)
+            raise ManualInterventionError("Managed section was only partially saved", '.pylintrc')
+
+        monkeypatch.setattr(Repository, 'update', _fail_once)
+
+        with open('.pylintrc', 'a') as outfile:
+            outfile.write('\n# local change\n')
+
+        assert watcher.poll(5) == []
+        assert 'partially saved' in caplog.text
+
+        with open('.editorconfig', 'a') as outfile:
+            outfile.write('\n# local change\n')
+
+        assert sorted(watcher.poll(5)) == ['BasicPythonSupport', 'PylintLinter']
+
+        with open('.pylintrc', 'r') as infile:
+            assert '# local change' not in infile.read()
+    finally:
+        watcher.close()
+
+
+def test_update_profile(bare_uni, tmpdir, capsys):
+    """Make sure --profile reports the time spent in each stage of update."""
+
+    trace_path = str(tmpdir.join('trace.json'))
+
+    assert multipackage_main(['--profile', '--profile-trace', trace_path, 'update']) == 0
+
+    stderr = capsys.readouterr().err
+    assert 'PROFILE: slowest spans' in stderr
+    assert 'PylintLinter' in stderr
+
+    with open(trace_path, "r") as infile:
+        events = json.load(infile)['traceEvents']
+
+    categories = set(x['cat'] for x in events)
+    for category in ('command', 'subsystem', 'ensure', 'template', 'hash', 'subprocess'):
+        assert category in categories
@@ -1,5 +1,9 @@
 """Tests of ManifestFile class."""
 
+import os
+from multipackage import Repository
+from multipackage.manifest import ManifestFile, SQLiteManifestFile, HashJob, VALID, INVALID_HASH, NOT_PRESENT, PRESENT_UNKNOWN
+
 
 def test_basic_behavior(init_repo):
     """Make sure everything works in the default case."""
@@ -10,3 +14,211 @@ def test_basic_behavior(init_repo):
 
     assert init_repo.initialized
     assert not init_repo.settings_changed
+
+
+def test_stat_fast_path(init_repo):
+    """Make sure unchanged stat info skips hashing unless paranoid."""
+
+    manifest = init_repo.manifest
+    settings_path = os.path.join(init_repo.path, init_repo.SETTINGS_FILE)
+    key = manifest._make_key(settings_path)
+
+    assert manifest.files[key].file_stat is not None
+
+    with open(settings_path, "rb") as infile:
+        data = infile.read()
+
+    orig_stat = os.stat(settings_path)
+
+    # Same size and mtime but different contents are not seen without paranoid
+    with open(settings_path, "wb") as outfile:
+        outfile.write(data.replace(b'macos', b'mocos'))
+
+    os.utime(settings_path, ns=(orig_stat.st_atime_ns, orig_stat.st_mtime_ns))
+
+    manifest.verify_all()
+    assert manifest.files[key].status == VALID
+
+    manifest.verify_all(paranoid=True)
+    assert manifest.files[key].status == INVALID_HASH
+
+    # A real modification changes the mtime and is always detected
+    os.utime(settings_path, ns=(orig_stat.st_atime_ns, orig_stat.st_mtime_ns + 10**9))
+    manifest.verify_all()
+    assert manifest.files[key].status == INVALID_HASH
+
+    os.remove(settings_path)
+    manifest.verify_all()
+    assert manifest.files[key].status == NOT_PRESENT
+
+
+def test_batch_hashing(tmpdir):
+    """Make sure batched hashing returns results in job order."""
+
+    paths = []
+    for i in range(20):
+        path = tmpdir.join("file_%02d.txt" % i)
+        path.write("line %d\nline 2\n" % i)
+        paths.append(str(path))
+
+    jobs = [HashJob(path, 'line') for path in paths]
+    jobs.append(HashJob(str(tmpdir.join("missing.txt")), 'line'))
+
+    hashes = ManifestFile._load_files(jobs)
+    assert hashes[:-1] == [ManifestFile._load_file(path) for path in paths]
+    assert hashes[-1] is None
+
+
+def test_hash_migration(init_repo):
+    """Make sure md5 entries are verified and lazily migrated."""
+
+    manifest_path = os.path.join(init_repo.path, init_repo.MANIFEST_FILE)
+    manifest = ManifestFile(manifest_path, init_repo.path, init_repo, hash_method="blake2b")
+
+    assert all(x.expected_hash.startswith("MD5:") for x in manifest.files.values())
+
+    manifest.verify_all(report=True, paranoid=True)
+    assert all(x.status == VALID for x in manifest.files.values())
+
+    migrated = manifest.migrate_hashes()
+    assert sorted(migrated) == sorted(manifest.files)
+    assert all(x.expected_hash.startswith("BLAKE2B:") for x in manifest.files.values())
+
+    manifest.save()
+
+    manifest = ManifestFile(manifest_path, init_repo.path, init_repo)
+    manifest.verify_all(report=True, paranoid=True)
+    assert all(x.status == VALID for x in manifest.files.values())
+    assert init_repo.count_messages('error') == 0
+
+
+def test_save_only_when_dirty(init_repo):
+    """Make sure an unchanged manifest is not rewritten."""
+
+    manifest = init_repo.manifest
+    settings_path = os.path.join(init_repo.path, init_repo.SETTINGS_FILE)
+
+    assert not manifest.dirty
+    manifest.update_file(settings_path, hash_type="json")
+    assert not manifest.dirty
+
+    os.remove(manifest.path)
+    manifest.save()
+    assert not os.path.exists(manifest.path)
+
+    manifest.save(force=True)
+    assert os.path.exists(manifest.path)
+
+    manifest.remove_file(settings_path)
+    assert manifest.dirty
+    manifest.save()
+    assert not manifest.dirty
+
+
+def test_sqlite_manifest(init_repo):
+    """Make sure the sqlite backend imports, queries and updates entries."""
+
+    settings_path = os.path.join(init_repo.path, init_repo.SETTINGS_FILE)
+    component_path = os.path.join(init_repo.path, init_repo.COMPONENT_FILE)
+
+    init_repo.set_setting('manifest.backend', 'sqlite')
+    init_repo.manifest.update_file(settings_path, hash_type="json")
+    init_repo.manifest.save()
+
+    repo = Repository(init_repo.path)
+    manifest = repo.manifest
+    assert isinstance(manifest, SQLiteManifestFile)
+    assert repo.count_messages('error') == 0
+    assert manifest.dirty
+
+    manifest.save()
+    assert os.path.exists(manifest.path)
+
+    repo = Repository(init_repo.path)
+    manifest = repo.manifest
+    assert not manifest.dirty
+    assert not repo.settings_changed
+    assert manifest.get(component_path).hash_type == 'line'
+    assert manifest.get(os.path.join(init_repo.path, 'missing.txt')) is None
+
+    found = manifest.find_prefix(os.path.join(init_repo.path, init_repo.MULTIPACKAGE_DIR))
+    assert [x.relative_path for x in found] == ['.multipackage/components.txt', '.multipackage/settings.json']
+    assert manifest.find_prefix(os.path.join(init_repo.path, 'doc')) == []
+
+    manifest.remove_file(component_path)
+    manifest.save()
+
+    manifest = Repository(init_repo.path).manifest
+    assert manifest.get(component_path) is None
+    assert sorted(manifest.files) == ['.multipackage/settings.json']
+
+    manifest.verify_all(report=True, paranoid=True)
+    assert manifest.files['.multipackage/settings.json'].status == VALID
+
+
+def test_lazy_status(tmpdir, monkeypatch):
+    """Make sure file existence is only checked when statuses are needed."""
+
+    paths = []
+    for i in range(3):
+        path = tmpdir.join("file_%d.txt" % i)
+        path.write("line %d\n" % i)
+        paths.append(str(path))
+
+    manifest_path = str(tmpdir.join("manifest.json"))
+    tmpdir.join("manifest.json").write("{}")
+
+    manifest = ManifestFile(manifest_path, str(tmpdir), None)
+    manifest.update_files([HashJob(path, 'line') for path in paths])
+    manifest.save()
+
+    os.remove(paths[1])
+
+    def _fail(path):
+        raise AssertionError("os.path.exists called while loading manifest: %s" % path)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os.path, 'exists', _fail)
+        manifest = ManifestFile(manifest_path, str(tmpdir), None)
+
+    statuses = {key: info.status for key, info in manifest.files.items()}
+    assert statuses == {'file_0.txt': PRESENT_UNKNOWN, 'file_1.txt': NOT_PRESENT, 'file_2.txt': PRESENT_UNKNOWN}
+    assert manifest.get(paths[1]).status == NOT_PRESENT
+
+
+def test_fingerprints(init_repo):
+    """Make sure subsystem fingerprints are saved by both backends."""
+
+    manifest = init_repo.manifest
+    fingerprint = {'inputs': 'MD5:1234', 'outputs': {'.pylintrc': [10, 20, 30]}}
+
+    manifest.set_fingerprint('PylintLinter', fingerprint)
+    manifest.save()
+
+    repo = Repository(init_repo.path)
+    assert repo.count_messages('error') == 0
+    assert repo.manifest.get_fingerprint('PylintLinter') == fingerprint
+    assert repo.manifest.get(os.path.join(init_repo.path, '#fingerprints')) is None
+
+    # Fingerprints are imported into and updated in the sqlite database
+    init_repo.set_setting('manifest.backend', 'sqlite')
+    init_repo.manifest.update_file(os.path.join(init_repo.path, init_repo.SETTINGS_FILE), hash_type="json")
+    init_repo.manifest.save()
+
+    repo = Repository(init_repo.path)
+    repo.manifest.save()
+
+    repo = Repository(init_repo.path)
+    assert repo.manifest.get_fingerprint('PylintLinter') == fingerprint
+
+    repo.manifest.set_fingerprint('TravisSubsystem', {'inputs': 'MD5:5678', 'outputs': {}})
+    repo.manifest.set_fingerprint('PylintLinter', None)
+    repo.manifest.save()
+
+    repo = Repository(init_repo.path)
+    assert repo.manifest.get_fingerprint('PylintLinter') is None
+    assert repo.manifest.get_fingerprint('TravisSubsystem')['inputs'] == 'MD5:5678'
+
+    repo.manifest.clear()
+    assert repo.manifest.get_fingerprint('TravisSubsystem') is None
+    repo.manifest.close()
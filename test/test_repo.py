@@ -1,6 +1,10 @@
 """Unit tests of the Repository class."""
 
+import os
 import pytest
+from multipackage import Repository
+from multipackage.repo import _group_subsystems
+from multipackage.utilities import overlay as overlay_mod
 from multipackage.exceptions import InternalError, InvalidSettingError, InvalidEnvironmentError
 
 
@@ -47,3 +51,161 @@ def test_settings(init_repo):
         init_repo.set_setting('doc.deploy.test', 'abc')
 
     assert error.value.variable_name == "doc.deploy.test"
+
+
+def test_batch_settings(init_repo, monkeypatch):
+    """Make sure settings are only written when they change."""
+
+    writes = []
+    monkeypatch.setattr(init_repo.manifest, 'update_file', lambda path, hash_type: writes.append(path))
+
+    init_repo.set_setting('test_matrix.platforms', init_repo.get_setting('test_matrix.platforms'))
+    assert len(writes) == 0
+
+    with init_repo.batch_settings():
+        init_repo.set_setting('doc.deploy', 'abc')
+        init_repo.set_setting('doc.other', 'def')
+        assert len(writes) == 0
+
+    assert len(writes) == 1
+
+    reloaded = Repository(init_repo.path)
+    assert reloaded.get_setting('doc') == {'deploy': 'abc', 'other': 'def'}
+    assert reloaded.count_messages('warning') == 0
+
+
+def test_unchanged_files_not_rewritten(init_repo):
+    """Make sure identical template and script output does not touch files."""
+
+    script_path = os.path.join(init_repo.path, init_repo.SCRIPT_DIR, 'release_notes.py')
+    doc_path = os.path.join(init_repo.path, 'components_copy.txt')
+
+    init_repo.ensure_script(os.path.join(init_repo.SCRIPT_DIR, 'release_notes.py'), 'release_notes.py')
+    init_repo.ensure_template('components_copy.txt', 'components.txt')
+    init_repo.ensure_lines('.gitignore', ['built_docs/'])
+
+    paths = [script_path, doc_path, os.path.join(init_repo.path, '.gitignore')]
+    for path in paths:
+        os.utime(path, ns=(10**18, 10**18))
+
+    init_repo.ensure_script(os.path.join(init_repo.SCRIPT_DIR, 'release_notes.py'), 'release_notes.py')
+    init_repo.ensure_template('components_copy.txt', 'components.txt')
+    init_repo.ensure_lines('.gitignore', ['built_docs/'])
+
+    assert all(os.stat(path).st_mtime_ns == 10**18 for path in paths)
+    assert init_repo.manifest.verify_file(doc_path, paranoid=True) == "unchanged"
+
+    with open(doc_path, "a") as outfile:
+        outfile.write("modified\n")
+
+    init_repo.ensure_template('components_copy.txt', 'components.txt')
+    assert os.stat(doc_path).st_mtime_ns != 10**18
+    assert init_repo.manifest.verify_file(doc_path, paranoid=True) == "unchanged"
+
+
+def test_transaction(init_repo, monkeypatch):
+    """Make sure edits inside a transaction are coalesced and atomic."""
+
+    gitignore = os.path.join(init_repo.path, '.gitignore')
+    hashed = []
+
+    orig_update_files = init_repo.manifest.update_files
+    monkeypatch.setattr(init_repo.manifest, 'update_files',
+                        lambda jobs: hashed.extend(jobs) or orig_update_files(jobs))
+
+    with init_repo.transaction() as overlay:
+        init_repo.ensure_lines('.gitignore', ['a'])
+        init_repo.ensure_lines('.gitignore', ['b'])
+        init_repo.ensure_lines('.gitignore', ['a'], present=False)
+        init_repo.ensure_template('components_copy.txt', 'components.txt')
+
+        assert not os.path.exists(gitignore)
+        assert b'\nb\n' in overlay.read(gitignore)
+
+    assert len(hashed) == 2
+    assert init_repo.manifest.verify_file(gitignore, paranoid=True) == "unchanged"
+
+    # Rendered templates are hashed while rendering, not read back from disk
+    template_job = [job for job in hashed if job.path.endswith('components_copy.txt')][0]
+    assert template_job.known_hash is not None
+    assert init_repo.manifest.verify_file(template_job.path, paranoid=True) == "unchanged"
+
+    with open(gitignore, "r") as infile:
+        lines = infile.read().splitlines()
+
+    assert 'b' in lines and 'a' not in lines
+
+    with pytest.raises(RuntimeError):
+        with init_repo.transaction():
+            init_repo.ensure_lines('.gitignore', ['c'])
+            init_repo.ensure_template('components_copy.txt', 'components.txt', present=False)
+            raise RuntimeError("subsystem failure")
+
+    with open(gitignore, "r") as infile:
+        assert infile.read().splitlines() == lines
+
+    assert os.path.exists(os.path.join(init_repo.path, 'components_copy.txt'))
+
+    with init_repo.transaction():
+        with pytest.raises(InternalError):
+            with init_repo.transaction(dry_run=True):
+                pass
+
+
+def test_transaction_rollback(init_repo, monkeypatch):
+    """Make sure files already replaced are restored if a later change fails."""
+
+    gitignore = os.path.join(init_repo.path, '.gitignore')
+    init_repo.ensure_lines('.gitignore', ['existing'])
+    with open(gitignore, "rb") as infile:
+        original = infile.read()
+
+    copy_path = os.path.join(init_repo.path, 'components_copy.txt')
+    new_path = os.path.join(init_repo.path, 'new_file.txt')
+    init_repo.ensure_template('components_copy.txt', 'components.txt')
+
+    orig_replace = os.replace
+
+    def _fail_last(src, dst):
+        if dst.endswith('new_file.txt'):
+            raise OSError("disk full")
+
+        orig_replace(src, dst)
+
+    monkeypatch.setattr(overlay_mod.os, 'replace', _fail_last)
+
+    with pytest.raises(OSError):
+        with init_repo.transaction():
+            init_repo.ensure_lines('.gitignore', ['added'])
+            init_repo.ensure_template('components_copy.txt', 'components.txt', present=False)
+            init_repo.ensure_lines('new_file.txt', ['new'])
+
+    monkeypatch.undo()
+
+    with open(gitignore, "rb") as infile:
+        assert infile.read() == original
+
+    assert os.path.exists(copy_path)
+    assert not os.path.exists(new_path)
+    assert sorted(x for x in os.listdir(init_repo.path) if x.endswith(('.new', '.old'))) == []
+
+
+def test_group_subsystems():
+    """Make sure only subsystems with overlapping outputs are grouped."""
+
+    root = os.path.abspath(os.sep)
+    path = lambda *parts: os.path.join(root, *parts)
+
+    outputs = [
+        {path('.gitignore'), path('scripts')},
+        {path('.travis.yml')},
+        {path('.pylintrc')},
+        {path('scripts', 'build.py'), path('doc')},
+        {path('doc', 'conf.py')}
+    ]
+
+    assert _group_subsystems(outputs) == [[0, 3, 4], [1], [2]]
+
+    # Subsystems that do not declare their outputs conflict with everything
+    assert _group_subsystems(outputs + [None]) == [[0, 1, 2, 3, 4, 5]]
+    assert _group_subsystems([]) == []
@@ -2,10 +2,21 @@
 
 from builtins import open
 import os
+import json
 import platform
+import random
+import re
+import threading
 import pytest
-from multipackage.utilities import ManagedFileSection, dict_hash, find_toplevel_packages
-from multipackage.exceptions import InternalError
+from multipackage.utilities import (ManagedFileSection, dict_hash, line_hash, line_hash_file, hash_method,
+                                    directory_hash, DirectoryHashCache, find_toplevel_packages,
+                                    SUPPORTED_HASH_METHODS, render_template, template_cache_stats,
+                                    clear_template_cache, user_cache_dir, stream_template, LineHasher,
+                                    PackageCache, timed, start_profiling, stop_profiling)
+from multipackage.utilities.template_compiler import compile_templates
+from multipackage.utilities.file_watch import create_watcher, PollingWatcher
+from multipackage.utilities import obj_hash
+from multipackage.exceptions import InternalError, ManualInterventionError
 
 
 def data_path(tmpdir, name, allow_empty=False):
@@ -168,3 +179,512 @@ def test_find_toplevel_packages():
 
     packages = find_toplevel_packages(os.path.join(os.path.dirname(__file__), '..'))
     assert packages == ['multipackage']
+
+
+def test_package_cache(tmpdir, monkeypatch):
+    """Make sure package discovery is cached until __init__.py files change."""
+
+    import multipackage.utilities.packages as packages_mod
+
+    searched = []
+    orig_scan = packages_mod._scan_packages
+    monkeypatch.setattr(packages_mod, '_scan_packages',
+                        lambda *args: searched.append(args) or orig_scan(*args))
+
+    root = tmpdir.mkdir("component")
+    root.mkdir("ns").join("__init__.py").write("")
+    root.join("ns").mkdir("pkg").join("__init__.py").write("")
+    root.mkdir("data").mkdir("nested")
+    root.mkdir("test").join("__init__.py").write("")
+    root.join("test").mkdir("sub").join("__init__.py").write("")
+    path = str(root)
+
+    cache_path = str(tmpdir.join("cache", "packages.json"))
+    cache = PackageCache(cache_path)
+    assert find_toplevel_packages(path, cache=cache) == ['ns']
+    assert find_toplevel_packages(path, prefix='ns', cache=cache) == ['ns.pkg']
+    assert find_toplevel_packages(path, prefix='ns', cache=cache) == ['ns.pkg']
+    assert len(searched) == 2
+    cache.save()
+
+    cache = PackageCache(cache_path)
+    assert find_toplevel_packages(path, cache=cache) == ['ns']
+    assert len(searched) == 2
+
+    # New packages appearing anywhere discovery looks invalidate the cache
+    root.join("data").join("__init__.py").write("")
+    cache = PackageCache(cache_path)
+    assert find_toplevel_packages(path, cache=cache) == ['data', 'ns']
+    assert len(searched) == 3
+
+    root.join("data").join("nested").join("__init__.py").write("")
+    assert find_toplevel_packages(path, prefix='data', cache=PackageCache()) == ['data.nested']
+
+    root.join("ns").join("pkg").join("__init__.py").remove()
+    cache.save()
+    cache = PackageCache(cache_path)
+    assert find_toplevel_packages(path, prefix='ns', cache=cache) == []
+
+    # Entries for deleted folders are dropped and unchanged entries are not rewritten
+    other = tmpdir.mkdir("other")
+    other.mkdir("pkg").join("__init__.py").write("")
+    cache = PackageCache(cache_path)
+    assert find_toplevel_packages(str(other), cache=cache) == ['pkg']
+    cache.save()
+    other.remove()
+
+    cache = PackageCache(cache_path)
+    root.mkdir("docs")
+    assert find_toplevel_packages(path, cache=cache) == ['data', 'ns']
+    cache.save()
+
+    with open(cache_path, "r", encoding="utf-8") as infile:
+        assert list(json.load(infile)['entries']) == [path]
+
+    # Another process saving the same entries does not rewrite the file
+    root.mkdir("extra")
+    cache = PackageCache(cache_path)
+    other_cache = PackageCache(cache_path)
+    assert find_toplevel_packages(path, cache=cache) == ['data', 'ns']
+    assert find_toplevel_packages(path, cache=other_cache) == ['data', 'ns']
+    cache.save()
+
+    saved_mtime = os.stat(cache_path).st_mtime_ns
+    other_cache.save()
+    assert os.stat(cache_path).st_mtime_ns == saved_mtime
+
+    # Excluded packages are pruned, including their subpackages
+    assert find_toplevel_packages(path, exclude=()) == ['data', 'ns', 'test']
+    assert find_toplevel_packages(path, prefix='test') == ['test.sub']
+    assert find_toplevel_packages(path, prefix='missing') == []
+
+
+@pytest.mark.parametrize("data", [
+    "", "\n", "\n\n", "a", "a\n", "a\nb", "a\r\nb\r\n", "a\rb\r", "a\r\r\nb",
+    "line 1\r\nline 2\nline 3\rline 4\r\n\r\n", "é中\r\né\n"
+])
+def test_streaming_line_hash(tmpdir, data):
+    """Make sure streaming line hashes match the list based version."""
+
+    path = str(tmpdir.join("hash_file.txt"))
+    with open(path, "w", encoding="utf-8", newline='') as outfile:
+        outfile.write(data)
+
+    with open(path, "r", encoding="utf-8", newline='') as infile:
+        expected = line_hash(infile.readlines())
+
+    for chunk_size in (1, 2, 3, 1024):
+        assert line_hash_file(path, chunk_size=chunk_size) == expected
+
+
+def test_hash_methods():
+    """Make sure all supported hash methods produce prefixed hashes."""
+
+    obj = {'test1': 15.0}
+
+    assert dict_hash(obj).startswith("MD5:")
+    assert dict_hash(obj, "sha256").startswith("SHA256:")
+    assert dict_hash(obj, "blake2b").startswith("BLAKE2B:")
+
+    for method in SUPPORTED_HASH_METHODS:
+        assert hash_method(line_hash(["a", "b"], method)) == method
+
+    with pytest.raises(ValueError):
+        line_hash(["a"], "sha1")
+
+    with pytest.raises(ValueError):
+        hash_method("07358855AB401EE3EAB3167DA585C70A")
+
+
+def test_directory_hash(tmpdir):
+    """Make sure directory hashes cover nested file contents."""
+
+    root = tmpdir.mkdir("tree")
+    root.join("a.txt").write("hello\n")
+    sub = root.mkdir("sub").mkdir("deeper")
+    deep_file = sub.join("b.txt")
+    deep_file.write("world\n")
+    root.mkdir("empty")
+
+    initial = directory_hash(str(root), "*.txt")
+
+    # Line endings and unselected or empty folders don't matter
+    root.join("a.txt").write_binary(b"hello\r\n")
+    root.mkdir("other").join("c.rst").write("ignored")
+    assert directory_hash(str(root), "*.txt") == initial
+
+    deep_file.write("changed\n")
+    changed = directory_hash(str(root), "*.txt")
+    assert changed != initial
+
+    cache_path = str(tmpdir.join("cache", "hashes.json"))
+    cache = DirectoryHashCache(cache_path)
+    assert directory_hash(str(root), "*.txt", cache=cache) == changed
+    assert os.path.exists(cache_path)
+
+    cache = DirectoryHashCache(cache_path)
+    assert directory_hash(str(root), "*.txt", cache=cache) == changed
+
+    deep_file.write("changed again\n")
+    assert directory_hash(str(root), "*.txt", cache=DirectoryHashCache(cache_path)) == directory_hash(str(root), "*.txt")
+
+
+def test_directory_hash_cache(tmpdir, monkeypatch):
+    """Make sure cached files are not read again and stale entries are pruned."""
+
+    root = tmpdir.mkdir("tree")
+    root.join("a.txt").write("hello\n")
+    deleted = root.mkdir("sub").join("b.txt")
+    deleted.write("world\n")
+
+    reads = []
+    original = obj_hash.line_hash_file
+
+    def _counting_hash(path, method):
+        reads.append(path)
+        return original(path, method)
+
+    monkeypatch.setattr(obj_hash, 'line_hash_file', _counting_hash)
+
+    cache_path = str(tmpdir.join("hashes.json"))
+    initial = directory_hash(str(root), "*.txt", cache=DirectoryHashCache(cache_path))
+    assert len(reads) == 2
+
+    del reads[:]
+    assert directory_hash(str(root), "*.txt", cache=DirectoryHashCache(cache_path)) == initial
+    assert reads == []
+
+    deleted.remove()
+    directory_hash(str(root), "*.txt", cache=DirectoryHashCache(cache_path))
+    assert reads == []
+
+    with open(cache_path, "r", encoding="utf-8") as infile:
+        keys = json.load(infile)['entries']
+
+    assert not any(key.endswith(str(deleted)) for key in keys)
+    assert not any(key.endswith(str(root.join("sub"))) for key in keys)
+    assert any(key.endswith(str(root.join("a.txt"))) for key in keys)
+
+
+def _sequential_ensure_lines(section, lines, match, present, multi):
+    """Reference implementation that processes one line at a time."""
+
+    section = list(section)
+    for i, line in enumerate(lines):
+        if match is None:
+            found = [j for j, x in enumerate(section) if x == line]
+        else:
+            found = [j for j, x in enumerate(section) if re.match(match[i], x) is not None]
+
+        if len(found) > 1 and not multi:
+            raise InternalError("multiple matches")
+
+        if len(found) == 0 and present:
+            section.append(line)
+        elif len(found) > 0:
+            for j in sorted(found[1:] if present else found, reverse=True):
+                del section[j]
+
+            if present:
+                section[found[0]] = line
+
+    return section
+
+
+@pytest.mark.parametrize("use_regex", [False, True])
+def test_ensure_lines_plan(use_regex):
+    """Make sure the indexed matcher gives the same result as sequential matching."""
+
+    rand = random.Random(1234)
+    words = ['a', 'b', 'c', 'a1', 'b2', 'c3', 'ab']
+    regexes = ['a', 'b', r'c\d', r'\w\d', 'ab', 'ab?', 'a|c', 'x']
+
+    for _i in range(500):
+        section_lines = [rand.choice(words) for _j in range(rand.randint(0, 8))]
+        lines = [rand.choice(words) for _j in range(rand.randint(1, 5))]
+        match = [rand.choice(regexes) for _line in lines] if use_regex else None
+        present = rand.random() < 0.7
+        multi = rand.random() < 0.5
+
+        section = ManagedFileSection("unused_path.txt", data="\n".join(section_lines) + "\n")
+        section.section_contents = list(section_lines)
+
+        try:
+            expected = _sequential_ensure_lines(section_lines, lines, match, present, multi)
+        except InternalError:
+            with pytest.raises(InternalError):
+                section._plan_lines(lines, match, present, multi)
+            continue
+
+        assert section._plan_lines(lines, match, present, multi) == expected
+
+
+def test_section_splice(tmpdir):
+    """Make sure updating a section leaves the rest of the file untouched."""
+
+    path = str(tmpdir.join("large.yml"))
+    before = b"".join(b"key_%d: value\r\n" % i for i in range(20000))
+    after = b"".join(b"other_%d: value\n" % i for i in range(20000)) + b"no final newline"
+
+    with open(path, "wb") as outfile:
+        outfile.write(before + after)
+
+    section = ManagedFileSection(path)
+    assert section.has_section is False
+    assert section.line_ending == "\r\n"
+
+    section.update(['managed: 1'])
+
+    with open(path, "rb") as infile:
+        data = infile.read()
+
+    assert data.endswith(before + after)
+
+    # Insert unmanaged content before the section and update it again
+    with open(path, "wb") as outfile:
+        outfile.write(before + data)
+
+    section = ManagedFileSection(path)
+    assert section.has_section is True
+    assert section.modified is False
+    assert section.section_contents == ['managed: 1']
+
+    section.ensure_lines(['managed: 2'], match=[r'managed:'])
+
+    with open(path, "rb") as infile:
+        data = infile.read()
+
+    assert data.startswith(before)
+    assert data.endswith(before + after)
+
+    section = ManagedFileSection(path)
+    assert section.section_contents == ['managed: 2']
+    assert len(section.other_lines) == 60001
+
+    # Parsing from in-memory data gives the same result as the file
+    with open(path, "r", encoding="utf-8", newline='') as infile:
+        text = infile.read()
+
+    in_memory = ManagedFileSection(path, data=text)
+    assert in_memory.section_contents == section.section_contents
+    assert in_memory.update(['managed: 3'], save=False) == section.update(['managed: 3'], save=False)
+
+
+
+@pytest.mark.parametrize("lines", [
+    ["# END MULTIPACKAGE MANAGED SECTION", "# BEGIN MULTIPACKAGE MANAGED SECTION, HASH=abc", "line",
+     "# END MULTIPACKAGE MANAGED SECTION"],
+    ["# END MULTIPACKAGE MANAGED SECTION", "# BEGIN MULTIPACKAGE MANAGED SECTION, HASH=abc", "line"],
+    ["# BEGIN MULTIPACKAGE MANAGED SECTION, HASH=abc", "line"],
+    ["# END MULTIPACKAGE MANAGED SECTION", "other"]
+])
+def test_section_corrupted(tmpdir, lines):
+    """Make sure misplaced section markers are rejected."""
+
+    path = str(tmpdir.join("corrupted.txt"))
+    with open(path, "w", encoding="utf-8") as outfile:
+        outfile.write(u"\n".join(lines) + u"\n")
+
+    with pytest.raises(ManualInterventionError):
+        ManagedFileSection(path)
+
+
+def test_template_cache(monkeypatch):
+    """Make sure templates environments and bytecode are cached."""
+
+    try:
+        first = render_template('components.txt', {})
+        assert render_template('components.txt', {}) == first
+
+        stats = template_cache_stats()
+        assert stats['environment_misses'] == 1
+        assert stats['environment_hits'] == 1
+        assert stats['bytecode_misses'] == 1
+
+        # A new process would only have the on-disk bytecode cache
+        clear_template_cache()
+        assert render_template('components.txt', {}) == first
+        assert template_cache_stats()['bytecode_hits'] == 1
+
+        # Different filter sets use separate environments
+        render_template('components.txt', {}, filters={'custom': lambda x: x})
+        assert template_cache_stats()['environment_misses'] == 2
+
+        monkeypatch.setenv('MULTIPACKAGE_CACHE_DIR', '')
+        assert user_cache_dir('templates') is None
+    finally:
+        clear_template_cache()
+
+
+def test_template_cache_stats_threads():
+    """Make sure the cache counters are not lost when rendering from many threads."""
+
+    filter_sets = [None, {'custom': lambda x: x}, {'other': lambda x: x}]
+
+    def _render(index):
+        for _i in range(50):
+            render_template('components.txt', {}, filters=filter_sets[index % len(filter_sets)])
+
+    threads = [threading.Thread(target=_render, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    stats = template_cache_stats()
+    assert stats['environment_misses'] == 3
+    assert stats['environment_hits'] + stats['environment_misses'] == 300
+
+
+def test_precompiled_templates(tmpdir, monkeypatch):
+    """Make sure precompiled templates are preferred and render identically."""
+
+    monkeypatch.setenv('MULTIPACKAGE_CACHE_DIR', '')
+    clear_template_cache()
+
+    try:
+        expected = render_template('components.txt', {})
+        assert template_cache_stats()['precompiled_hits'] == 0
+
+        compiled_dir = str(tmpdir.join('compiled'))
+        names = compile_templates(compiled_dir)
+        assert 'travis.yml.tpl' in names
+        assert 'module.rst' not in names
+
+        monkeypatch.setattr('multipackage.utilities.template_env.COMPILED_TEMPLATE_DIR', compiled_dir)
+        clear_template_cache()
+
+        assert render_template('components.txt', {}) == expected
+        assert template_cache_stats()['precompiled_hits'] == 1
+
+        # Templates missing from the compiled folder fall back to the source
+        source_dir = tmpdir.mkdir('source')
+        source_dir.join('components.txt').write("compiled version\n")
+        partial_dir = str(tmpdir.join('partial'))
+        compile_templates(partial_dir, str(source_dir))
+
+        monkeypatch.setattr('multipackage.utilities.template_env.COMPILED_TEMPLATE_DIR', partial_dir)
+        clear_template_cache()
+
+        assert render_template('components.txt', {}) == "compiled version"
+        render_template('editorconfig', {})
+        assert template_cache_stats()['precompiled_hits'] == 1
+
+        # Templates compiled by a different jinja2 version are ignored
+        tmpdir.join('partial', 'jinja2_version.txt').write("0.0.1")
+        clear_template_cache()
+
+        assert render_template('components.txt', {}) == expected
+        assert template_cache_stats()['precompiled_hits'] == 0
+    finally:
+        clear_template_cache()
+
+
+def test_stream_template(tmpdir):
+    """Make sure streamed templates match rendered ones and are hashed in the same pass."""
+
+    variables = {'options': {}, 'components': []}
+    expected = render_template('components.txt', variables)
+
+    hasher = LineHasher('sha256')
+    out_path = str(tmpdir.join('streamed.txt'))
+    with open(out_path, "wb") as outfile:
+        stream_template('components.txt', variables, outfile, hasher=hasher)
+
+    with open(out_path, "rb") as infile:
+        assert infile.read() == expected.encode('utf-8')
+
+    assert hasher.hexdigest() == line_hash_file(out_path, 'sha256')
+
+    rendered_path = str(tmpdir.join('rendered.txt'))
+    assert render_template('components.txt', variables, out_path=rendered_path) == expected
+    assert not os.path.exists(rendered_path + '.new')
+
+    with open(rendered_path, "rb") as infile:
+        assert infile.read() == expected.encode('utf-8')
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_file_watcher(tmpdir, polling):
+    """Make sure both watchers report created, modified and removed entries."""
+
+    folder = str(tmpdir.mkdir('watched'))
+    other = str(tmpdir.mkdir('other'))
+    path = os.path.join(folder, 'file.txt')
+
+    watcher = create_watcher([folder], polling=polling, interval=0.01)
+    assert isinstance(watcher, PollingWatcher) == polling or platform.system() != 'Linux'
+
+    try:
+        assert watcher.wait(0.05) == set()
+
+        with open(path, "w") as outfile:
+            outfile.write(u"hello")
+
+        assert path in watcher.wait(2)
+        watcher.reset()
+
+        with open(os.path.join(other, 'ignored.txt'), "w") as outfile:
+            outfile.write(u"hello")
+
+        assert watcher.wait(0.05) == set()
+
+        watcher.set_folders([folder, other])
+        os.remove(path)
+        os.mkdir(os.path.join(other, 'subdir'))
+
+        changed = set()
+        while len(changed) < 2:
+            found = watcher.wait(2)
+            assert len(found) > 0
+            changed.update(found)
+
+        assert changed == set([path, os.path.join(other, 'subdir')])
+    finally:
+        watcher.close()
+
+
+def test_profiler(tmpdir):
+    """Make sure timed spans are only recorded while profiling."""
+
+    with timed('test', 'ignored'):
+        pass
+
+    profiler = start_profiling(use_cprofile=True)
+    try:
+        with timed('test', 'outer'):
+            for _i in range(3):
+                with timed('test', 'inner'):
+                    sum(range(1000))
+
+        with timed('other', 'single'):
+            pass
+    finally:
+        assert stop_profiling() is profiler
+
+    with timed('test', 'ignored'):
+        pass
+
+    rows = {(category, name): calls for category, name, calls, _wall, _cpu in profiler.summary()}
+    assert rows == {('test', 'outer'): 1, ('test', 'inner'): 3, ('other', 'single'): 1}
+    assert profiler.summary()[0][:2] == ('test', 'outer')
+
+    summary = profiler.format_summary()
+    assert 'inner' in summary and 'ignored' not in summary
+
+    trace = profiler.trace_events()
+    assert len(trace['traceEvents']) == 5
+    assert all(x['ph'] == 'X' and x['dur'] >= 0 for x in trace['traceEvents'])
+
+    trace_path = str(tmpdir.join('trace.json'))
+    pstats_path = str(tmpdir.join('profile.pstats'))
+    profiler.save_trace(trace_path)
+    profiler.save_pstats(pstats_path)
+
+    with open(trace_path, "r") as infile:
+        assert json.load(infile) == trace
+
+    import pstats
+    assert pstats.Stats(pstats_path).total_calls > 0
+